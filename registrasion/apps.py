@@ -1,8 +1,23 @@
 from __future__ import unicode_literals
 from django.apps import AppConfig
+from django.core import checks
 
 
 class RegistrasionConfig(AppConfig):
     name = "registrasion"
     label = "registrasion"
     verbose_name = "Registrasion"
+
+    def ready(self):
+        from . import checks as registrasion_checks
+        from .controllers import admission
+        from .controllers import checkin
+        from .controllers import conditions
+        from .controllers import discount
+        from .controllers import version
+        admission.connect_signals()
+        checkin.connect_signals()
+        conditions.register_controllers()
+        discount.connect_signals()
+        version.connect_signals()
+        checks.register(registrasion_checks.check_cache_backend)
@@ -0,0 +1,26 @@
+from django.core import checks
+
+from registrasion.controllers import version
+
+
+def check_cache_backend(app_configs, **kwargs):
+    ''' Warns if the default cache can't be shared between processes.
+    Registrasion uses the cache to tell every process when the inventory or
+    conditions change, and to store the conditions that each user meets, so
+    it only keeps those results for a single batch if the cache isn't
+    shared. '''
+
+    if version.shared_cache():
+        return []
+
+    return [
+        checks.Warning(
+            "The default cache backend is local to each process, so "
+            "Registrasion can't keep results worked out from the inventory, "
+            "conditions, and carts between requests.",
+            hint="Use a shared cache backend, such as memcached, or set "
+                 "CACHE_SHARED_BETWEEN_PROCESSES = True if you serve "
+                 "Registrasion from a single process.",
+            id="registrasion.W001",
+        )
+    ]
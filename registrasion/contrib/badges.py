@@ -0,0 +1,311 @@
+''' Renders attendees' badges in bulk, optionally in parallel.
+
+Rendered badges are stored, along with a hash of everything they were
+rendered from, so only badges whose user, attendee profile, paid items or
+templates have changed are rendered again. '''
+
+import hashlib
+import multiprocessing
+import os
+import zipfile
+
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db import transaction
+from django.template import loader
+from django.template.loader_tags import ExtendsNode
+from django.template.loader_tags import IncludeNode
+from django.utils import six
+
+from registrasion.models import commerce
+from registrasion.models import people
+
+
+BADGE_TEMPLATE = "registrasion/badge.svg"
+
+# How many newly rendered badges to store at once
+STORE_BATCH_SIZE = 100
+
+# The compiled badge template, in each worker process
+_worker_template = None
+
+
+def badge_users(users):
+    ''' Returns the users, with the attendee and attendee profile that badges
+    usually show loaded in the same query.
+
+    Arguments:
+        users (Queryset[User]): The users whose badges we want.
+
+    '''
+
+    return users.select_related(
+        "attendee",
+        "attendee__attendeeprofilebase",
+    ).order_by("id")
+
+
+def render_badge(user, template=None):
+    ''' Renders a single user's badge.
+
+    Arguments:
+        user (User): The user whose badge we want.
+
+        template (Optional[Template]): The compiled badge template. If this is
+            not given, it is loaded.
+
+    Returns:
+        str: The rendered badge (SVG).
+
+    '''
+
+    if template is None:
+        template = loader.get_template(BADGE_TEMPLATE)
+
+    data = {
+        "user": user,
+    }
+
+    return template.render(data)
+
+
+def cached_badge(user):
+    ''' Returns a single user's badge, rendering it only if it has changed
+    since it was last rendered.
+
+    Arguments:
+        user (User): The user whose badge we want.
+
+    Returns:
+        str: The rendered badge (SVG).
+
+    '''
+
+    users = User.objects.filter(pk=user.pk)
+    return dict(_render_badges(users, 1))[user.pk]
+
+
+def write_badges(users, fileobj, processes=1):
+    ''' Renders the badges for the given users, and writes them to a zip
+    file, named ``badge_<user id>.svg``. Badges are written as soon as they
+    are rendered, so the whole set is never held in memory.
+
+    Arguments:
+        users (Queryset[User]): The users whose badges we want.
+
+        fileobj (file): A file, opened for writing, or a path.
+
+        processes (int): The number of worker processes to render badges in.
+            If this is 1, badges are rendered in this process.
+
+    '''
+
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as z:
+        for user_id, badge in _render_badges(users, processes):
+            z.writestr("badge_%d.svg" % user_id, badge.encode("utf-8"))
+
+
+def write_archive(users, path=None, processes=1):
+    ''' Writes the badges for the given users to a zip file, as
+    ``write_badges`` does. The file is only replaced once every badge has
+    been written, so a partly written file is never served.
+
+    Arguments:
+        users (Queryset[User]): The users whose badges we want.
+
+        path (Optional[str]): Where to write the zip file. Defaults to the
+            ``BADGES_ARCHIVE`` setting.
+
+        processes (int): The number of worker processes to render badges in.
+
+    '''
+
+    if path is None:
+        path = getattr(settings, "BADGES_ARCHIVE", None)
+    if path is None:
+        raise ValueError("Give a path, or set BADGES_ARCHIVE")
+
+    partial = path + ".partial"
+    write_badges(users, partial, processes=processes)
+    os.rename(partial, path)
+
+
+def archive_path():
+    ''' Returns the path of the zip file that ``write_archive`` writes to by
+    default, if it has been written, or None. '''
+
+    path = getattr(settings, "BADGES_ARCHIVE", None)
+    if path is None or not os.path.exists(path):
+        return None
+    return path
+
+
+def _render_badges(users, processes):
+    ''' Yields (user id, badge) for each user, taking the badge from
+    RenderedBadge where it's up to date, and rendering (and storing) the
+    rest. '''
+
+    users = list(badge_users(users))
+    template = loader.get_template(BADGE_TEMPLATE)
+    keys = _badge_keys(users, template)
+
+    stored = people.RenderedBadge.objects.filter(
+        user__in=[user.id for user in users],
+    ).values_list("user", "key")
+    fresh = set(
+        user_id for user_id, key in stored if keys[user_id] == key
+    )
+
+    cached = people.RenderedBadge.objects.filter(
+        user__in=fresh,
+    ).values_list("user", "svg")
+    for result in cached.iterator():
+        yield result
+
+    stale = [user for user in users if user.id not in fresh]
+
+    batch = []
+    for user_id, badge in _render_uncached(stale, processes, template):
+        batch.append(people.RenderedBadge(
+            user_id=user_id,
+            key=keys[user_id],
+            svg=badge,
+        ))
+        if len(batch) == STORE_BATCH_SIZE:
+            _store_badges(batch)
+            batch = []
+        yield user_id, badge
+
+    _store_badges(batch)
+
+
+def _render_uncached(users, processes, template):
+    if not users:
+        return
+
+    if processes == 1:
+        for user in users:
+            yield user.id, render_badge(user, template)
+        return
+
+    # Worker processes must open their own database connections, if the
+    # template needs one, rather than sharing ours.
+    connections.close_all()
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    try:
+        for result in pool.imap(_render_in_worker, users, chunksize=16):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _init_worker():
+    global _worker_template
+    _worker_template = loader.get_template(BADGE_TEMPLATE)
+
+
+def _render_in_worker(user):
+    return user.id, render_badge(user, _worker_template)
+
+
+def _store_badges(rendered):
+    if not rendered:
+        return
+
+    user_ids = [badge.user_id for badge in rendered]
+
+    with transaction.atomic():
+        # Locking the users stops a concurrent export from storing the same
+        # badges between our delete and our insert
+        list(User.objects.select_for_update().filter(pk__in=user_ids))
+        people.RenderedBadge.objects.filter(user__in=user_ids).delete()
+        people.RenderedBadge.objects.bulk_create(rendered)
+
+
+def _badge_keys(users, template):
+    ''' Returns a dict of user id to a hash of everything that the user's
+    badge is rendered from. '''
+
+    user_ids = [user.id for user in users]
+
+    # The source, rather than the modification time, so that redeploying an
+    # unchanged template doesn't invalidate every badge
+    template_hash = hashlib.sha1()
+    for source in _template_sources(template):
+        template_hash.update(source.encode("utf-8"))
+    template_hash = template_hash.hexdigest()
+
+    profiles = people.AttendeeProfileBase.objects.filter(
+        attendee__user__in=user_ids,
+    ).select_related("attendee").select_subclasses()
+    profile_values = dict(
+        (profile.attendee.user_id, _field_values(profile))
+        for profile in profiles
+    )
+
+    paid_items = defaultdict(list)
+    items = commerce.ProductItem.objects.filter(
+        cart__user__in=user_ids,
+        cart__status=commerce.Cart.STATUS_PAID,
+    ).values_list("cart__user", "product", "product__name", "quantity")
+    for user_id, product_id, name, quantity in items:
+        paid_items[user_id].append((product_id, name, quantity))
+
+    keys = {}
+    for user in users:
+        content = (
+            template_hash,
+            user.username,
+            user.first_name,
+            user.last_name,
+            user.email,
+            profile_values.get(user.id),
+            sorted(paid_items[user.id]),
+        )
+        keys[user.id] = hashlib.sha1(
+            repr(content).encode("utf-8")
+        ).hexdigest()
+
+    return keys
+
+
+def _template_sources(template, seen=None):
+    ''' Returns the source of the template, and of every template that it
+    extends or includes by name. Templates named by a variable can't be
+    found here, so changes to those don't invalidate stored badges. '''
+
+    template = getattr(template, "template", template)
+    if seen is None:
+        seen = set()
+
+    sources = [getattr(template, "source", "")]
+    nodelist = getattr(template, "nodelist", None)
+    if nodelist is None:
+        return sources
+
+    names = [
+        node.parent_name for node in nodelist.get_nodes_by_type(ExtendsNode)
+    ] + [
+        node.template for node in nodelist.get_nodes_by_type(IncludeNode)
+    ]
+
+    for name in names:
+        # Constant names are resolved when the template is compiled
+        name = getattr(name, "var", name)
+        if not isinstance(name, six.string_types) or name in seen:
+            continue
+        seen.add(name)
+        sources.extend(_template_sources(loader.get_template(name), seen))
+
+    return sources
+
+
+def _field_values(instance):
+    return [
+        (field.attname, field.value_from_object(instance))
+        for field in instance._meta.concrete_fields
+    ]
@@ -0,0 +1,212 @@
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from registrasion.models import commerce
+from registrasion.models import people
+
+
+class AdmissionController(object):
+    ''' Controls how many users can use the registration pages at once.
+
+    When ``ADMISSION_LIMIT`` is set, at most that many users are admitted to
+    the registration pages at a time. Everyone else is given a place in a
+    queue, and is admitted in turn as admitted users check out, stop loading
+    pages for ``ADMISSION_TIMEOUT`` seconds, or let the reservation on the
+    items in their cart lapse. Staff, and users who have completed their
+    registration, are always admitted.
+
+    If ``ADMISSION_LIMIT`` is not set, everyone is admitted, and nothing is
+    stored.
+
+    '''
+
+    DEFAULT_TIMEOUT = 15 * 60
+
+    # How often a user's last seen time is written to the database
+    SEEN_INTERVAL = datetime.timedelta(seconds=30)
+
+    def __init__(self, ticket):
+        self.ticket = ticket
+
+    @classmethod
+    def enabled(cls):
+        return cls.limit() is not None
+
+    @classmethod
+    def limit(cls):
+        return getattr(settings, "ADMISSION_LIMIT", None)
+
+    @classmethod
+    def timeout(cls):
+        seconds = getattr(settings, "ADMISSION_TIMEOUT", cls.DEFAULT_TIMEOUT)
+        return datetime.timedelta(seconds=seconds)
+
+    @classmethod
+    def bypasses_queue(cls, user):
+        ''' Returns true if the user never needs to queue for the
+        registration pages. '''
+
+        if not cls.enabled() or user.is_staff:
+            return True
+
+        attendee = people.Attendee.get_instance(user)
+        return attendee.completed_registration
+
+    @classmethod
+    def for_user(cls, user):
+        ''' Returns the controller for the user's place in the queue,
+        joining the back of the queue if they don't have a place, or if
+        they have lost it. This admits as many waiting users as there is
+        room for. '''
+
+        now = timezone.now()
+
+        ticket, created = commerce.AdmissionTicket.objects.get_or_create(
+            user=user,
+            defaults={"time_last_seen": now},
+        )
+
+        if not created and ticket.time_last_seen < now - cls.timeout():
+            # They've lost their place, so they go to the back of the queue
+            ticket.delete()
+            ticket = commerce.AdmissionTicket.objects.create(
+                user=user,
+                time_last_seen=now,
+            )
+        elif now - ticket.time_last_seen > cls.SEEN_INTERVAL:
+            commerce.AdmissionTicket.objects.filter(pk=ticket.pk).update(
+                time_last_seen=now,
+            )
+            ticket.time_last_seen = now
+
+        ctrl = cls(ticket)
+        if not ctrl.is_admitted():
+            cls.admit_waiting()
+            ticket.refresh_from_db()
+
+        return ctrl
+
+    def is_admitted(self):
+        return self.ticket.time_admitted is not None
+
+    def position(self):
+        ''' Returns this user's position in the queue, starting at 1, or 0
+        if they have been admitted. '''
+
+        if self.is_admitted():
+            return 0
+
+        ahead = self._live_tickets().filter(
+            time_admitted=None,
+            id__lt=self.ticket.id,
+        ).count()
+
+        return ahead + 1
+
+    @classmethod
+    @transaction.atomic
+    def admit_waiting(cls):
+        ''' Admits waiting users, in order, until there are ``ADMISSION_LIMIT``
+        admitted users who are still active. '''
+
+        # Requests that admit users wait for each other here, so each one
+        # counts the users admitted by the others.
+        cls._lock_queue()
+
+        cls._release_lapsed_reservations()
+
+        tickets = cls._live_tickets()
+        admitted = tickets.exclude(time_admitted=None).count()
+        room = cls.limit() - admitted
+        if room <= 0:
+            return
+
+        waiting = tickets.filter(time_admitted=None).order_by("id")
+        admit = list(waiting.values_list("id", flat=True)[:room])
+        commerce.AdmissionTicket.objects.filter(id__in=admit).update(
+            time_admitted=timezone.now(),
+        )
+
+    @classmethod
+    def _lock_queue(cls):
+        ''' Locks the admission queue until the end of the current
+        transaction, creating it if it does not exist yet. '''
+
+        queues = commerce.AdmissionQueue.objects.select_for_update()
+
+        try:
+            return queues.get(pk=1)
+        except ObjectDoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                return commerce.AdmissionQueue.objects.create(pk=1)
+        except IntegrityError:
+            # Another request created the queue before we could.
+            return queues.get(pk=1)
+
+    @classmethod
+    def _release_lapsed_reservations(cls):
+        ''' Takes away the places of admitted users who have let the
+        reservation on the items in their cart lapse since they were
+        admitted. They have stopped buying, so they make room for the next
+        user in the queue, and have to queue again. '''
+
+        now = timezone.now()
+        carts = commerce.AdmissionTicket.objects.exclude(
+            time_admitted=None,
+        ).filter(
+            user__cart__status=commerce.Cart.STATUS_ACTIVE,
+            user__cart__productitem__isnull=False,
+        ).values_list(
+            "id",
+            "time_admitted",
+            "user__cart__time_last_updated",
+            "user__cart__reservation_duration",
+        ).distinct()
+
+        lapsed = [
+            ticket_id
+            for ticket_id, admitted, updated, duration in carts
+            if admitted < updated + duration <= now
+        ]
+
+        if lapsed:
+            commerce.AdmissionTicket.objects.filter(id__in=lapsed).delete()
+
+    @classmethod
+    def _live_tickets(cls):
+        ''' Returns the tickets for users who haven't lost their place. '''
+
+        cutoff = timezone.now() - cls.timeout()
+        return commerce.AdmissionTicket.objects.filter(
+            time_last_seen__gte=cutoff,
+        )
+
+
+def _cart_saved(sender, instance, **kwargs):
+    # Users who have checked out make room for the next user in the queue
+    if instance.status == commerce.Cart.STATUS_PAID:
+        if AdmissionController.enabled():
+            commerce.AdmissionTicket.objects.filter(
+                user=instance.user_id,
+            ).delete()
+            transaction.on_commit(AdmissionController.admit_waiting)
+
+
+def connect_signals():
+    ''' Frees users' places when they check out, and admits the next users
+    in the queue. This is called when the registrasion app is ready. '''
+
+    post_save.connect(
+        _cart_saved,
+        sender=commerce.Cart,
+        dispatch_uid="registrasion-admission",
+    )
@@ -1,5 +1,6 @@
 import contextlib
 import functools
+import threading
 
 from django.contrib.auth.models import User
 
@@ -13,16 +14,25 @@ class BatchController(object):
     outermost call will have the effect of ending the batch.
 
     Batches store results for functions wrapped with ``memoise``. These results
-    for the user are flushed at the end of the batch.
+    for the user are flushed at the end of the batch. Each thread has its own
+    batches, so concurrent requests from the same user don't share results.
 
     If a return for a memoised function has a callable attribute called
     ``end_batch``, that attribute will be called at the end of the batch.
 
     '''
 
-    _user_caches = {}
+    _local = threading.local()
     _NESTING_KEY = "nesting_count"
 
+    @classmethod
+    def _user_caches(cls):
+        try:
+            return cls._local.user_caches
+        except AttributeError:
+            cls._local.user_caches = {}
+            return cls._local.user_caches
+
     @classmethod
     @contextlib.contextmanager
     def batch(cls, user):
@@ -37,24 +47,29 @@ class BatchController(object):
 
     @classmethod
     def _enter_batch_context(cls, user):
-        if user not in cls._user_caches:
-            cls._user_caches[user] = cls._new_cache()
+        if user not in cls._user_caches():
+            cls._user_caches()[user] = cls._new_cache()
 
-        cache = cls._user_caches[user]
+        cache = cls._user_caches()[user]
         cache[cls._NESTING_KEY] += 1
 
     @classmethod
     def _exit_batch_context(cls, user):
-        cache = cls._user_caches[user]
+        cache = cls._user_caches()[user]
         cache[cls._NESTING_KEY] -= 1
 
         if cache[cls._NESTING_KEY] == 0:
-            cls._call_end_batch_methods(user)
-            del cls._user_caches[user]
+            try:
+                cls._call_end_batch_methods(user)
+            finally:
+                # A batch that failed to end must not leak into the next one
+                del cls._user_caches()[user]
+                if not cls._user_caches():
+                    cls._local.__dict__.pop("thread_cache", None)
 
     @classmethod
     def _call_end_batch_methods(cls, user):
-        cache = cls._user_caches[user]
+        cache = cls._user_caches()[user]
         ended = set()
         while True:
             keys = set(cache.keys())
@@ -101,15 +116,57 @@ class BatchController(object):
 
             return cache[func_key]
 
+        f._memoised_func = func
         return f
 
+    @classmethod
+    def forget(cls, user, memoised=None):
+        ''' Discards results stored in the user's current batch, so that they
+        are worked out again the next time they are needed. Results that have
+        an ``end_batch`` method are kept, so that the batch is still ended
+        properly.
+
+        Arguments:
+            user (User): The user whose results we want to discard.
+
+            memoised (Optional[callable]): A function wrapped with
+                ``memoise``. If given, only its results are discarded.
+
+        '''
+
+        cache = cls._user_caches().get(user)
+        if cache is None:
+            return
+
+        func = getattr(memoised, "_memoised_func", None)
+
+        for key in list(cache.keys()):
+            if key == cls._NESTING_KEY:
+                continue
+            if func is not None and key[0] is not func:
+                continue
+            if hasattr(cache[key], "end_batch"):
+                continue
+            del cache[key]
+
+    @classmethod
+    def thread_cache(cls):
+        ''' Returns a results cache that is shared by every batch open on
+        this thread, and discarded when the last of them ends, or None if no
+        batch is open. Use this for results that don't depend on the user.
+        '''
+
+        if not cls._user_caches():
+            return None
+        return cls._local.__dict__.setdefault("thread_cache", {})
+
     @classmethod
     def get_cache(cls, user):
-        if user not in cls._user_caches:
+        if user not in cls._user_caches():
             # Return blank cache here, we'll just discard :)
             return cls._new_cache()
 
-        return cls._user_caches[user]
+        return cls._user_caches()[user]
 
     @classmethod
     def _new_cache(cls):
@@ -1,16 +1,22 @@
 from .batch import BatchController
 from .category import CategoryController
+from .conditions import ConditionController
 from .discount import DiscountController
 from .flag import FlagController
+from .flag import FlagTable
 from .product import ProductController
+from .voucher import VoucherController
+from . import version
 
 import collections
 import datetime
 import functools
 import itertools
 
+from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import ValidationError
+from django.db import OperationalError
 from django.db import transaction
 from django.db.models import Max
 from django.db.models import Q
@@ -27,23 +33,67 @@ def _modifies_cart(func):
     if we're doing something that could modify the cart.
 
     It also wraps the execution of this function in a database transaction,
-    and marks the boundaries of a cart operations batch.
+    and marks the boundaries of a cart operations batch. If the transaction
+    fails because a lock could not be taken, or because of a serialization
+    failure, it is retried, as long as it is not part of a larger
+    transaction.
     '''
 
     @functools.wraps(func)
     def inner(self, *a, **k):
         self._fail_if_cart_is_not_active()
-        with transaction.atomic():
-            with BatchController.batch(self.cart.user):
-                # Mark the version of self in the batch cache as modified
-                memoised = self.for_user(self.cart.user)
-                memoised._modified_by_batch = True
-                return func(self, *a, **k)
+
+        # We can only retry if we own the whole transaction
+        if transaction.get_connection().in_atomic_block:
+            retries = 0
+        else:
+            retries = self.LOCK_RETRIES
+
+        while True:
+            try:
+                with transaction.atomic():
+                    # Results stored after our changes are invalid if the
+                    # changes are rolled back
+                    with ConditionController.forgetting_on_failure():
+                        with BatchController.batch(self.cart.user):
+                            return _modify_in_batch(self, func, *a, **k)
+            except OperationalError:
+                if retries == 0:
+                    raise
+                retries -= 1
     return inner
 
 
+def _modify_in_batch(ctrl, func, *a, **k):
+    ''' Calls ``func`` on the cart controller ``ctrl``, inside the current
+    batch, which is marked as having modified the cart. '''
+
+    user = ctrl.cart.user
+
+    # Mark the version of ctrl in the batch cache as modified
+    memoised = ctrl.for_user(user)
+    modified_earlier = hasattr(memoised, "_modified_by_batch")
+    memoised._modified_by_batch = True
+
+    try:
+        return func(ctrl, *a, **k)
+    except OperationalError:
+        # The transaction has failed, so the batch can't be ended inside it,
+        # and nothing worked out in it so far can be trusted. Changes made
+        # earlier in an enclosing batch were committed, so they still need
+        # the batch to be ended.
+        if not modified_earlier:
+            del memoised._modified_by_batch
+        BatchController.forget(user)
+        raise
+
+
 class CartController(object):
 
+    # The number of times a cart operation is retried if it fails because of
+    # contention for locks.
+    LOCK_RETRIES = 3
+
     def __init__(self, cart):
         self.cart = cart
 
@@ -58,12 +108,26 @@ class CartController(object):
                 user=user,
                 status=commerce.Cart.STATUS_ACTIVE,
             )
+            return cls(existing)
         except ObjectDoesNotExist:
-            existing = commerce.Cart.objects.create(
+            pass
+
+        with transaction.atomic():
+            # Serialise cart creation for this user, so that concurrent
+            # requests can't each create an active cart.
+            User.objects.select_for_update().get(pk=user.pk)
+
+            existing = commerce.Cart.objects.filter(
                 user=user,
-                time_last_updated=timezone.now(),
-                reservation_duration=datetime.timedelta(),
-            )
+                status=commerce.Cart.STATUS_ACTIVE,
+            ).first()
+            if existing is None:
+                existing = commerce.Cart.objects.create(
+                    user=user,
+                    time_last_updated=timezone.now(),
+                    reservation_duration=datetime.timedelta(),
+                )
+
         return cls(existing)
 
     def _fail_if_cart_is_not_active(self):
@@ -78,6 +142,8 @@ class CartController(object):
 
         time = timezone.now()
 
+        self._renew_voucher_claims(time)
+
         # Calculate the residual of the _old_ reservation duration
         # if it's greater than what's in the cart now, keep it.
         time_elapsed_since_updated = (time - self.cart.time_last_updated)
@@ -100,6 +166,36 @@ class CartController(object):
         self.cart.time_last_updated = time
         self.cart.reservation_duration = max(reservations)
 
+    def _renew_voucher_claims(self, time):
+        ''' Claims the cart's vouchers again if its reservation had expired
+        before ``time``, because the claims of expired carts may have been
+        forgotten. Vouchers that can't be claimed again are removed. Call
+        this before renewing the reservation. '''
+
+        cart = self.cart
+        if cart.time_last_updated + cart.reservation_duration > time:
+            return
+
+        # Other carts may have used up the voucher since the reservation
+        # expired, in which case this cart loses it.
+        lost = [
+            voucher for voucher in cart.vouchers.all()
+            if not VoucherController(voucher).renew_claim(cart)
+        ]
+
+        if lost:
+            cart.vouchers.remove(*lost)
+            ConditionController.forget_results(cart.user)
+
+    def _is_reserved(self):
+        ''' Returns True if the cart's reservation has not expired, in which
+        case the claims on its vouchers are still counted. '''
+
+        cart = self.cart
+        return cart.time_last_updated + cart.reservation_duration > (
+            timezone.now()
+        )
+
     def end_batch(self):
         ''' Calls ``_end_batch`` if a modification has been performed in the
         previous batch. '''
@@ -118,9 +214,12 @@ class CartController(object):
 
         self.cart.refresh_from_db()
 
+        # Renewing the reservation can remove vouchers, which changes the
+        # available discounts
+        self._autoextend_reservation()
+
         self._recalculate_discounts()
 
-        self._autoextend_reservation()
         self.cart.revision += 1
         self.cart.save()
 
@@ -146,6 +245,7 @@ class CartController(object):
         if cart.reservation_duration - elapsed > timedelta:
             return
 
+        self._renew_voucher_claims(timezone.now())
         cart.time_last_updated = timezone.now()
         cart.reservation_duration = timedelta
         cart.save()
@@ -167,13 +267,19 @@ class CartController(object):
 
         # n.b need to add have the existing items first so that the new
         # items override the old ones.
+        old_quantities = dict(
+            (i.product, i.quantity) for i in items_in_cart.all()
+        )
         all_product_quantities = dict(itertools.chain(
-            ((i.product, i.quantity) for i in items_in_cart.all()),
+            old_quantities.items(),
             product_quantities,
         )).items()
 
         # Validate that the limits we're adding are OK
         products = set(product for product, q in product_quantities)
+        self._lock_stock_limits(
+            product for product, quantity in product_quantities if quantity
+        )
         try:
             self._test_limits(all_product_quantities)
         except CartValidationError as ve:
@@ -207,6 +313,57 @@ class CartController(object):
         items_in_cart.filter(to_delete).delete()
         commerce.ProductItem.objects.bulk_create(new_items)
 
+        version.category_items_changed(
+            product.category_id for product, quantity in product_quantities
+            if old_quantities.get(product, 0) != quantity
+        )
+
+        # Reserve the items while we still hold the stock limit locks. The
+        # batch may end after this transaction commits, and until the cart is
+        # reserved, other carts don't count its items against stock limits.
+        self._autoextend_reservation()
+        self.cart.save(
+            update_fields=["time_last_updated", "reservation_duration"],
+        )
+
+        ConditionController.forget_results(self.cart.user, products)
+
+    def _lock_stock_limits(self, products):
+        ''' Locks the stock limit flags that cover the given products until
+        the end of the transaction. Other carts that want the same stock wait
+        here until we're done, so they count our items before testing their
+        own, and the stock limit can't be exceeded.
+
+        The locks are taken in order of ID, so that carts that need more
+        than one of the same flags can't deadlock. '''
+
+        product_ids = set(product.id for product in products)
+        if not product_ids:
+            return
+
+        flag_ids = [
+            condition_id
+            for condition_id, covered in FlagTable.get().products.items()
+            if product_ids.intersection(covered)
+        ]
+        if not flag_ids:
+            return
+
+        locked = conditions.TimeOrStockLimitFlag.objects.filter(
+            pk__in=flag_ids,
+            limit__isnull=False,
+        ).select_for_update().order_by("pk")
+
+        # Evaluating the queryset takes the locks
+        list(locked.values_list("pk", flat=True))
+
+        # Remainders worked out earlier in the batch (say, to show which
+        # products are available) were worked out before we held the locks,
+        # so they can't be used to test the limits.
+        user = self.cart.user
+        BatchController.forget(user, FlagController._filtered_flags)
+        BatchController.forget(user, ProductController.user_remainders)
+
     def _test_limits(self, product_quantities):
         ''' Tests that the quantity changes we intend to make do not violate
         the limits and flag conditions imposed on the products. '''
@@ -271,6 +428,12 @@ class CartController(object):
     def apply_voucher(self, voucher_code):
         ''' Applies the voucher with the given code to this cart. '''
 
+        # Reject unknown codes without querying the database
+        if not VoucherController.code_exists(voucher_code):
+            raise ValidationError(
+                "%s is not a valid voucher code." % voucher_code
+            )
+
         # Try and find the voucher
         voucher = inventory.Voucher.objects.get(code=voucher_code.upper())
 
@@ -278,33 +441,24 @@ class CartController(object):
         if voucher in self.cart.vouchers.all():
             return
 
-        self._test_voucher(voucher)
+        # Lock the voucher's counter until we've finished claiming it
+        self._test_voucher(voucher, lock=True)
 
         # If successful...
         self.cart.vouchers.add(voucher)
+        VoucherController(voucher).claim()
+        ConditionController.forget_results(self.cart.user)
 
-    def _test_voucher(self, voucher):
+    def _test_voucher(self, voucher, lock=False, held=False):
         ''' Tests whether this voucher is allowed to be applied to this cart.
-        Raises ValidationError if not. '''
+        Raises ValidationError if not. If ``lock`` is true, concurrent claims
+        on this voucher will wait until the current transaction ends. Set
+        ``held`` if the cart already holds the voucher. '''
 
-        # Is voucher exhausted?
-        active_carts = commerce.Cart.reserved_carts()
-
-        # It's invalid for a user to enter a voucher that's exhausted
-        carts_with_voucher = active_carts.filter(vouchers=voucher)
-        carts_with_voucher = carts_with_voucher.exclude(pk=self.cart.id)
-        if carts_with_voucher.count() >= voucher.limit:
-            raise ValidationError(
-                "Voucher %s is no longer available" % voucher.code)
-
-        # It's not valid for users to re-enter a voucher they already have
-        user_carts_with_voucher = carts_with_voucher.filter(
-            user=self.cart.user,
+        VoucherController(voucher).test_available(
+            self.cart, lock=lock, held=held and self._is_reserved(),
         )
 
-        if user_carts_with_voucher.count() > 0:
-            raise ValidationError("You have already entered this voucher.")
-
     def _test_vouchers(self, vouchers):
         ''' Tests each of the vouchers against self._test_voucher() and raises
         the collective ValidationError.
@@ -313,7 +467,7 @@ class CartController(object):
         errors = []
         for voucher in vouchers:
             try:
-                self._test_voucher(voucher)
+                self._test_voucher(voucher, held=True)
             except ValidationError as ve:
                 errors.append(ve)
 
@@ -413,12 +567,16 @@ class CartController(object):
         to_remove = []
         for voucher in self.cart.vouchers.all():
             try:
-                self._test_voucher(voucher)
+                self._test_voucher(voucher, held=True)
             except ValidationError:
                 to_remove.append(voucher)
 
         for voucher in to_remove:
             self.cart.vouchers.remove(voucher)
+            VoucherController(voucher).release()
+
+        if to_remove:
+            ConditionController.forget_results(self.cart.user)
 
         # Fix products and discounts
         items = commerce.ProductItem.objects.filter(cart=self.cart)
@@ -1,13 +1,18 @@
 from registrasion.models import commerce
+from registrasion.models import conditions
 from registrasion.models import inventory
 
+from django.core.cache import cache
 from django.db.models import Case
 from django.db.models import F, Q
 from django.db.models import Sum
 from django.db.models import When
 from django.db.models import Value
 
+from . import version
 from .batch import BatchController
+from .conditions import TimeOrStockLimitFlagController
+from .flag import FlagTable
 
 from operator import attrgetter
 
@@ -42,6 +47,50 @@ class CategoryController(object):
 
         return sorted(set(i.category for i in available), key=attrgetter("order"))
 
+    # How long a category's sold out status is kept, in seconds
+    SOLD_OUT_REFRESH = 30
+
+    @classmethod
+    def sold_out(cls, category_id):
+        ''' Returns true if no products from the category can be reserved
+        by anybody, because of time limits, or because all of their stock is
+        held in reserved carts. This doesn't depend on the user, so it's
+        worked out from the totals across all carts, and kept for
+        ``SOLD_OUT_REFRESH`` seconds.
+
+        Users who already hold one of the products in their own cart may
+        still be able to reserve it, so check ``available_categories`` for
+        them. '''
+
+        key = "registrasion-sold-out-%d-%s" % (
+            category_id, version.INVENTORY.current(),
+        )
+        sold_out = cache.get(key)
+        if sold_out is None:
+            sold_out = cls._sold_out(category_id)
+            cache.set(key, sold_out, cls.SOLD_OUT_REFRESH)
+        return sold_out
+
+    @classmethod
+    def _sold_out(cls, category_id):
+        table = FlagTable.get()
+        unavailable = TimeOrStockLimitFlagController.unavailable_to_everyone(
+            conditions.TimeOrStockLimitFlag,
+        )
+
+        products = inventory.Product.objects.filter(category=category_id)
+        for product_id in products.values_list("id", flat=True):
+            dif = table.dif.get(product_id, ())
+            eit = table.eit.get(product_id, ())
+            if any(i in unavailable for i in dif):
+                continue
+            if eit and all(i in unavailable for i in eit):
+                continue
+            # Somebody might be able to reserve this product
+            return False
+
+        return True
+
     @classmethod
     @BatchController.memoise
     def user_remainders(cls, user):
@@ -0,0 +1,191 @@
+import json
+
+from collections import defaultdict
+from django.apps import apps
+from django.db.models import Sum
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from registrasion.models import commerce
+from registrasion.models import people
+
+
+class CheckInController(object):
+    ''' Looks up and checks in attendees at the registration desk.
+
+    Each attendee's check-in manifest holds their name and paid items, so
+    that looking them up by access code is a single indexed query. Manifests
+    are rebuilt whenever one of the attendee's carts is paid or released, and
+    whenever their attendee profile is saved. '''
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    @classmethod
+    def for_access_code(cls, access_code):
+        ''' Returns the controller for the attendee with the given access
+        code, or None if there is no such attendee. '''
+
+        try:
+            manifest = people.CheckInManifest.objects.get(
+                access_code=access_code.upper(),
+            )
+        except people.CheckInManifest.DoesNotExist:
+            return None
+
+        return cls(manifest)
+
+    @classmethod
+    def update_manifest(cls, user):
+        ''' Rebuilds the check-in manifest for the given user. '''
+
+        attendee = people.Attendee.get_instance(user)
+        cls._update_manifests([attendee])
+
+    @classmethod
+    def update_all(cls):
+        ''' Rebuilds the check-in manifest for every attendee. '''
+
+        attendees = people.Attendee.objects.all()
+        cls._update_manifests(list(attendees))
+
+    @classmethod
+    def export(cls):
+        ''' Returns every attendee's manifest, as a list of dicts, in the
+        format returned by ``as_dict``. '''
+
+        manifests = people.CheckInManifest.objects.order_by("access_code")
+        return [cls(manifest).as_dict() for manifest in manifests]
+
+    def as_dict(self):
+        ''' Returns:
+            dict: with data::
+
+                {
+                    "access_code": str(),
+                    "name": str(),
+                    "items": [
+                        {
+                            "category": str(),
+                            "product": str(),
+                            "quantity": int(),
+                        },
+                        ...
+                    ],
+                    "time_checked_in": datetime(), # or None
+                }
+
+        '''
+
+        return {
+            "access_code": self.manifest.access_code,
+            "name": self.manifest.name,
+            "items": json.loads(self.manifest.items),
+            "time_checked_in": self.manifest.time_checked_in,
+        }
+
+    def check_in(self):
+        ''' Marks the attendee as checked in, if they haven't been already.
+
+        Returns:
+            bool: True if the attendee had not already checked in.
+
+        '''
+
+        now = timezone.now()
+        updated = people.CheckInManifest.objects.filter(
+            pk=self.manifest.pk,
+            time_checked_in=None,
+        ).update(time_checked_in=now)
+
+        self.manifest.refresh_from_db()
+        return updated == 1
+
+    @classmethod
+    def _update_manifests(cls, attendees):
+        user_ids = [attendee.user_id for attendee in attendees]
+
+        profiles = people.AttendeeProfileBase.objects.filter(
+            attendee__in=attendees,
+        ).select_related("attendee").select_subclasses()
+        names = dict(
+            (profile.attendee.user_id, cls._name(profile))
+            for profile in profiles
+        )
+
+        items = commerce.ProductItem.objects.filter(
+            cart__user__in=user_ids,
+            cart__status=commerce.Cart.STATUS_PAID,
+        ).values(
+            "cart__user",
+            "product__category__name",
+            "product__name",
+        ).annotate(
+            total=Sum("quantity"),
+        ).order_by(
+            "product__category__order",
+            "product__order",
+        )
+
+        paid_items = defaultdict(list)
+        for item in items:
+            paid_items[item["cart__user"]].append({
+                "category": item["product__category__name"],
+                "product": item["product__name"],
+                "quantity": item["total"],
+            })
+
+        for attendee in attendees:
+            # The check-in time is left alone, so rebuilding a manifest never
+            # un-checks-in an attendee
+            people.CheckInManifest.objects.update_or_create(
+                attendee=attendee,
+                defaults={
+                    "access_code": attendee.access_code,
+                    "name": names.get(attendee.user_id, ""),
+                    "items": json.dumps(paid_items[attendee.user_id]),
+                },
+            )
+
+    @classmethod
+    def _name(cls, profile):
+        if profile.name_field() is None:
+            return ""
+        return profile.attendee_name()
+
+
+def _cart_saved(sender, instance, **kwargs):
+    # Fixtures are loaded raw; their manifests are loaded alongside them
+    if kwargs.get("raw"):
+        return
+    if instance.status != commerce.Cart.STATUS_ACTIVE:
+        CheckInController.update_manifest(instance.user)
+
+
+def _profile_saved(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        return
+    CheckInController.update_manifest(instance.attendee.user)
+
+
+def connect_signals():
+    ''' Keeps check-in manifests up to date whenever a cart is paid or
+    released, or an attendee profile is saved. This is called when the
+    registrasion app is ready. '''
+
+    post_save.connect(
+        _cart_saved,
+        sender=commerce.Cart,
+        dispatch_uid="registrasion-checkin-cart",
+    )
+    # Attendee profiles are subclassed by the site, so connect to each of
+    # the subclasses, rather than to every model's saves.
+    for model in apps.get_models():
+        if issubclass(model, people.AttendeeProfileBase):
+            post_save.connect(
+                _profile_saved,
+                sender=model,
+                dispatch_uid="registrasion-checkin-profile-%s" % (
+                    model._meta.label
+                ),
+            )
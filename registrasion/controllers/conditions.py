@@ -1,3 +1,15 @@
+import contextlib
+import datetime
+import functools
+import itertools
+import operator
+import threading
+
+from collections import defaultdict
+from collections import namedtuple
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Case
 from django.db.models import F, Q
 from django.db.models import Sum
@@ -7,46 +19,452 @@ from django.utils import timezone
 
 from registrasion.models import commerce
 from registrasion.models import conditions
+from registrasion.models import inventory
+
+from symposion.schedule import models as schedule_models
+
+from . import version
+from .batch import BatchController
 
 
 _BIG_QUANTITY = 99999999  # A big quantity
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+_TimeWindow = namedtuple(
+    "_TimeWindow",
+    (
+        "token",
+        "condition_ids",
+        "valid_from",
+        "valid_until",
+    ),
+)
+
+
+def _group_pairs(rows):
+    ''' Turns (key, value) pairs, such as (condition ID, user ID), into a
+    mapping from each key to the set of its values. '''
+
+    groups = defaultdict(set)
+    for key, value in rows:
+        groups[key].add(value)
+    return groups
+
+
+@version.INVENTORY.memoise
+def flag_products():
+    ''' Returns the IDs of the products covered by each flag condition,
+    directly or through their categories.
+
+    Returns:
+        dict[int, tuple[int, ...]]: Sorted product IDs, keyed by condition
+            ID.
+
+    '''
+
+    ProductThrough = conditions.FlagBase.products.through
+    CategoryThrough = conditions.FlagBase.categories.through
+
+    products_by_category = defaultdict(list)
+    for product_id, category_id in inventory.Product.objects.values_list(
+            "id", "category_id"):
+        products_by_category[category_id].append(product_id)
+
+    covered = defaultdict(set)
+    for flag_id, product_id in ProductThrough.objects.values_list(
+            "flagbase_id", "product_id"):
+        covered[flag_id].add(product_id)
+    for flag_id, category_id in CategoryThrough.objects.values_list(
+            "flagbase_id", "category_id"):
+        covered[flag_id].update(products_by_category[category_id])
+
+    return dict((k, tuple(sorted(v))) for k, v in covered.items())
 
 
 class ConditionController(object):
     ''' Base class for testing conditions that activate Flag
     or Discount objects. '''
 
+    # Hints that describe what the result of the pre-filter for a condition
+    # depends on, so that it can be kept for as long as it is valid.
+    #
+    # CACHE_NONE: the pre-filter is evaluated every time.
+    # CACHE_STATIC: the result does not depend on the user at all, so it is
+    #   kept until the inventory or conditions change.
+    # CACHE_PER_USER: the result depends only on the contents of the user's
+    #   carts (and on which carts have been released), so it is kept until
+    #   the user's cart changes; between requests only if the cache is shared
+    #   between processes.
+    # CACHE_TIME_DEPENDENT: the result depends on the time and on stock held
+    #   by every user, so it is evaluated every time.
+    CACHE_NONE = "none"
+    CACHE_STATIC = "static"
+    CACHE_PER_USER = "per-user"
+    CACHE_TIME_DEPENDENT = "time-dependent"
+
+    CACHING = CACHE_NONE
+
+    # Maps condition types to the controllers that evaluate them. This is
+    # populated by ``register`` when the apps are ready.
+    _registry = {}
+
+    # The results forgotten by the cart operations in progress on each
+    # thread, so that they can be forgotten again if an operation fails.
+    _changes = threading.local()
+
     def __init__(self, condition):
         self.condition = condition
 
+    @staticmethod
+    def register(condition_type, controller):
+        ''' Registers the controller that evaluates conditions of the given
+        type. Sites that add their own condition types should call this from
+        their ``AppConfig.ready()``.
+
+        Controllers provide ``pre_filter`` and ``user_quantity_remaining``
+        (or ``is_met``) for one user at a time. They can also override
+        ``pre_filter_many`` and ``remainders_many`` to evaluate many users at
+        once, and set ``CACHING`` to describe how long their pre-filter
+        results stay valid.
+
+        Arguments:
+            condition_type (type): A concrete subclass of
+                ``conditions.FlagBase`` or ``conditions.DiscountBase``.
+
+            controller (type): A subclass of ``ConditionController``.
+
+        '''
+
+        ConditionController._registry[condition_type] = controller
+
     @staticmethod
     def _controllers():
-        return {
-            conditions.CategoryFlag: CategoryConditionController,
-            conditions.GroupMemberDiscount: GroupMemberConditionController,
-            conditions.GroupMemberFlag: GroupMemberConditionController,
-            conditions.IncludedProductDiscount: ProductConditionController,
-            conditions.ProductFlag: ProductConditionController,
-            conditions.SpeakerFlag: SpeakerConditionController,
-            conditions.SpeakerDiscount: SpeakerConditionController,
-            conditions.TimeOrStockLimitDiscount:
-                TimeOrStockLimitDiscountController,
-            conditions.TimeOrStockLimitFlag:
-                TimeOrStockLimitFlagController,
-            conditions.VoucherDiscount: VoucherConditionController,
-            conditions.VoucherFlag: VoucherConditionController,
-        }
+        return ConditionController._registry
 
     @staticmethod
     def for_type(cls):
-        return ConditionController._controllers()[cls]
+        return ConditionController._registry[cls]
 
     @staticmethod
     def for_condition(condition):
         try:
             return ConditionController.for_type(type(condition))(condition)
         except KeyError:
-            return ConditionController()
+            return ConditionController(condition)
+
+    @classmethod
+    def filtered_conditions(cls, base, user):
+        ''' Returns all of the conditions of the given base type that pass
+        the pre-filter for this user.
+
+        The pre-filters for every condition type are combined into a single
+        query, as ID-only subqueries, so that this takes one round-trip to the
+        database. Condition types that annotate a remainder in their
+        pre-filter are fetched with one more query, so that the conditions
+        carry their annotations.
+
+        Arguments:
+            base (type): ``conditions.FlagBase`` or
+                ``conditions.DiscountBase``.
+
+            user (User): The user for whom we're testing these conditions.
+
+        Returns:
+            [base, ...]: The conditions that passed the pre-filter, as
+                instances of their concrete subclasses.
+
+        '''
+
+        types = [i for i in cls._controllers() if issubclass(i, base)]
+
+        all_results = cls._load_results(user) or {}
+        results = all_results.setdefault(base._meta.model_name, {})
+
+        subqueries = []
+        remainder_types = []
+        evaluated = []
+
+        for condition_type in types:
+            ctrl = cls.for_type(condition_type)
+            if issubclass(ctrl, RemainderSetByFilter):
+                remainder_types.append(condition_type)
+                continue
+
+            queryset = condition_type.objects.all()
+
+            if ctrl.CACHING == cls.CACHE_STATIC:
+                passed = cls._static_ids(condition_type)
+                if passed:
+                    subqueries.append(Q(pk__in=passed))
+                continue
+
+            if ctrl.CACHING == cls.CACHE_PER_USER:
+                # Only evaluate the conditions we don't know about yet
+                ids = cls._condition_ids(condition_type)
+                passed = [i for i in ids if results.get(i)]
+                unknown = [i for i in ids if i not in results]
+                if passed:
+                    subqueries.append(Q(pk__in=passed))
+                if not unknown:
+                    continue
+                evaluated.extend(unknown)
+                queryset = queryset.filter(pk__in=unknown)
+
+            queryset = ctrl.pre_filter(queryset, user)
+            subqueries.append(Q(pk__in=queryset.values("pk")))
+
+        filtered = []
+
+        if subqueries:
+            passes_filter = functools.reduce(operator.or_, subqueries)
+            filtered.extend(
+                base.objects.filter(passes_filter).select_subclasses()
+            )
+
+        if evaluated:
+            passed = set(condition.id for condition in filtered)
+            results.update((i, i in passed) for i in evaluated)
+            cls._store_results(user, all_results)
+
+        for condition_type in remainder_types:
+            ctrl = cls.for_type(condition_type)
+            filtered.extend(
+                ctrl.pre_filter(condition_type.objects.all(), user)
+            )
+
+        return filtered
+
+    @classmethod
+    def forget_results(cls, user, products=None):
+        ''' Forgets the stored pre-filter results for the given user that
+        could be affected by a change to their cart. This is called
+        immediately, and again when the current transaction is committed, so
+        that no other request can store results from before the change.
+
+        Arguments:
+            user (User): The user whose cart has changed.
+
+            products (Optional[Iterable[inventory.Product]]): The products
+                whose quantities have changed. If not given, all of the
+                user's results are forgotten.
+
+        '''
+
+        if products is not None:
+            products = [product.id for product in products]
+
+        stack = getattr(cls._changes, "stack", None)
+        if stack:
+            stack[-1].append((user, products))
+
+        cls._forget_results(user, products)
+        transaction.on_commit(
+            lambda: cls._forget_results(user, products)
+        )
+
+    @classmethod
+    @contextlib.contextmanager
+    def forgetting_on_failure(cls):
+        ''' Records the results that are forgotten inside the block. If the
+        block raises an exception, its changes are rolled back, so results
+        worked out since those changes are forgotten again. Results that
+        don't depend on the changes are kept. '''
+
+        stack = cls._changes.__dict__.setdefault("stack", [])
+        stack.append([])
+        try:
+            yield
+        except Exception:
+            for user, product_ids in stack[-1]:
+                cls._forget_results(user, product_ids)
+            raise
+        finally:
+            changes = stack.pop()
+            if stack:
+                stack[-1].extend(changes)
+
+    @classmethod
+    def _forget_results(cls, user, product_ids):
+        if product_ids is None:
+            cls._store_results(user, None)
+            return
+
+        all_results = cls._load_results(user)
+        if not all_results:
+            return
+
+        dependencies = cls._dependencies()
+        for product_id in product_ids:
+            for base_name, condition_id in dependencies.get(product_id, ()):
+                all_results.get(base_name, {}).pop(condition_id, None)
+
+        cls._store_results(user, all_results)
+
+    @classmethod
+    def _load_results(cls, user):
+        ''' Returns the user's stored pre-filter results. These are kept in
+        Django's cache if it is shared between processes, so that every
+        process sees the changes to the user's carts. Otherwise, they are
+        only kept until the user's current batch ends. '''
+
+        key = cls._results_key(user)
+        if version.shared_cache():
+            return cache.get(key)
+        return BatchController.get_cache(user).get(key)
+
+    @classmethod
+    def _store_results(cls, user, all_results):
+        ''' Stores the user's pre-filter results where ``_load_results``
+        looks for them, or forgets them if ``all_results`` is None. '''
+
+        key = cls._results_key(user)
+        if version.shared_cache():
+            if all_results is None:
+                cache.delete(key)
+            else:
+                cache.set(key, all_results, version.memo_timeout())
+            return
+
+        batch = BatchController.get_cache(user)
+        if all_results is None:
+            batch.pop(key, None)
+        else:
+            batch[key] = all_results
+
+    @classmethod
+    def _results_key(cls, user):
+        return "registrasion-condition-results-%d-%s-%s" % (
+            user.id,
+            version.INVENTORY.current(),
+            version.RELEASED_CARTS.current(),
+        )
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _condition_ids(condition_type):
+        return list(condition_type.objects.values_list("pk", flat=True))
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _static_ids(condition_type):
+        ''' Returns the IDs of the conditions of a CACHE_STATIC type that pass
+        its pre-filter, which does not depend on the user. '''
+
+        ctrl = ConditionController.for_type(condition_type)
+        queryset = ctrl.pre_filter(condition_type.objects.all(), None)
+        return list(queryset.values_list("pk", flat=True))
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _dependencies():
+        ''' Returns the conditions whose pre-filter results for a user may
+        change when the quantity of a product in that user's cart changes.
+
+        Returns:
+            dict[int, set[tuple[str, int]]]: The base model name and ID of
+                each condition, keyed by product ID.
+
+        '''
+
+        controllers = ConditionController._controllers()
+
+        dependencies = defaultdict(set)
+        for condition_type, ctrl in controllers.items():
+            if ctrl.CACHING != ConditionController.CACHE_PER_USER:
+                continue
+            if issubclass(condition_type, conditions.FlagBase):
+                base_name = conditions.FlagBase._meta.model_name
+            else:
+                base_name = conditions.DiscountBase._meta.model_name
+            rows = ctrl.product_dependencies(condition_type.objects.all())
+            for condition_id, product_id in rows:
+                if product_id is not None:
+                    dependencies[product_id].add((base_name, condition_id))
+
+        return dependencies
+
+    @classmethod
+    def product_dependencies(cls, queryset):
+        ''' Returns (condition ID, product ID) pairs for each product whose
+        quantity in a user's carts can change whether the conditions in
+        queryset pass the pre-filter for that user. '''
+
+        return []
+
+    @classmethod
+    def remainders_for_users(cls, base, users):
+        ''' Returns the remainders of every condition of the given base type
+        for each of the given users, using a small number of set-based
+        queries for each condition type.
+
+        Arguments:
+            base (type): ``conditions.FlagBase`` or
+                ``conditions.DiscountBase``.
+
+            users (Queryset[User]): The users for whom we're testing these
+                conditions.
+
+        Returns:
+            dict[int, dict[int, int]]: Each user's remainder for each
+                condition, keyed by condition ID, then by user ID. Users who
+                do not pass the pre-filter for a condition are left out.
+
+        '''
+
+        types = [i for i in cls._controllers() if issubclass(i, base)]
+
+        remainders = {}
+        for condition_type in types:
+            ctrl = cls.for_type(condition_type)
+            remainders.update(
+                ctrl.remainders_many(condition_type.objects.all(), users)
+            )
+
+        return remainders
+
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        ''' Returns which of the conditions in queryset pass the pre-filter
+        for each of the given users. This default implementation calls
+        pre_filter for each user in turn; subclasses should override it with
+        set-based queries.
+
+        Arguments:
+
+            queryset (Queryset[c]): The candidate conditions.
+
+            users (Queryset[User]): The users for whom we're testing these
+                conditions.
+
+        Returns:
+            dict[int, set[int]]: The IDs of the users who pass the pre-filter
+                for each condition, keyed by condition ID.
+
+        '''
+
+        passed = defaultdict(set)
+        for user in users:
+            condition_ids = cls.pre_filter(queryset, user).values_list(
+                "pk", flat=True,
+            )
+            for condition_id in condition_ids:
+                passed[condition_id].add(user.id)
+
+        return passed
+
+    @classmethod
+    def remainders_many(cls, queryset, users):
+        ''' Returns the remainder of each condition in queryset for each of
+        the given users, in the form described in ``remainders_for_users``.
+        This default implementation gives a big remainder to every user that
+        passes the pre-filter. '''
+
+        passed = cls.pre_filter_many(queryset, users)
+        return dict(
+            (condition_id, dict.fromkeys(user_ids, _BIG_QUANTITY))
+            for condition_id, user_ids in passed.items()
+        )
 
     @classmethod
     def pre_filter(cls, queryset, user):
@@ -146,6 +564,8 @@ class RemainderSetByFilter(object):
 
 class CategoryConditionController(IsMetByFilter, ConditionController):
 
+    CACHING = ConditionController.CACHE_PER_USER
+
     @classmethod
     def pre_filter(self, queryset, user):
         ''' Returns all of the items from queryset where the user has a
@@ -155,26 +575,75 @@ class CategoryConditionController(IsMetByFilter, ConditionController):
         in_user_carts = Q(
             enabling_category__product__productitem__cart__user=user
         )
-        released = commerce.Cart.STATUS_RELEASED
-        in_released_carts = Q(
-            enabling_category__product__productitem__cart__status=released
-        )
         queryset = queryset.filter(in_user_carts)
-        queryset = queryset.exclude(in_released_carts)
+        queryset = queryset.exclude(self._in_released_carts())
 
         return queryset
 
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        user_field = "enabling_category__product__productitem__cart__user"
+
+        allowed = set(
+            queryset.exclude(
+                cls._in_released_carts()
+            ).values_list("pk", flat=True)
+        )
+        in_user_carts = queryset.filter(**{user_field + "__in": users})
+        rows = in_user_carts.values_list("pk", user_field).distinct()
+
+        return _group_pairs(i for i in rows if i[0] in allowed)
+
+    @classmethod
+    def product_dependencies(cls, queryset):
+        return queryset.values_list("pk", "enabling_category__product")
+
+    @classmethod
+    def _in_released_carts(cls):
+        released = commerce.Cart.STATUS_RELEASED
+        return Q(
+            enabling_category__product__productitem__cart__status=released
+        )
+
 
 class ProductConditionController(IsMetByFilter, ConditionController):
     ''' Condition tests for ProductFlag and
     IncludedProductDiscount. '''
 
+    CACHING = ConditionController.CACHE_PER_USER
+
     @classmethod
     def pre_filter(self, queryset, user):
         ''' Returns all of the items from queryset where the user has a
         product invoking that item's condition in one of their carts. '''
 
         in_user_carts = Q(enabling_products__productitem__cart__user=user)
+
+        queryset = queryset.filter(in_user_carts)
+        queryset = queryset.exclude(self._only_in_released_carts())
+
+        return queryset
+
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        user_field = "enabling_products__productitem__cart__user"
+
+        allowed = set(
+            queryset.exclude(
+                cls._only_in_released_carts()
+            ).values_list("pk", flat=True)
+        )
+        in_user_carts = queryset.filter(**{user_field + "__in": users})
+        rows = in_user_carts.values_list("pk", user_field).distinct()
+
+        return _group_pairs(i for i in rows if i[0] in allowed)
+
+    @classmethod
+    def product_dependencies(cls, queryset):
+        return queryset.values_list("pk", "enabling_products")
+
+    @classmethod
+    def _only_in_released_carts(cls):
         released = commerce.Cart.STATUS_RELEASED
         paid = commerce.Cart.STATUS_PAID
         active = commerce.Cart.STATUS_ACTIVE
@@ -185,13 +654,7 @@ class ProductConditionController(IsMetByFilter, ConditionController):
             Q(enabling_products__productitem__cart__status=paid) |
             Q(enabling_products__productitem__cart__status=active)
         )
-
-        queryset = queryset.filter(in_user_carts)
-        queryset = queryset.exclude(
-            in_released_carts & not_in_paid_or_active_carts
-        )
-
-        return queryset
+        return in_released_carts & not_in_paid_or_active_carts
 
 
 class TimeOrStockLimitConditionController(
@@ -201,17 +664,21 @@ class TimeOrStockLimitConditionController(
     ''' Common condition tests for TimeOrStockLimit Flag and
     Discount.'''
 
+    CACHING = ConditionController.CACHE_TIME_DEPENDENT
+
+    # The conditions that are in their time window, keyed by condition type.
+    _windows = {}
+
     @classmethod
     def pre_filter(self, queryset, user):
         ''' Returns all of the items from queryset where the date falls into
         any specified range, but not yet where the stock limit is not yet
         reached.'''
 
-        now = timezone.now()
-
-        # Keep items with no start time, or start time not yet met.
-        queryset = queryset.filter(Q(start_time=None) | Q(start_time__lte=now))
-        queryset = queryset.filter(Q(end_time=None) | Q(end_time__gte=now))
+        in_window = self._in_window(queryset.model)
+        if not in_window:
+            return queryset.none()
+        queryset = queryset.filter(pk__in=in_window)
 
         # Filter out items that have been reserved beyond the limits
         quantity_or_zero = self._calculate_quantities(user)
@@ -226,6 +693,139 @@ class TimeOrStockLimitConditionController(
 
         return queryset
 
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        remainders = cls.remainders_many(queryset, users)
+        return dict(
+            (condition_id, set(by_user))
+            for condition_id, by_user in remainders.items()
+        )
+
+    @classmethod
+    def remainders_many(cls, queryset, users):
+        queryset = queryset.filter(pk__in=cls._in_window(queryset.model))
+        limits = dict(queryset.values_list("pk", "limit"))
+
+        user_ids = [user.id for user in users]
+
+        # Each user's own active cart doesn't count against their remainder
+        reserved_carts = commerce.Cart.reserved_carts()
+        active_carts = reserved_carts.filter(
+            user__in=user_ids,
+            status=commerce.Cart.STATUS_ACTIVE,
+        )
+
+        totals = defaultdict(int)
+        reserved = cls._quantities_many(limits, reserved_carts)
+        for (condition_id, _), quantity in reserved.items():
+            totals[condition_id] += quantity
+        active = cls._quantities_many(limits, active_carts)
+
+        remainders = {}
+        for condition_id, limit in limits.items():
+            by_user = {}
+            for user_id in user_ids:
+                if limit is None:
+                    remainder = _BIG_QUANTITY
+                else:
+                    own = active.get((condition_id, user_id), 0)
+                    remainder = limit - (totals[condition_id] - own)
+                if remainder > 0:
+                    by_user[user_id] = remainder
+            if by_user:
+                remainders[condition_id] = by_user
+
+        return remainders
+
+    @classmethod
+    def _in_window(cls, condition_type):
+        ''' Returns the IDs of the conditions of the given type whose start
+        and end times include the current time.
+
+        The set of conditions in their window only changes when a start or
+        end time passes, so it is kept until the next of those times, or
+        until the conditions change, but no longer than the memo timeout.
+
+        '''
+
+        now = timezone.now()
+        token = version.INVENTORY.current()
+        window = cls._windows.get(condition_type)
+
+        if (
+            window is None or
+            window.token != token or
+            now < window.valid_from or
+            now >= window.valid_until
+        ):
+            window = cls._compute_window(condition_type, token, now)
+            cls._windows[condition_type] = window
+
+        return window.condition_ids
+
+    @classmethod
+    def _compute_window(cls, condition_type, token, now):
+        times = condition_type.objects.values_list(
+            "pk", "start_time", "end_time",
+        )
+
+        condition_ids = set()
+        boundaries = []
+
+        for condition_id, start_time, end_time in times:
+            started = start_time is None or start_time <= now
+            ended = end_time is not None and end_time < now
+            if started and not ended:
+                condition_ids.add(condition_id)
+
+            # The condition comes into its window at its start time, and
+            # leaves it just after its end time.
+            if start_time is not None:
+                boundaries.append(start_time)
+            if end_time is not None:
+                boundaries.append(end_time + _ONE_MICROSECOND)
+
+        # Check again after the memo timeout, in case we've missed a change
+        upcoming = [i for i in boundaries if i > now]
+        upcoming.append(
+            now + datetime.timedelta(seconds=version.memo_timeout())
+        )
+
+        return _TimeWindow(
+            token=token,
+            condition_ids=frozenset(condition_ids),
+            valid_from=now,
+            valid_until=min(upcoming),
+        )
+
+    @classmethod
+    def unavailable_to_everyone(cls, condition_type):
+        ''' Returns the IDs of the conditions of the given type that cannot
+        be met by any user: those that are outside of their time window, and
+        those whose stock is all held in reserved carts. '''
+
+        limits = dict(condition_type.objects.values_list("pk", "limit"))
+        in_window = cls._in_window(condition_type)
+
+        limited = [
+            condition_id for condition_id, limit in limits.items()
+            if limit is not None and condition_id in in_window
+        ]
+        reserved = cls._quantities_many(
+            limited, commerce.Cart.reserved_carts(),
+        )
+
+        totals = defaultdict(int)
+        for (condition_id, _), quantity in reserved.items():
+            totals[condition_id] += quantity
+
+        return set(
+            condition_id for condition_id in limits
+            if condition_id not in in_window or
+            condition_id in limited and
+            totals[condition_id] >= limits[condition_id]
+        )
+
     @classmethod
     def _relevant_carts(cls, user):
         reserved_carts = commerce.Cart.reserved_carts()
@@ -274,6 +874,37 @@ class TimeOrStockLimitFlagController(
 
         return quantity_or_zero
 
+    @classmethod
+    def _quantities_many(cls, condition_ids, carts):
+        ''' Returns the quantity of items covered by each of the given
+        conditions in each user's carts, keyed by (condition ID, user ID). '''
+
+        covered = flag_products()
+        conditions_by_product = defaultdict(list)
+        for condition_id in condition_ids:
+            for product_id in covered.get(condition_id, ()):
+                conditions_by_product[product_id].append(condition_id)
+
+        if not conditions_by_product:
+            return {}
+
+        items = commerce.ProductItem.objects.filter(
+            cart__in=carts,
+            product__in=list(conditions_by_product),
+        ).order_by().values(
+            "cart__user", "product",
+        ).annotate(
+            total_quantity=Sum("quantity"),
+        )
+
+        quantities = defaultdict(int)
+        for item in items:
+            for condition_id in conditions_by_product[item["product"]]:
+                key = (condition_id, item["cart__user"])
+                quantities[key] += item["total_quantity"]
+
+        return quantities
+
 
 class TimeOrStockLimitDiscountController(TimeOrStockLimitConditionController):
 
@@ -293,10 +924,31 @@ class TimeOrStockLimitDiscountController(TimeOrStockLimitConditionController):
 
         return quantity_or_zero
 
+    @classmethod
+    def _quantities_many(cls, condition_ids, carts):
+        ''' Returns the quantity of items discounted by each of the given
+        conditions in each user's carts, keyed by (condition ID, user ID). '''
+
+        items = commerce.DiscountItem.objects.filter(
+            cart__in=carts,
+            discount__in=list(condition_ids),
+        ).order_by().values(
+            "cart__user", "discount",
+        ).annotate(
+            total_quantity=Sum("quantity"),
+        )
+
+        return dict(
+            ((item["discount"], item["cart__user"]), item["total_quantity"])
+            for item in items
+        )
+
 
 class VoucherConditionController(IsMetByFilter, ConditionController):
     ''' Condition test for VoucherFlag and VoucherDiscount.'''
 
+    CACHING = ConditionController.CACHE_PER_USER
+
     @classmethod
     def pre_filter(self, queryset, user):
         ''' Returns all of the items from queryset where the user has entered
@@ -304,6 +956,12 @@ class VoucherConditionController(IsMetByFilter, ConditionController):
 
         return queryset.filter(voucher__cart__user=user)
 
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        queryset = queryset.filter(voucher__cart__user__in=users)
+        rows = queryset.values_list("pk", "voucher__cart__user").distinct()
+        return _group_pairs(rows)
+
 
 class SpeakerConditionController(IsMetByFilter, ConditionController):
 
@@ -312,24 +970,112 @@ class SpeakerConditionController(IsMetByFilter, ConditionController):
         ''' Returns all of the items from queryset which are enabled by a user
         being a presenter or copresenter of a non-cancelled proposal. '''
 
-        # Filter out cancelled proposals
-        queryset = queryset.filter(
-            proposal_kind__proposalbase__presentation__cancelled=False
+        speakers = self._speakers()
+        if user.id not in speakers.users:
+            # Most users aren't speakers, so don't bother looking further
+            return queryset.none()
+
+        condition_ids = [
+            condition_id
+            for condition_id, users in self._eligible_users(queryset.model)
+            if user.id in users
+        ]
+
+        return queryset.filter(pk__in=condition_ids)
+
+    @classmethod
+    def pre_filter_many(cls, queryset, users):
+        user_ids = set(user.id for user in users)
+        condition_ids = set(queryset.values_list("pk", flat=True))
+
+        return dict(
+            (condition_id, eligible & user_ids)
+            for condition_id, eligible in cls._eligible_users(queryset.model)
+            if condition_id in condition_ids
+        )
+
+    @classmethod
+    def _eligible_users(cls, condition_type):
+        ''' Yields each condition of the given type, along with the set of
+        IDs of the users who meet it. '''
+
+        speakers = cls._speakers()
+        for condition in cls._speaker_conditions(condition_type):
+            condition_id, is_presenter, is_copresenter, kinds = condition
+            users = set()
+            for kind in kinds:
+                if is_presenter:
+                    users |= speakers.presenters.get(kind, frozenset())
+                if is_copresenter:
+                    users |= speakers.copresenters.get(kind, frozenset())
+            yield condition_id, users
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _speaker_conditions(condition_type):
+        ''' Returns (condition ID, is_presenter, is_copresenter, proposal
+        kind IDs) for each condition of the given type. '''
+
+        rows = condition_type.objects.values_list(
+            "pk", "is_presenter", "is_copresenter", "proposal_kind",
         )
 
-        u = user
-        # User is a presenter
-        user_is_presenter = Q(
-            is_presenter=True,
-            proposal_kind__proposalbase__presentation__speaker__user=u,
+        by_id = {}
+        for condition_id, is_presenter, is_copresenter, kind in rows:
+            if condition_id not in by_id:
+                by_id[condition_id] = (
+                    condition_id, is_presenter, is_copresenter, set(),
+                )
+            if kind is not None:
+                by_id[condition_id][3].add(kind)
+
+        return list(by_id.values())
+
+    @staticmethod
+    @version.SPEAKERS.memoise
+    def _speakers():
+        ''' Returns the IDs of the presenters and copresenters of each
+        proposal kind, only counting presentations that are not cancelled.
+        This is rebuilt when the presentations or speakers change. '''
+
+        presentations = schedule_models.Presentation.objects.filter(
+            cancelled=False,
         )
-        # User is a copresenter
-        user_is_copresenter = Q(
-            is_copresenter=True,
-            proposal_kind__proposalbase__presentation__additional_speakers__user=u,  # NOQA
+
+        presenters = _group_pairs(presentations.values_list(
+            "proposal_base__kind", "speaker__user",
+        ))
+        copresenters = _group_pairs(presentations.values_list(
+            "proposal_base__kind", "additional_speakers__user",
+        ))
+
+        def frozen(by_kind):
+            return dict(
+                (kind, frozenset(i for i in users if i is not None))
+                for kind, users in by_kind.items()
+            )
+
+        presenters = frozen(presenters)
+        copresenters = frozen(copresenters)
+        users = frozenset(itertools.chain(
+            *itertools.chain(presenters.values(), copresenters.values())
+        ))
+
+        return _SpeakerIndex(
+            presenters=presenters,
+            copresenters=copresenters,
+            users=users,
         )
 
-        return queryset.filter(user_is_presenter | user_is_copresenter)
+
+_SpeakerIndex = namedtuple(
+    "_SpeakerIndex",
+    (
+        "presenters",
+        "copresenters",
+        "users",
+    ),
+)
 
 
 class GroupMemberConditionController(IsMetByFilter, ConditionController):
@@ -339,4 +1085,82 @@ class GroupMemberConditionController(IsMetByFilter, ConditionController):
         ''' Returns all of the items from conditions which are enabled by a
         user being member of a Django Auth Group. '''
 
-        return conditions.filter(group__in=user.groups.all())
+        by_group = self._conditions_by_group(conditions.model)
+
+        condition_ids = set()
+        for group_id in self._user_groups(user):
+            condition_ids |= by_group.get(group_id, set())
+
+        if not condition_ids:
+            return conditions.none()
+
+        return conditions.filter(pk__in=condition_ids)
+
+    @classmethod
+    def pre_filter_many(cls, conditions, users):
+        memberships = User.groups.through.objects.filter(user__in=users)
+        users_by_group = _group_pairs(
+            memberships.values_list("group", "user")
+        )
+
+        by_group = cls._conditions_by_group(conditions.model)
+        condition_ids = set(conditions.values_list("pk", flat=True))
+
+        passed = defaultdict(set)
+        for group_id, user_ids in users_by_group.items():
+            for condition_id in by_group.get(group_id, ()):
+                if condition_id in condition_ids:
+                    passed[condition_id] |= user_ids
+
+        return passed
+
+    @staticmethod
+    def _user_groups(user):
+        ''' Returns the IDs of the groups that the user is a member of. If the
+        cache is shared, these are cached until any group membership
+        changes. '''
+
+        if not version.shared_cache():
+            return frozenset(user.groups.values_list("id", flat=True))
+
+        key = "registrasion-user-groups-%d-%s" % (
+            user.id, version.GROUPS.current(),
+        )
+        groups = cache.get(key)
+        if groups is None:
+            groups = frozenset(user.groups.values_list("id", flat=True))
+            cache.set(key, groups, version.memo_timeout())
+        return groups
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _conditions_by_group(condition_type):
+        ''' Returns the IDs of the conditions of the given type that each
+        group meets, keyed by group ID. '''
+
+        return _group_pairs(condition_type.objects.values_list("group", "pk"))
+
+
+def register_controllers():
+    ''' Registers the controllers for the built-in condition types. This is
+    called when the registrasion app is ready. '''
+
+    builtins = (
+        (conditions.CategoryFlag, CategoryConditionController),
+        (conditions.GroupMemberDiscount, GroupMemberConditionController),
+        (conditions.GroupMemberFlag, GroupMemberConditionController),
+        (conditions.IncludedProductDiscount, ProductConditionController),
+        (conditions.ProductFlag, ProductConditionController),
+        (conditions.SpeakerFlag, SpeakerConditionController),
+        (conditions.SpeakerDiscount, SpeakerConditionController),
+        (
+            conditions.TimeOrStockLimitDiscount,
+            TimeOrStockLimitDiscountController,
+        ),
+        (conditions.TimeOrStockLimitFlag, TimeOrStockLimitFlagController),
+        (conditions.VoucherDiscount, VoucherConditionController),
+        (conditions.VoucherFlag, VoucherConditionController),
+    )
+
+    for condition_type, controller in builtins:
+        ConditionController.register(condition_type, controller)
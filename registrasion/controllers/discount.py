@@ -1,3 +1,4 @@
+import collections
 import itertools
 
 from .batch import BatchController
@@ -6,11 +7,10 @@ from .conditions import ConditionController
 from registrasion.models import commerce
 from registrasion.models import conditions
 
-from django.db.models import Case
-from django.db.models import F, Q
+from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Sum
-from django.db.models import Value
-from django.db.models import When
+from django.db.models.signals import post_save
 
 
 class DiscountAndQuantity(object):
@@ -111,11 +111,6 @@ class DiscountController(object):
 
         '''
 
-        types = list(ConditionController._controllers())
-        discounttypes = [
-            i for i in types if issubclass(i, conditions.DiscountBase)
-        ]
-
         product_clauses = conditions.DiscountForProduct.objects.all()
         product_clauses = product_clauses.select_related(
             "discount",
@@ -128,15 +123,9 @@ class DiscountController(object):
             "discount",
         )
 
-        all_subsets = []
-
-        for discounttype in discounttypes:
-            discounts = discounttype.objects.all()
-            ctrl = ConditionController.for_type(discounttype)
-            discounts = ctrl.pre_filter(discounts, user)
-            all_subsets.append(discounts)
-
-        filtered_discounts = list(itertools.chain(*all_subsets))
+        filtered_discounts = ConditionController.filtered_conditions(
+            conditions.DiscountBase, user,
+        )
 
         # Map from discount key to itself
         # (contains annotations needed in the future)
@@ -147,51 +136,87 @@ class DiscountController(object):
             category_clauses.filter(discount__in=filtered_discounts),
         )
 
-        clause_sets = (
-            cls._annotate_with_past_uses(i, user) for i in clause_sets
-        )
-
         # The set of all potential discount clauses
         discount_clauses = set(itertools.chain(*clause_sets))
 
+        past_uses = cls._past_uses(user)
+
         # Replace discounts with the filtered ones
         # These are the correct subclasses (saves query later on), and have
         # correct annotations from filters if necessary.
         for clause in discount_clauses:
             clause.discount = from_filter[clause.discount.id]
 
+            if isinstance(clause, conditions.DiscountForProduct):
+                key = (clause.discount.id, "product", clause.product_id)
+            else:
+                key = (clause.discount.id, "category", clause.category_id)
+            clause.past_use_count = past_uses.get(key, 0)
+
         return discount_clauses
 
     @classmethod
-    def _annotate_with_past_uses(cls, queryset, user):
-        ''' Annotates the queryset with a usage count for that discount claus
-        by the given user. '''
+    def _past_uses(cls, user):
+        ''' Returns the quantity of items that the user has bought with each
+        discount, keyed by (discount ID, "product", product ID) and
+        (discount ID, "category", category ID). '''
+
+        usages = commerce.DiscountUsage.objects.filter(
+            user=user,
+        ).values_list(
+            "discount", "product", "product__category", "quantity",
+        )
 
-        if queryset.model == conditions.DiscountForCategory:
-            matches = (
-                Q(category=F('discount__discountitem__product__category'))
-            )
-        elif queryset.model == conditions.DiscountForProduct:
-            matches = (
-                Q(product=F('discount__discountitem__product'))
-            )
+        past_uses = collections.defaultdict(int)
+        for discount, product, category, quantity in usages:
+            past_uses[(discount, "product", product)] += quantity
+            past_uses[(discount, "category", category)] += quantity
 
-        in_carts = (
-            Q(discount__discountitem__cart__user=user) &
-            Q(discount__discountitem__cart__status=commerce.Cart.STATUS_PAID)
-        )
+        return past_uses
 
-        past_use_quantity = When(
-            in_carts & matches,
-            then="discount__discountitem__quantity",
+    @classmethod
+    @transaction.atomic
+    def update_usage(cls, user):
+        ''' Recounts the user's discount usage from the discount items in
+        their paid carts. This needs to be called whenever one of the user's
+        carts is paid or released. '''
+
+        # Serialise updates for this user
+        User.objects.select_for_update().get(pk=user.pk)
+
+        items = commerce.DiscountItem.objects.filter(
+            cart__user=user,
+            cart__status=commerce.Cart.STATUS_PAID,
+        ).order_by().values(
+            "discount", "product",
+        ).annotate(
+            total_quantity=Sum("quantity"),
         )
 
-        past_use_quantity_or_zero = Case(
-            past_use_quantity,
-            default=Value(0),
+        commerce.DiscountUsage.objects.filter(user=user).delete()
+        commerce.DiscountUsage.objects.bulk_create(
+            commerce.DiscountUsage(
+                user=user,
+                discount_id=item["discount"],
+                product_id=item["product"],
+                quantity=item["total_quantity"],
+            )
+            for item in items
         )
 
-        queryset = queryset.annotate(
-            past_use_count=Sum(past_use_quantity_or_zero)
-        )
-        return queryset
+
+def _cart_saved(sender, instance, **kwargs):
+    if instance.status != commerce.Cart.STATUS_ACTIVE:
+        DiscountController.update_usage(instance.user)
+
+
+def connect_signals():
+    ''' Keeps the discount usage up to date whenever a cart is paid or
+    released, however that happens. This is called when the registrasion app
+    is ready. '''
+
+    post_save.connect(
+        _cart_saved,
+        sender=commerce.Cart,
+        dispatch_uid="registrasion-discount-usage",
+    )
@@ -0,0 +1,211 @@
+from collections import defaultdict
+from django.db.models import Sum
+
+from registrasion.models import commerce
+from registrasion.models import conditions
+from registrasion.models import inventory
+
+from .conditions import ConditionController
+from .discount import DiscountAndQuantity
+from .flag import FlagTable
+
+
+class EligibilityController(object):
+    ''' Works out which products are available to, and which discounts apply
+    to, many users at once.
+
+    This gives the same answers as calling
+    ``ProductController.available_products`` and
+    ``DiscountController.available_discounts`` for each user, but uses a
+    handful of set-based queries for all of the users, rather than a handful
+    of queries for each user.
+
+    '''
+
+    def __init__(self, users):
+        '''
+
+        Arguments:
+            users (Queryset[User]): The users we're interested in.
+
+        '''
+
+        self.users = users
+
+    def _user_ids(self):
+        return [user.id for user in self.users]
+
+    def _paid_quantities(self):
+        ''' Returns the quantity of each product and each category in each
+        user's paid carts, keyed by user ID, then by ("product", product ID)
+        and ("category", category ID). '''
+
+        items = commerce.ProductItem.objects.filter(
+            cart__user__in=self.users,
+            cart__status=commerce.Cart.STATUS_PAID,
+        ).order_by().values(
+            "cart__user", "product", "product__category",
+        ).annotate(
+            total_quantity=Sum("quantity"),
+        )
+
+        quantities = defaultdict(lambda: defaultdict(int))
+        for item in items:
+            user_quantities = quantities[item["cart__user"]]
+            quantity = item["total_quantity"]
+            category = item["product__category"]
+            user_quantities[("product", item["product"])] += quantity
+            user_quantities[("category", category)] += quantity
+
+        return quantities
+
+    def available_products(self, products):
+        ''' Returns the products that are available to each user.
+
+        Arguments:
+            products (Iterable[inventory.Product]): The products to test.
+
+        Returns:
+            dict[int, list[inventory.Product]]: The available products,
+                ordered by ``order``, keyed by user ID.
+
+        '''
+
+        products = sorted(set(products), key=lambda product: product.order)
+        categories = dict(
+            (category.id, category)
+            for category in inventory.Category.objects.filter(
+                product__in=products,
+            ).distinct()
+        )
+
+        paid = self._paid_quantities()
+        remainders = ConditionController.remainders_for_users(
+            conditions.FlagBase, self.users,
+        )
+        table = FlagTable.get()
+
+        def flag_met(condition_id, user_id):
+            # Without quantities, a condition is met if it can accept an item
+            return remainders.get(condition_id, {}).get(user_id, 0) >= 1
+
+        available = {}
+
+        for user_id in self._user_ids():
+            user_paid = paid.get(user_id, {})
+
+            user_available = []
+            for product in products:
+                category = categories[product.category_id]
+                limits = (
+                    (product.limit_per_user, ("product", product.id)),
+                    (category.limit_per_user, ("category", category.id)),
+                )
+                if any(
+                    limit is not None and limit - user_paid.get(key, 0) <= 0
+                    for limit, key in limits
+                ):
+                    continue
+
+                dif = table.dif.get(product.id, ())
+                eit = table.eit.get(product.id, ())
+                if not all(flag_met(i, user_id) for i in dif):
+                    continue
+                if eit and not any(flag_met(i, user_id) for i in eit):
+                    continue
+
+                user_available.append(product)
+
+            available[user_id] = user_available
+
+        return available
+
+    def available_discounts(self, categories, products):
+        ''' Returns the discounts available to each user for the given
+        categories and products.
+
+        Returns:
+            dict[int, list[DiscountAndQuantity]]: The available discounts,
+                keyed by user ID.
+
+        '''
+
+        products = set(products)
+        all_categories = set(categories)
+        all_categories |= set(product.category for product in products)
+
+        remainders = ConditionController.remainders_for_users(
+            conditions.DiscountBase, self.users,
+        )
+
+        product_clauses = conditions.DiscountForProduct.objects.filter(
+            discount__in=list(remainders),
+            product__in=products,
+        ).select_related("product", "product__category")
+        category_clauses = conditions.DiscountForCategory.objects.filter(
+            discount__in=list(remainders),
+            category__in=all_categories,
+        ).select_related("category")
+        clauses = list(product_clauses) + list(category_clauses)
+
+        discounts = dict(
+            (discount.id, discount)
+            for discount in conditions.DiscountBase.objects.filter(
+                id__in=set(clause.discount_id for clause in clauses),
+            ).select_subclasses()
+        )
+
+        past_uses = self._past_discount_uses(discounts)
+
+        available = {}
+
+        for user_id in self._user_ids():
+            user_uses = past_uses.get(user_id, {})
+            user_available = []
+
+            for clause in clauses:
+                if user_id not in remainders[clause.discount_id]:
+                    continue
+
+                if isinstance(clause, conditions.DiscountForProduct):
+                    past_use_count = user_uses.get(
+                        (clause.discount_id, "product", clause.product_id), 0,
+                    )
+                else:
+                    past_use_count = user_uses.get(
+                        (clause.discount_id, "category", clause.category_id),
+                        0,
+                    )
+
+                if past_use_count >= clause.quantity:
+                    continue
+
+                user_available.append(DiscountAndQuantity(
+                    discount=discounts[clause.discount_id],
+                    clause=clause,
+                    quantity=clause.quantity - past_use_count,
+                ))
+
+            available[user_id] = user_available
+
+        return available
+
+    def _past_discount_uses(self, discount_ids):
+        ''' Returns the quantity of each discount that each user has used in
+        paid carts, keyed by user ID, then by (discount ID, "product",
+        product ID) and (discount ID, "category", category ID). '''
+
+        usages = commerce.DiscountUsage.objects.filter(
+            user__in=self.users,
+            discount__in=list(discount_ids),
+        ).values_list(
+            "user", "discount", "product", "product__category", "quantity",
+        )
+
+        uses = defaultdict(lambda: defaultdict(int))
+        for user, discount, product, category, quantity in usages:
+            user_uses = uses[user]
+            user_uses[(discount, "product", product)] += quantity
+            user_uses[(discount, "category", category)] += quantity
+
+        return uses
@@ -2,14 +2,13 @@ import itertools
 
 from collections import defaultdict
 from collections import namedtuple
-from django.db.models import Count
-from django.db.models import Q
 
+from . import version
 from .batch import BatchController
 from .conditions import ConditionController
+from .conditions import flag_products
 
 from registrasion.models import conditions
-from registrasion.models import inventory
 
 
 class FlagController(object):
@@ -39,124 +38,80 @@ class FlagController(object):
             products = set(products)
             quantities = {}
 
-        if products:
-            # Simplify the query.
-            all_conditions = cls._filtered_flags(user)
-        else:
-            all_conditions = []
-
-        all_conditions = conditions.FlagBase.objects.filter(
-            id__in=set(i.id for i in all_conditions)
-        ).select_subclasses()
+        table = FlagTable.get()
+        products_by_id = dict((product.id, product) for product in products)
 
-        # Prefetch all of the products and categories (Saves a LOT of queries)
-        all_conditions = all_conditions.prefetch_related(
-            "products", "categories", "products__category",
-        )
-
-        # Now pre-select all of the products attached to those categories
-        all_categories = set(
-            cat for condition in all_conditions
-                for cat in condition.categories.all()
+        # Only the conditions that cover the products we're testing matter.
+        relevant = set(
+            condition_id
+            for product_id in products_by_id
+            for condition_id in itertools.chain(
+                table.dif.get(product_id, ()),
+                table.eit.get(product_id, ()),
+            )
         )
-        all_category_ids = (i.id for i in all_categories)
-        all_category_products = inventory.Product.objects.filter(
-            category__in=all_category_ids
-        ).select_related("category")
 
-        products_by_category_ = itertools.groupby(all_category_products, lambda prod: prod.category)
-        products_by_category = dict((k.id, list(v)) for (k, v) in products_by_category_)
-
-        # All disable-if-false conditions on a product need to be met
-        do_not_disable = defaultdict(lambda: True)
-        # At least one enable-if-true condition on a product must be met
-        do_enable = defaultdict(lambda: False)
-        # (if either sort of condition is present)
-
-        # Count the number of conditions for a product
-        dif_count = defaultdict(int)
-        eit_count = defaultdict(int)
+        if relevant:
+            filtered = [
+                condition for condition in cls._filtered_flags(user)
+                if condition.id in relevant
+            ]
+        else:
+            filtered = []
 
+        # Evaluate each of the conditions that apply to this user. Conditions
+        # that don't apply to this user are never met.
+        met = {}
         messages = {}
 
-        for condition in all_conditions:
+        for condition in filtered:
             cond = ConditionController.for_condition(condition)
             remainder = cond.user_quantity_remaining(user, filtered=True)
 
-            # Get all products covered by this condition, and the products
-            # from the categories covered by this condition
-
-            condition_products = condition.products.all()
-            category_products = (
-                product for cat in condition.categories.all() for product in products_by_category[cat.id]
-            )
-
-            all_products = itertools.chain(
-                condition_products, category_products
-            )
-            all_products = set(all_products)
-
-            # Filter out the products from this condition that
-            # are not part of this query.
-            all_products = set(i for i in all_products if i in products)
+            # The products from this condition that are part of this query
+            affected = [
+                products_by_id[product_id]
+                for product_id in table.products[condition.id]
+                if product_id in products_by_id
+            ]
 
             if quantities:
-                consumed = sum(quantities[i] for i in all_products)
+                consumed = sum(quantities[i] for i in affected)
             else:
                 consumed = 1
-            met = consumed <= remainder
-
-            if not met:
-                message = cls._error_message(all_products, remainder)
+            met[condition.id] = consumed <= remainder
 
-            for product in all_products:
-                if condition.is_disable_if_false:
-                    do_not_disable[product] &= met
-                    dif_count[product] += 1
-                else:
-                    do_enable[product] |= met
-                    eit_count[product] += 1
+            if not met[condition.id]:
+                message = cls._error_message(affected, remainder)
+                for product in affected:
+                    messages.setdefault(product, message)
 
-                if not met and product not in messages:
-                    messages[product] = message
-
-        total_flags = FlagCounter.count(user)
-
-        valid = {}
-
-        # the problem is that now, not every condition falls into
-        # do_not_disable or do_enable '''
-        # You should look into this, chris :)
+        error_fields = []
 
         for product in products:
-            if quantities:
-                if quantities[product] == 0:
-                    continue
-
-            f = total_flags.get(product)
-            if f.dif > 0 and f.dif != dif_count[product]:
-                do_not_disable[product] = False
-                if product not in messages:
-                    messages[product] = cls._error_message([product], 0)
-            if f.eit > 0 and product not in do_enable:
-                do_enable[product] = False
-                if product not in messages:
-                    messages[product] = cls._error_message([product], 0)
-
-        for product in itertools.chain(do_not_disable, do_enable):
-            f = total_flags.get(product)
-            if product in do_enable:
-                # If there's an enable-if-true, we need need of those met too.
-                # (do_not_disable will default to true otherwise)
-                valid[product] = do_not_disable[product] and do_enable[product]
-            elif product in do_not_disable:
-                # If there's a disable-if-false condition, all must be met
-                valid[product] = do_not_disable[product]
-
-        error_fields = [
-            (product, messages[product])
-            for product in valid if not valid[product]
-        ]
+            dif = table.dif.get(product.id, ())
+            eit = table.eit.get(product.id, ())
+
+            if quantities and quantities[product] == 0:
+                # Products that are being removed are only tested against
+                # the conditions that apply to this user.
+                dif = [i for i in dif if i in met]
+                eit = [i for i in eit if i in met]
+
+            if not dif and not eit:
+                continue
+
+            # All disable-if-false conditions on a product need to be met,
+            # and at least one enable-if-true condition, if there are any.
+            valid = all(met.get(i, False) for i in dif)
+            if eit:
+                valid = valid and any(met.get(i, False) for i in eit)
+
+            if not valid:
+                message = messages.get(product)
+                if message is None:
+                    message = cls._error_message([product], 0)
+                error_fields.append((product, message))
 
         return error_fields
 
@@ -197,18 +152,9 @@ class FlagController(object):
 
         '''
 
-        types = list(ConditionController._controllers())
-        flagtypes = [i for i in types if issubclass(i, conditions.FlagBase)]
-
-        all_subsets = []
-
-        for flagtype in flagtypes:
-            flags = flagtype.objects.all()
-            ctrl = ConditionController.for_type(flagtype)
-            flags = ctrl.pre_filter(flags, user)
-            all_subsets.append(flags)
-
-        return list(itertools.chain(*all_subsets))
+        return ConditionController.filtered_conditions(
+            conditions.FlagBase, user,
+        )
 
 
 ConditionAndRemainder = namedtuple(
@@ -220,63 +166,61 @@ ConditionAndRemainder = namedtuple(
 )
 
 
-_FlagCounter = namedtuple(
-    "_FlagCounter",
+_FlagTable = namedtuple(
+    "_FlagTable",
     (
+        "dif",
+        "eit",
         "products",
-        "categories",
     ),
 )
 
 
-_ConditionsCount = namedtuple(
-    "ConditionsCount",
-    (
-        "dif",
-        "eit",
-    ),
-)
+class FlagTable(_FlagTable):
+    ''' The flag configuration, compiled into a table indexed by product.
 
+    Attributes:
+        dif (dict[int, tuple[int, ...]]): The IDs of the disable-if-false
+            conditions that cover each product, keyed by product ID.
 
-class FlagCounter(_FlagCounter):
+        eit (dict[int, tuple[int, ...]]): The IDs of the enable-if-true
+            conditions that cover each product, keyed by product ID.
 
-    @classmethod
-    @BatchController.memoise
-    def count(cls, user):
-        # Get the count of how many conditions should exist per product
-        flagbases = conditions.FlagBase.objects
+        products (dict[int, tuple[int, ...]]): The IDs of the products
+            covered by each condition, directly or through their categories,
+            keyed by condition ID.
+
+    '''
 
-        types = (
-            conditions.FlagBase.ENABLE_IF_TRUE,
-            conditions.FlagBase.DISABLE_IF_FALSE,
+    @classmethod
+    @version.INVENTORY.memoise
+    def get(cls):
+        ''' Returns the table for the current flag configuration. The table
+        is rebuilt when the inventory or any condition changes, and at least
+        every ``CONFIGURATION_MEMO_TIMEOUT`` seconds, in case this process
+        has missed a change made by another process. '''
+
+        condition_types = dict(
+            conditions.FlagBase.objects.values_list("id", "condition")
+        )
+        covered = flag_products()
+
+        dif = defaultdict(list)
+        eit = defaultdict(list)
+        for flag_id, product_ids in covered.items():
+            # The coverage is memoised separately, so may be a little older
+            condition = condition_types.get(flag_id)
+            if condition is None:
+                continue
+            elif condition == conditions.FlagBase.DISABLE_IF_FALSE:
+                by_product = dif
+            else:
+                by_product = eit
+            for product_id in product_ids:
+                by_product[product_id].append(flag_id)
+
+        return cls(
+            dif=dict((k, tuple(sorted(v))) for k, v in dif.items()),
+            eit=dict((k, tuple(sorted(v))) for k, v in eit.items()),
+            products=covered,
         )
-        keys = ("eit", "dif")
-        flags = [
-            flagbases.filter(
-                condition=condition_type
-            ).values(
-                'products', 'categories'
-            ).annotate(
-                count=Count('id')
-            )
-            for condition_type in types
-        ]
-
-        cats = defaultdict(lambda: defaultdict(int))
-        prod = defaultdict(lambda: defaultdict(int))
-
-        for key, flagcounts in zip(keys, flags):
-            for row in flagcounts:
-                if row["products"] is not None:
-                    prod[row["products"]][key] = row["count"]
-                if row["categories"] is not None:
-                    cats[row["categories"]][key] = row["count"]
-
-        return cls(products=prod, categories=cats)
-
-    def get(self, product):
-        p = self.products[product.id]
-        c = self.categories[product.category.id]
-        eit = p["eit"] + c["eit"]
-        dif = p["dif"] + c["dif"]
-        return _ConditionsCount(dif=dif, eit=eit)
@@ -13,6 +13,7 @@ from registrasion.models import people
 from .cart import CartController
 from .credit_note import CreditNoteController
 from .for_id import ForId
+from .voucher import VoucherController
 
 
 class InvoiceController(ForId, object):
@@ -358,6 +359,10 @@ class InvoiceController(ForId, object):
             cart.status = commerce.Cart.STATUS_RELEASED
             cart.save()
 
+            # The vouchers in this cart are now available to other carts
+            for voucher in cart.vouchers.all():
+                VoucherController(voucher).release()
+
     def update_validity(self):
         ''' Voids this invoice if the attached cart is no longer valid because
         the cart revision has changed, or the reservations have expired. '''
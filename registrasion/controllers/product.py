@@ -7,11 +7,15 @@ from django.db.models import When
 from django.db.models import Value
 
 from registrasion.models import commerce
+from registrasion.models import conditions
 from registrasion.models import inventory
 
+from . import version
+
 from .batch import BatchController
 from .category import CategoryController
 from .flag import FlagController
+from .flag import FlagTable
 
 
 class ProductController(object):
@@ -55,6 +59,53 @@ class ProductController(object):
 
         return out
 
+    @classmethod
+    def stock_remaining(cls, user, products):
+        ''' Returns how many of each product can still be reserved by this
+        user under the stock limits that cover it, not counting what is in
+        the user's own cart.
+
+        Returns:
+            dict[int, Optional[int]]: The remaining stock, keyed by product
+                ID. Products without stock limits map to None.
+
+        '''
+
+        table = FlagTable.get()
+        limited = cls._stock_limited_flags()
+        remainders = dict(
+            (condition.id, condition.remainder)
+            for condition in FlagController._filtered_flags(user)
+            if condition.id in limited
+        )
+
+        remaining = {}
+        for product in products:
+            flag_ids = [
+                i for i in itertools.chain(
+                    table.dif.get(product.id, ()),
+                    table.eit.get(product.id, ()),
+                )
+                if i in limited
+            ]
+            if flag_ids:
+                remaining[product.id] = min(
+                    remainders.get(i, 0) for i in flag_ids
+                )
+            else:
+                remaining[product.id] = None
+
+        return remaining
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _stock_limited_flags():
+        return frozenset(
+            conditions.TimeOrStockLimitFlag.objects.filter(
+                limit__isnull=False,
+            ).values_list("pk", flat=True)
+        )
+
     @classmethod
     @BatchController.memoise
     def user_remainders(cls, user):
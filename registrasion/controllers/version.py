@@ -0,0 +1,262 @@
+import functools
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from .batch import BatchController
+
+
+# The default for the CONFIGURATION_MEMO_TIMEOUT setting.
+DEFAULT_MEMO_TIMEOUT = 60
+
+
+def memo_timeout():
+    ''' Returns the longest time, in seconds, that results worked out from
+    the configuration may be kept for, even if no change to the configuration
+    has been seen. Set this with the ``CONFIGURATION_MEMO_TIMEOUT`` setting.
+    '''
+
+    return getattr(
+        settings, "CONFIGURATION_MEMO_TIMEOUT", DEFAULT_MEMO_TIMEOUT,
+    )
+
+
+# Cache backends whose contents are only seen by the process that set them
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+)
+
+
+def shared_cache():
+    ''' Returns True if Django's default cache is shared by every process
+    serving the site, so that results kept in it, or memoised against the
+    versions kept in it, see every process's changes. This is worked out
+    from the cache backend, unless the ``CACHE_SHARED_BETWEEN_PROCESSES``
+    setting is set (say, to True, if you serve your site from a single
+    process). '''
+
+    shared = getattr(settings, "CACHE_SHARED_BETWEEN_PROCESSES", None)
+    if shared is None:
+        backend = settings.CACHES.get("default", {}).get("BACKEND")
+        shared = backend not in PROCESS_LOCAL_CACHES
+    return shared
+
+
+class ConfigurationVersion(object):
+    ''' An opaque token that changes whenever any of a set of watched models
+    is saved, deleted, or has its many-to-many relations changed.
+
+    Results that depend only on the watched models can be memoised for as
+    long as the token stays the same, with ``memoise``.
+
+    The token is kept in Django's cache framework, so that every process
+    serving your site sees the changes made by the others. If the cache isn't
+    shared between processes (see ``shared_cache``), memoised results are
+    only kept until the current batch ends. Memoised results are also only
+    kept for ``memo_timeout()`` seconds, in case a change is missed.
+
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.cache_key = "registrasion-version-" + name
+        self._memos = {}
+        self._memos_token = None
+
+    def current(self):
+        ''' Returns the current token for this version. '''
+
+        token = cache.get(self.cache_key)
+        if token is None:
+            token = self.increment()
+        return token
+
+    def increment(self):
+        ''' Changes the token for this version, invalidating anything that
+        was memoised against the old one. '''
+
+        token = uuid.uuid4().hex
+        cache.set(self.cache_key, token, None)
+        return token
+
+    def memoise(self, func):
+        ''' Decorator that stores the result of the wrapped function until the
+        token changes. Keyword arguments are not supported.
+
+        Arguments:
+            func (callable(*a)): The function whose results we want to store.
+                The positional arguments, ``a``, are used as cache keys, and
+                must be hashable.
+
+        Returns:
+            callable(*a): The memoising version of ``func``.
+
+        '''
+
+        @functools.wraps(func)
+        def f(*a):
+            token = self.current()
+            key = (func, a)
+
+            if not shared_cache():
+                # Other processes' changes can't be seen, so the result is
+                # only kept for as long as the current batch
+                memos = BatchController.thread_cache()
+                if memos is None:
+                    return func(*a)
+                key = (self.cache_key, token) + key
+                if key not in memos:
+                    memos[key] = func(*a)
+                return memos[key]
+
+            if token != self._memos_token:
+                # Everything memoised against the old token is stale
+                self._memos = {}
+                self._memos_token = token
+
+            now = time.time()
+            memo = self._memos.get(key)
+
+            if memo is None or memo[0] != token or memo[1] <= now:
+                memo = (token, now + memo_timeout(), func(*a))
+                self._memos[key] = memo
+
+            return memo[2]
+
+        return f
+
+    def watch(self, *models):
+        ''' Changes the token whenever any of the given models changes. '''
+
+        for model in models:
+            uid = "%s-%s" % (self.cache_key, model._meta.label)
+            post_save.connect(
+                self._changed, sender=model, weak=False, dispatch_uid=uid,
+            )
+            post_delete.connect(
+                self._changed, sender=model, weak=False, dispatch_uid=uid,
+            )
+            for field in model._meta.many_to_many:
+                through = field.remote_field.through
+                m2m_changed.connect(
+                    self._changed,
+                    sender=through,
+                    weak=False,
+                    dispatch_uid="%s-%s" % (uid, field.name),
+                )
+
+    def _changed(self, sender, **kwargs):
+        action = kwargs.get("action", "post_")
+        if not action.startswith("post_"):
+            return
+
+        # Change the token straight away, and again once the change has been
+        # committed, so that nothing memoises the uncommitted state.
+        self.increment()
+        transaction.on_commit(self.increment)
+
+
+''' Changes whenever the inventory (categories, products, vouchers), or any
+flag or discount changes. '''
+INVENTORY = ConfigurationVersion("inventory")
+
+''' Changes whenever a cart is released. Releasing a cart can change whether
+product and category conditions are met for any user. '''
+RELEASED_CARTS = ConfigurationVersion("released-carts")
+
+''' Changes whenever a presentation, speaker or proposal changes, which can
+change who is eligible for speaker conditions. '''
+SPEAKERS = ConfigurationVersion("speakers")
+
+''' Changes whenever a group, or any user's group membership, changes. '''
+GROUPS = ConfigurationVersion("groups")
+
+
+''' Changes whenever any cart changes, or the inventory changes, either of
+which can change which products are available, and how many remain. '''
+AVAILABILITY = ConfigurationVersion("availability")
+
+
+def category_items(category_id):
+    ''' Returns the version that changes whenever the items from the given
+    category held in any cart change, or a cart holding them is paid or
+    released. Reservations that lapse are only noticed at the next change.
+
+    Arguments:
+        category_id (int): The ID of the category.
+
+    Returns:
+        ConfigurationVersion: The version for that category. Only use its
+            token, because its memos aren't shared with other calls.
+
+    '''
+
+    return ConfigurationVersion("category-items-%d" % category_id)
+
+
+def category_items_changed(category_ids):
+    ''' Changes the ``category_items`` version of each of the given
+    categories. '''
+
+    for category_id in set(category_ids):
+        category_items(category_id)._changed(None)
+
+
+def _cart_saved(sender, instance, **kwargs):
+    if instance.status == instance.STATUS_RELEASED:
+        RELEASED_CARTS._changed(sender)
+
+    # Active carts call category_items_changed as their items change
+    if instance.status != instance.STATUS_ACTIVE:
+        category_items_changed(
+            instance.productitem_set.values_list(
+                "product__category", flat=True,
+            ).distinct()
+        )
+
+
+def connect_signals():
+    ''' Connects the signal handlers that keep the versions up to date. This
+    is called when the registrasion app is ready. '''
+
+    inventory_modules = (
+        "registrasion.models.conditions",
+        "registrasion.models.inventory",
+    )
+
+    app = apps.get_app_config("registrasion")
+    inventory_models = [
+        model for model in app.get_models()
+        if model.__module__ in inventory_modules
+    ]
+    INVENTORY.watch(*inventory_models)
+    AVAILABILITY.watch(app.get_model("Cart"), *inventory_models)
+
+    from symposion.proposals.models import ProposalBase
+    from symposion.schedule.models import Presentation
+    from symposion.speakers.models import Speaker
+
+    SPEAKERS.watch(Presentation, ProposalBase, Speaker)
+
+    GROUPS.watch(Group)
+    m2m_changed.connect(
+        GROUPS._changed,
+        sender=User.groups.through,
+        weak=False,
+        dispatch_uid=GROUPS.cache_key + "-user-groups",
+    )
+
+    post_save.connect(
+        _cart_saved,
+        sender=app.get_model("Cart"),
+        dispatch_uid=RELEASED_CARTS.cache_key,
+    )
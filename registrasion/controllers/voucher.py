@@ -0,0 +1,536 @@
+import csv
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Length
+
+from registrasion import util
+from registrasion.controllers import version
+from registrasion.models import commerce
+from registrasion.models import conditions
+from registrasion.models import inventory
+
+
+class VoucherController(object):
+    ''' Tests and records the claims that carts make on a voucher.
+
+    Each voucher has a ``VoucherCounter``, which holds an upper bound on the
+    number of reserved carts that hold the voucher. While that bound is below
+    the voucher's limit, a claim can be accepted by reading a single row.
+    Once it reaches the limit, the reserved carts are counted properly, which
+    forgets any claims from carts whose reservations have expired. A cart
+    whose reservation is renewed after it expired must claim its vouchers
+    again, with ``renew_claim``.
+
+    '''
+
+    # The number of codes to look up in each query when bulk creating
+    BATCH_SIZE = 500
+
+    # The number of random codes that generate_codes may try for each code
+    # it needs
+    CODE_ATTEMPTS = 10
+
+    # The default number of invalid codes that may be entered from a given
+    # user or address in each period, and the length of that period in
+    # seconds. Override these with the VOUCHER_ATTEMPT_LIMIT and
+    # VOUCHER_ATTEMPT_PERIOD settings.
+    ATTEMPT_LIMIT = 10
+    ATTEMPT_PERIOD = 600
+
+    def __init__(self, voucher):
+        self.voucher = voucher
+
+    def _reserved_carts(self):
+        return commerce.Cart.reserved_carts().filter(vouchers=self.voucher)
+
+    def _counter(self, lock):
+        ''' Returns the VoucherCounter for this voucher, creating it from the
+        reserved carts if it does not exist yet.
+
+        Arguments:
+            lock (bool): If true, the counter row is selected for update, and
+                will stay locked until the current transaction ends.
+
+        '''
+
+        counters = commerce.VoucherCounter.objects
+        if lock:
+            counters = counters.select_for_update()
+
+        try:
+            return counters.get(voucher=self.voucher)
+        except ObjectDoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                return commerce.VoucherCounter.objects.create(
+                    voucher=self.voucher,
+                    claims=self._reserved_carts().count(),
+                )
+        except IntegrityError:
+            # Another cart created the counter before we could.
+            return counters.get(voucher=self.voucher)
+
+    def test_available(self, cart, lock=False, held=False):
+        ''' Raises ValidationError if the given cart may not hold this
+        voucher.
+
+        Arguments:
+            cart (commerce.Cart): The cart that holds, or wants to hold, this
+                voucher.
+
+            lock (bool): If true, the voucher's counter is locked until the
+                end of the current transaction. Concurrent claims on the
+                voucher are serialised, so the voucher can not be claimed more
+                times than its limit allows. This must be called inside a
+                transaction.
+
+            held (bool): True if the cart holds this voucher, and its
+                reservation has not expired, so that its own claim is
+                included in the counter.
+
+        '''
+
+        counter = self._counter(lock)
+
+        # The counter includes the cart's own claim if it's held
+        limit = self.voucher.limit + (1 if held else 0)
+
+        if counter.claims >= limit:
+            # The counter may include carts that have since expired, so find
+            # out how many claims are actually still held.
+            carts = self._reserved_carts()
+            others = carts.exclude(pk=cart.id).count()
+
+            if lock:
+                ours = carts.filter(pk=cart.id).exists()
+                counter.claims = others + (1 if ours else 0)
+                counter.save()
+
+            # It's invalid for a user to enter a voucher that's exhausted
+            if others >= self.voucher.limit:
+                raise ValidationError(
+                    "Voucher %s is no longer available" % self.voucher.code)
+
+        # It's not valid for users to re-enter a voucher they already have
+        user_carts_with_voucher = self._reserved_carts().filter(
+            user=cart.user,
+        ).exclude(
+            pk=cart.id,
+        )
+
+        if user_carts_with_voucher.exists():
+            raise ValidationError("You have already entered this voucher.")
+
+    def claim(self):
+        ''' Records a new claim on this voucher. You should call
+        ``test_available`` with ``lock=True`` earlier in the same
+        transaction. '''
+
+        commerce.VoucherCounter.objects.filter(
+            voucher=self.voucher,
+        ).update(
+            claims=F("claims") + 1,
+        )
+
+    @transaction.atomic
+    def renew_claim(self, cart):
+        ''' Claims this voucher again for a cart whose reservation had
+        expired, and is being renewed. Claims from expired carts may have been
+        forgotten when the claims were last counted, so the reserved carts are
+        counted again.
+
+        Returns:
+            bool: True if the voucher could be claimed. If not, remove the
+                voucher from the cart.
+
+        '''
+
+        counter = self._counter(lock=True)
+        others = self._reserved_carts().exclude(pk=cart.id).count()
+
+        claimed = others < self.voucher.limit
+        counter.claims = others + (1 if claimed else 0)
+        counter.save()
+
+        return claimed
+
+    @transaction.atomic
+    def release(self):
+        ''' Recounts the claims on this voucher after a cart has given it up.
+        '''
+
+        counter = self._counter(lock=True)
+        counter.claims = self._reserved_carts().count()
+        counter.save()
+
+    @staticmethod
+    @version.INVENTORY.memoise
+    def _all_codes():
+        return frozenset(
+            inventory.Voucher.objects.values_list("code", flat=True)
+        )
+
+    @classmethod
+    def code_exists(cls, code):
+        ''' Returns true if some voucher has the given code. The set of codes
+        is held in memory until the inventory changes, so this does not query
+        the database for each code that is entered. '''
+
+        return inventory.Voucher.normalise_code(code) in cls._all_codes()
+
+    @classmethod
+    def _attempt_settings(cls):
+        limit = getattr(settings, "VOUCHER_ATTEMPT_LIMIT", cls.ATTEMPT_LIMIT)
+        period = getattr(
+            settings, "VOUCHER_ATTEMPT_PERIOD", cls.ATTEMPT_PERIOD
+        )
+        return limit, period
+
+    @classmethod
+    def _attempt_key(cls, source):
+        return "registrasion-voucher-attempts-" + source
+
+    @classmethod
+    def attempts_exceeded(cls, sources):
+        ''' Returns true if any of the given sources has entered too many
+        invalid voucher codes recently.
+
+        Arguments:
+            sources ([str, ...]): Strings that identify where the attempt came
+                from, e.g. the user and their IP address.
+
+        '''
+
+        limit, _ = cls._attempt_settings()
+        keys = [cls._attempt_key(source) for source in sources]
+        attempts = cache.get_many(keys)
+        return any(count >= limit for count in attempts.values())
+
+    @classmethod
+    def record_failed_attempt(cls, sources):
+        ''' Records that each of the given sources has entered an invalid
+        voucher code. '''
+
+        _, period = cls._attempt_settings()
+        for source in sources:
+            key = cls._attempt_key(source)
+            # add() only sets the key if it's not already there, so the
+            # period runs from the first failed attempt.
+            cache.add(key, 0, period)
+            try:
+                cache.incr(key)
+            except ValueError:
+                # The key expired between add() and incr()
+                cache.add(key, 1, period)
+
+    @classmethod
+    def generate_codes(cls, count, length=8, prefix=""):
+        ''' Generates voucher codes that are not used by any existing voucher.
+
+        Arguments:
+            count (int): The number of codes to generate.
+
+            length (int): The number of random characters in each code.
+
+            prefix (str): A string to put at the start of each code.
+
+        Returns:
+            [str, ...]: ``count`` distinct, normalised voucher codes.
+
+        Raises:
+            ValueError: if there aren't ``count`` unused codes of the given
+                length and prefix, or they could not be found in a reasonable
+                number of attempts.
+
+        '''
+
+        max_length = inventory.Voucher._meta.get_field("code").max_length
+        if len(prefix) + length > max_length:
+            raise ValueError(
+                "Voucher codes may be at most %d characters long" % max_length
+            )
+
+        prefix = inventory.Voucher.normalise_code(prefix)
+
+        # Only codes with the same prefix and length can collide
+        taken = inventory.Voucher.objects.annotate(
+            code_length=Length("code"),
+        ).filter(
+            code__startswith=prefix,
+            code_length=len(prefix) + length,
+        )
+
+        available = len(util.VOUCHER_CODE_CHARS) ** length - taken.count()
+        if count > available:
+            raise ValueError(
+                "There are only %d unused codes with %d characters after "
+                "the prefix" % (max(available, 0), length)
+            )
+
+        # Random codes rarely collide, unless most of the codes are used up
+        attempts = count * cls.CODE_ATTEMPTS + cls.BATCH_SIZE
+
+        codes = set()
+        while len(codes) < count:
+            candidates = set()
+            while len(codes) + len(candidates) < count and attempts > 0:
+                attempts -= 1
+                code = util.generate_voucher_code(length, prefix)
+                if code not in codes:
+                    candidates.add(code)
+
+            if not candidates:
+                raise ValueError(
+                    "Could not find %d unused codes; try a longer length" % (
+                        count,
+                    )
+                )
+
+            # Look the candidates up in batches, rather than loading every
+            # existing code
+            candidates = sorted(candidates)
+            for i in range(0, len(candidates), cls.BATCH_SIZE):
+                batch = candidates[i:i + cls.BATCH_SIZE]
+                used = set(inventory.Voucher.objects.filter(
+                    code__in=batch,
+                ).values_list("code", flat=True))
+                codes.update(code for code in batch if code not in used)
+
+        return sorted(codes)
+
+    @classmethod
+    def code_errors(cls, codes):
+        ''' Checks codes that are to be given to new vouchers.
+
+        Arguments:
+            codes ([str, ...]): The codes to check.
+
+        Returns:
+            [(int, str), ...]: The index in ``codes`` of each code that can't
+                be used, and the reason why, in order of index.
+
+        '''
+
+        max_length = inventory.Voucher._meta.get_field("code").max_length
+
+        errors = []
+        first_index = {}
+        for i, code in enumerate(codes):
+            code = inventory.Voucher.normalise_code(code)
+            if not code:
+                errors.append((i, "The code is blank"))
+            elif len(code) > max_length:
+                errors.append((i, "%s is longer than %d characters" % (
+                    code, max_length,
+                )))
+            elif code in first_index:
+                errors.append((i, "%s appears more than once" % code))
+            else:
+                first_index[code] = i
+
+        unique = sorted(first_index)
+        for i in range(0, len(unique), cls.BATCH_SIZE):
+            used = inventory.Voucher.objects.filter(
+                code__in=unique[i:i + cls.BATCH_SIZE],
+            ).values_list("code", flat=True)
+            errors.extend(
+                (first_index[code], "%s is already in use" % code)
+                for code in used
+            )
+
+        return sorted(errors)
+
+    @classmethod
+    @transaction.atomic
+    def bulk_create(cls, recipient, codes, limit=1, like=None):
+        ''' Creates a voucher for each of the given codes.
+
+        Arguments:
+            recipient (str): The recipient to record against each voucher.
+
+            codes ([str, ...]): The codes for the new vouchers. These must not
+                be used by any existing voucher.
+
+            limit (int): The number of attendees who may hold each voucher.
+
+            like (Optional[inventory.Voucher]): If provided, each new voucher
+                is given a copy of this voucher's VoucherDiscount (along with
+                its discount clauses) and VoucherFlag.
+
+        Returns:
+            [inventory.Voucher, ...]: The new vouchers, ordered by code.
+
+        Raises:
+            ValueError: if any of the codes can't be used, as reported by
+                ``code_errors``.
+
+        '''
+
+        errors = cls.code_errors(codes)
+        if errors:
+            raise ValueError("; ".join(message for i, message in errors))
+
+        codes = [inventory.Voucher.normalise_code(code) for code in codes]
+
+        inventory.Voucher.objects.bulk_create(
+            inventory.Voucher(recipient=recipient, code=code, limit=limit)
+            for code in codes
+        )
+
+        # Not every database returns primary keys from bulk_create
+        vouchers = []
+        for i in range(0, len(codes), cls.BATCH_SIZE):
+            vouchers.extend(inventory.Voucher.objects.filter(
+                code__in=codes[i:i + cls.BATCH_SIZE],
+            ))
+        vouchers.sort(key=lambda voucher: voucher.code)
+
+        if like is not None:
+            cls._copy_discount(like, vouchers)
+            cls._copy_flag(like, vouchers)
+
+        # bulk_create() doesn't send the signals that change the version
+        version.INVENTORY._changed(None)
+
+        return vouchers
+
+    @classmethod
+    def _copy_discount(cls, like, vouchers):
+        try:
+            original = like.voucherdiscount
+        except ObjectDoesNotExist:
+            return
+
+        product_clauses = list(original.discountforproduct_set.all())
+        category_clauses = list(original.discountforcategory_set.all())
+
+        discount_ids = cls._bulk_create_conditions(
+            conditions.VoucherDiscount,
+            vouchers,
+            description=original.description,
+        )
+
+        new_product_clauses = []
+        new_category_clauses = []
+        for discount_id in discount_ids:
+            for clause in product_clauses:
+                new_product_clauses.append(conditions.DiscountForProduct(
+                    discount_id=discount_id,
+                    product_id=clause.product_id,
+                    percentage=clause.percentage,
+                    price=clause.price,
+                    quantity=clause.quantity,
+                ))
+            for clause in category_clauses:
+                new_category_clauses.append(conditions.DiscountForCategory(
+                    discount_id=discount_id,
+                    category_id=clause.category_id,
+                    percentage=clause.percentage,
+                    quantity=clause.quantity,
+                ))
+
+        conditions.DiscountForProduct.objects.bulk_create(new_product_clauses)
+        conditions.DiscountForCategory.objects.bulk_create(
+            new_category_clauses
+        )
+
+    @classmethod
+    def _copy_flag(cls, like, vouchers):
+        try:
+            original = like.voucherflag
+        except ObjectDoesNotExist:
+            return
+
+        product_ids = list(original.products.values_list("id", flat=True))
+        category_ids = list(original.categories.values_list("id", flat=True))
+
+        flag_ids = cls._bulk_create_conditions(
+            conditions.VoucherFlag,
+            vouchers,
+            description=original.description,
+            condition=original.condition,
+        )
+
+        ProductThrough = conditions.FlagBase.products.through
+        CategoryThrough = conditions.FlagBase.categories.through
+
+        product_links = []
+        category_links = []
+        for flag_id in flag_ids:
+            product_links.extend(
+                ProductThrough(flagbase_id=flag_id, product_id=product_id)
+                for product_id in product_ids
+            )
+            category_links.extend(
+                CategoryThrough(flagbase_id=flag_id, category_id=category_id)
+                for category_id in category_ids
+            )
+
+        ProductThrough.objects.bulk_create(product_links)
+        CategoryThrough.objects.bulk_create(category_links)
+
+    @classmethod
+    def _bulk_create_conditions(cls, model, vouchers, description, **fields):
+        ''' Creates an instance of ``model`` (VoucherDiscount or VoucherFlag)
+        for each of the vouchers, with the given description and base model
+        fields, and returns their IDs in the same order.
+
+        Django can't bulk create multi-table models, so the base rows are
+        bulk created first, each with a unique temporary description that is
+        used to find its ID, since not every database returns primary keys
+        from bulk_create. The voucher rows are then inserted together. '''
+
+        base_model, = model._meta.parents
+        markers = [uuid.uuid4().hex for voucher in vouchers]
+
+        base_model.objects.bulk_create(
+            base_model(description=marker, **fields) for marker in markers
+        )
+
+        ids = {}
+        for i in range(0, len(markers), cls.BATCH_SIZE):
+            ids.update(base_model.objects.filter(
+                description__in=markers[i:i + cls.BATCH_SIZE],
+            ).values_list("description", "id"))
+        ids = [ids[marker] for marker in markers]
+
+        base_model.objects.filter(id__in=ids).update(description=description)
+
+        quote = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+            quote(model._meta.db_table),
+            quote(model._meta.pk.column),
+            quote(model._meta.get_field("voucher").column),
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                (condition_id, voucher.id)
+                for condition_id, voucher in zip(ids, vouchers)
+            ])
+
+        return ids
+
+    @classmethod
+    def write_csv(cls, vouchers, outfile):
+        ''' Writes the code, recipient, and limit of each voucher to
+        ``outfile`` as UTF-8 encoded CSV. '''
+
+        writer = csv.writer(outfile)
+        encode = lambda i: i.encode("utf8") if isinstance(i, unicode) else i  # NOQA
+        writer.writerow(["code", "recipient", "limit"])
+        for voucher in vouchers:
+            writer.writerow([
+                encode(voucher.code),
+                encode(voucher.recipient),
+                voucher.limit,
+            ])
@@ -1,3 +1,4 @@
+from .controllers import version
 from .controllers.product import ProductController
 from .models import commerce
 from .models import inventory
@@ -87,7 +88,21 @@ class ManualPaymentForm(forms.ModelForm):
 
 def ProductsForm(category, products):
     ''' Produces an appropriate _ProductsForm subclass for the given render
-    type. '''
+    type.
+
+    The classes are kept until the inventory changes, so each combination of
+    category and products only needs to be built once. '''
+
+    products = list(products)
+    products.sort(key=lambda prod: prod.order)
+
+    # Model instances hash and compare by ID, so these are keyed by the
+    # category ID, its render type, and the ordered product IDs.
+    return _products_form(category, category.render_type, tuple(products))
+
+
+@version.INVENTORY.memoise
+def _products_form(category, render_type, products):
 
     # Each Category.RENDER_TYPE value has a subclass here.
     cat = inventory.Category
@@ -99,15 +114,12 @@ def ProductsForm(category, products):
     }
 
     # Produce a subclass of _ProductsForm which we can alter the base_fields on
-    class ProductsForm(RENDER_TYPES[category.render_type]):
+    class ProductsForm(RENDER_TYPES[render_type]):
         pass
 
-    products = list(products)
-    products.sort(key=lambda prod: prod.order)
-
     ProductsForm.set_fields(category, products)
 
-    if category.render_type == inventory.Category.RENDER_TYPE_ITEM_QUANTITY:
+    if render_type == inventory.Category.RENDER_TYPE_ITEM_QUANTITY:
         ProductsForm = forms.formset_factory(
             ProductsForm,
             formset=_ItemQuantityProductsFormSet,
@@ -0,0 +1,118 @@
+import csv
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+
+from registrasion.controllers.voucher import VoucherController
+from registrasion.models import inventory
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates vouchers in bulk, either with newly generated codes, or with "
+        "codes imported from a CSV file, and writes them out as CSV."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "recipient",
+            help="The recipient to record against each voucher.",
+        )
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=0,
+            help="The number of codes to generate.",
+        )
+        parser.add_argument(
+            "--import",
+            dest="import_file",
+            help="A CSV file whose first column holds the codes to create.",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=1,
+            help="The number of attendees who may hold each voucher.",
+        )
+        parser.add_argument(
+            "--length",
+            type=int,
+            default=8,
+            help="The number of random characters in each generated code.",
+        )
+        parser.add_argument(
+            "--prefix",
+            default="",
+            help="A string to put at the start of each generated code.",
+        )
+        parser.add_argument(
+            "--like",
+            help="The code of an existing voucher whose discount and flag "
+                 "should be copied to each new voucher.",
+        )
+        parser.add_argument(
+            "--output",
+            help="A file to write the new vouchers to (default: stdout).",
+        )
+
+    def handle(self, *args, **options):
+        like = None
+        if options["like"]:
+            try:
+                like = inventory.Voucher.objects.get(
+                    code=inventory.Voucher.normalise_code(options["like"]),
+                )
+            except inventory.Voucher.DoesNotExist:
+                raise CommandError("No voucher has code %s" % options["like"])
+
+        if options["import_file"]:
+            # The csv module needs files opened in binary mode
+            with open(options["import_file"], "rb") as infile:
+                reader = csv.reader(infile)
+                rows = [
+                    (reader.line_num, row[0].strip())
+                    for row in reader if row and row[0].strip()
+                ]
+            codes = [code for line, code in rows]
+
+            # Report every unusable code at once, rather than one per run
+            errors = VoucherController.code_errors(codes)
+            if errors:
+                raise CommandError("\n".join(
+                    "Line %d: %s" % (rows[i][0], message)
+                    for i, message in errors
+                ))
+        elif options["count"] > 0:
+            try:
+                codes = VoucherController.generate_codes(
+                    options["count"],
+                    length=options["length"],
+                    prefix=options["prefix"],
+                )
+            except ValueError as e:
+                raise CommandError(str(e))
+        else:
+            raise CommandError("Specify either --count or --import")
+
+        try:
+            vouchers = VoucherController.bulk_create(
+                options["recipient"],
+                codes,
+                limit=options["limit"],
+                like=like,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        except IntegrityError:
+            # Another voucher took one of the codes after they were checked
+            raise CommandError("One or more of the codes is already in use")
+
+        if options["output"]:
+            with open(options["output"], "wb") as outfile:
+                VoucherController.write_csv(vouchers, outfile)
+        else:
+            VoucherController.write_csv(vouchers, self.stdout)
+
+        self.stderr.write("Created %d vouchers" % len(vouchers))
@@ -0,0 +1,78 @@
+import multiprocessing
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from registrasion.contrib import badges
+from registrasion.models import commerce
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders the badges of every attendee with a paid invoice into a zip "
+        "file, using several processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output",
+            nargs="?",
+            help="The zip file to write the badges to (default: the "
+                 "BADGES_ARCHIVE setting, which staff can download from the "
+                 "badges page).",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help="The number of processes to render badges in (default: the "
+                 "number of CPUs).",
+        )
+        parser.add_argument(
+            "--category",
+            type=int,
+            action="append",
+            default=[],
+            help="Only render badges for attendees who have paid for a "
+                 "product from this category. May be repeated.",
+        )
+        parser.add_argument(
+            "--product",
+            type=int,
+            action="append",
+            default=[],
+            help="Only render badges for attendees who have paid for this "
+                 "product. May be repeated.",
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(
+            invoice__status=commerce.Invoice.STATUS_PAID,
+        )
+
+        if options["category"]:
+            users = users.filter(
+                invoice__lineitem__product__category__in=options["category"],
+            )
+        if options["product"]:
+            users = users.filter(
+                invoice__lineitem__product__in=options["product"],
+            )
+
+        users = users.distinct()
+
+        output = options["output"] or getattr(
+            settings, "BADGES_ARCHIVE", None,
+        )
+        if output is None:
+            raise CommandError("Give an output file, or set BADGES_ARCHIVE")
+
+        badges.write_archive(
+            users,
+            output,
+            processes=options["processes"],
+        )
+
+        self.stdout.write("Wrote %d badges to %s" % (users.count(), output))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from registrasion.controllers.checkin import CheckInController
+from registrasion.models import people
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds every attendee's check-in manifest. Manifests are kept up "
+        "to date as carts are paid, so this is only needed once, after "
+        "installing or upgrading."
+    )
+
+    def handle(self, *args, **options):
+        CheckInController.update_all()
+
+        self.stdout.write("Updated %d check-in manifests" % (
+            people.CheckInManifest.objects.count(),
+        ))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+STATUS_PAID = 2
+
+
+def populate_discount_usage(apps, schema_editor):
+    DiscountItem = apps.get_model("registrasion", "DiscountItem")
+    DiscountUsage = apps.get_model("registrasion", "DiscountUsage")
+
+    items = DiscountItem.objects.filter(
+        cart__status=STATUS_PAID,
+    ).order_by().values(
+        "cart__user", "discount", "product",
+    ).annotate(
+        total_quantity=Sum("quantity"),
+    )
+
+    DiscountUsage.objects.bulk_create(
+        DiscountUsage(
+            user_id=item["cart__user"],
+            discount_id=item["discount"],
+            product_id=item["product"],
+            quantity=item["total_quantity"],
+        )
+        for item in items
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('registrasion', '0007_vouchercounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscountUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('discount', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registrasion.DiscountBase')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registrasion.Product')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='discountusage',
+            unique_together=set([('user', 'discount', 'product')]),
+        ),
+        migrations.RunPython(
+            populate_discount_usage,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrasion', '0010_renderedbadge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckInManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_code', models.CharField(db_index=True, max_length=6, unique=True)),
+                ('name', models.CharField(blank=True, max_length=256)),
+                ('items', models.TextField(default='[]')),
+                ('time_checked_in', models.DateTimeField(blank=True, null=True)),
+                ('attendee', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='registrasion.Attendee')),
+            ],
+        ),
+    ]
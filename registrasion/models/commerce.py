@@ -64,6 +64,115 @@ class Cart(models.Model):
         )
 
 
+@python_2_unicode_compatible
+class VoucherCounter(models.Model):
+    ''' Keeps a running count of the carts that hold a Voucher, so that the
+    voucher's limit can be tested without counting every reserved cart.
+
+    Attributes:
+        voucher (inventory.Voucher): The voucher being counted.
+
+        claims (int): An upper bound on the number of reserved carts that hold
+            this voucher. It is incremented whenever a cart claims the
+            voucher, and is recounted from the reserved carts when it reaches
+            the voucher's limit, or when a cart gives up the voucher.
+
+    '''
+
+    class Meta:
+        app_label = "registrasion"
+
+    def __str__(self):
+        return "%s: %d claims" % (self.voucher, self.claims)
+
+    voucher = models.OneToOneField(
+        inventory.Voucher,
+        on_delete=models.CASCADE,
+    )
+    claims = models.PositiveIntegerField(default=0)
+
+
+@python_2_unicode_compatible
+class DiscountUsage(models.Model):
+    ''' Records how much of a product a user has bought with a discount,
+    across all of their paid carts. This lets the past uses of a discount
+    be read without adding up the discount items in every paid cart.
+
+    Attributes:
+        user (User): The user who used the discount.
+
+        discount (conditions.DiscountBase): The discount that was used.
+
+        product (inventory.Product): The product that was discounted.
+
+        quantity (int): The number of items of ``product`` that were
+            discounted by ``discount`` in the user's paid carts.
+
+    '''
+
+    class Meta:
+        app_label = "registrasion"
+        unique_together = (
+            ("user", "discount", "product"),
+        )
+
+    def __str__(self):
+        return "%s: %s * %d for %s" % (
+            self.discount, self.product, self.quantity, self.user)
+
+    user = models.ForeignKey(User)
+    discount = models.ForeignKey(conditions.DiscountBase)
+    product = models.ForeignKey(inventory.Product)
+    quantity = models.PositiveIntegerField()
+
+
+@python_2_unicode_compatible
+class AdmissionTicket(models.Model):
+    ''' A user's place in the queue for the registration pages. These are
+    only used if admission control is turned on with ``ADMISSION_LIMIT``.
+
+    Attributes:
+        user (User): The user who is queueing.
+
+        time_admitted (Optional[datetime]): The time that the user was
+            admitted to the registration pages, or None if they are still
+            waiting. Users are admitted in order of ticket ID.
+
+        time_last_seen (datetime): The last time the user loaded a
+            registration page or checked their place in the queue. Users who
+            have not been seen for ``ADMISSION_TIMEOUT`` lose their place.
+
+    '''
+
+    class Meta:
+        app_label = "registrasion"
+        index_together = [
+            ("time_admitted", "time_last_seen"),
+        ]
+
+    def __str__(self):
+        if self.time_admitted is None:
+            return "%s (waiting)" % self.user
+        return "%s (admitted)" % self.user
+
+    user = models.OneToOneField(User)
+    time_admitted = models.DateTimeField(null=True, blank=True)
+    time_last_seen = models.DateTimeField()
+
+
+@python_2_unicode_compatible
+class AdmissionQueue(models.Model):
+    ''' A single row, which is locked while users are admitted from the
+    queue for the registration pages, so that concurrent requests can't
+    admit more than ``ADMISSION_LIMIT`` users between them. '''
+
+    class Meta:
+        app_label = "registrasion"
+
+    def __str__(self):
+        return "Admission queue"
+
+
 @python_2_unicode_compatible
 class ProductItem(models.Model):
     ''' Represents a product-quantity pair in a Cart. '''
@@ -403,3 +512,4 @@ class ManualCreditNoteRefund(CreditNoteRefund):
         app_label = "registrasion"
 
     entered_by = models.ForeignKey(User)
+
@@ -67,11 +67,55 @@ class AttendeeProfileBase(models.Model):
         '''
         return None
 
-    def attendee_name(self):
-        if type(self) == AttendeeProfileBase:
+    @classmethod
+    def resolve_subclasses(cls, profiles):
+        ''' Finds the subclass instance of each of the given profiles, in a
+        single query, and remembers it on the profile, so that
+        ``attendee_name`` and ``invoice_recipient`` don't need to query for it
+        again. Use this before calling those on many profiles.
+
+        Arguments:
+            profiles (Iterable[AttendeeProfileBase]): The profiles.
+
+        Returns:
+            [AttendeeProfileBase, ...]: The subclass instance of each of the
+                profiles, in the same order.
+
+        '''
+
+        profiles = list(profiles)
+        unresolved = dict(
+            (profile.id, profile) for profile in profiles
+            if type(profile) == AttendeeProfileBase and
+            getattr(profile, "_subclass_instance", None) is None
+        )
+
+        if unresolved:
+            subclassed = AttendeeProfileBase.objects.filter(
+                id__in=list(unresolved),
+            ).select_related(
+                "attendee", "attendee__user",
+            ).select_subclasses()
+            for instance in subclassed:
+                unresolved[instance.id]._subclass_instance = instance
+
+        return [profile.subclass_instance() for profile in profiles]
+
+    def subclass_instance(self):
+        ''' Returns this profile as an instance of the subclass that it was
+        created as. '''
+
+        if type(self) != AttendeeProfileBase:
+            return self
+
+        real = getattr(self, "_subclass_instance", None)
+        if real is None:
             real = AttendeeProfileBase.objects.get_subclass(id=self.id)
-        else:
-            real = self
+            self._subclass_instance = real
+        return real
+
+    def attendee_name(self):
+        real = self.subclass_instance()
         return getattr(real, real.name_field())
 
     def invoice_recipient(self):
@@ -84,7 +128,7 @@ class AttendeeProfileBase(models.Model):
         '''
 
         # Manual dispatch to subclass. Fleh.
-        slf = AttendeeProfileBase.objects.get_subclass(id=self.id)
+        slf = self.subclass_instance()
         # Actually compare the functions.
         if type(slf).invoice_recipient != type(self).invoice_recipient:
             return type(slf).invoice_recipient(slf)
@@ -93,3 +137,68 @@ class AttendeeProfileBase(models.Model):
         return slf.attendee.user.username
 
     attendee = models.OneToOneField(Attendee, on_delete=models.CASCADE)
+
+
+@python_2_unicode_compatible
+class RenderedBadge(models.Model):
+    ''' A user's badge, as it was last rendered, so that it only needs to be
+    rendered again when something it shows may have changed.
+
+    Attributes:
+        user (User): The user whose badge this is.
+
+        key (str): A hash of everything the badge was rendered from: the
+            user, their attendee profile, the items they have paid for, and
+            the badge template.
+
+        svg (str): The rendered badge.
+
+    '''
+
+    class Meta:
+        app_label = "registrasion"
+
+    def __str__(self):
+        return "Badge for %s" % self.user
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=40)
+    svg = models.TextField()
+
+
+@python_2_unicode_compatible
+class CheckInManifest(models.Model):
+    ''' What an attendee should be given when they check in, precomputed so
+    that it can be looked up by access code without any joins. This is kept
+    up to date by ``CheckInController``.
+
+    Attributes:
+        attendee (Attendee): The attendee this manifest is for.
+
+        access_code (str): The attendee's access code.
+
+        name (str): The attendee's name, from their attendee profile.
+
+        items (str): The items that the attendee has paid for, as a JSON
+            list of ``{"category": str, "product": str, "quantity": int}``.
+
+        time_checked_in (Optional[datetime]): When the attendee checked in,
+            or None if they haven't.
+
+    '''
+
+    class Meta:
+        app_label = "registrasion"
+
+    def __str__(self):
+        return "Check-in manifest for %s" % self.attendee
+
+    attendee = models.OneToOneField(Attendee, on_delete=models.CASCADE)
+    access_code = models.CharField(
+        max_length=6,
+        unique=True,
+        db_index=True,
+    )
+    name = models.CharField(max_length=256, blank=True)
+    items = models.TextField(default="[]")
+    time_checked_in = models.DateTimeField(null=True, blank=True)
@@ -16,8 +16,10 @@ from django.db.models.fields.related import RelatedField
 from django.shortcuts import render
 
 from registrasion.controllers.cart import CartController
+from registrasion.controllers.eligibility import EligibilityController
 from registrasion.controllers.item import ItemController
 from registrasion.models import commerce
+from registrasion.models import inventory
 from registrasion.models import people
 from registrasion import util
 from registrasion import views
@@ -331,6 +333,10 @@ def product_line_items(request, form):
         "user__attendee__attendeeprofilebase"
     ).order_by("issue_time")
 
+    people.AttendeeProfileBase.resolve_subclasses(
+        invoice.user.attendee.attendeeprofilebase for invoice in invoices
+    )
+
     headings = [
         'Invoice', 'Invoice Date', 'Attendee', 'Qty', 'Product', 'Status'
     ]
@@ -421,6 +427,11 @@ def credit_notes(request, form):
         "invoice__user__attendee__attendeeprofilebase",
     )
 
+    # This evaluates the queryset, so the report shows these same profiles
+    people.AttendeeProfileBase.resolve_subclasses(
+        note.invoice.user.attendee.attendeeprofilebase for note in notes
+    )
+
     return QuerysetReport(
         "Credit Notes",
         ["id",
@@ -824,6 +835,52 @@ def speaker_registrations(request, form):
     return []
 
 
+@report_view(
+    "Product availability",
+    form_type=forms.ProductAndCategoryForm,
+)
+def product_availability(request, form):
+    ''' Shows which of the given products each registered attendee can
+    currently add to their cart, and the discounts that would apply. '''
+
+    products = form.cleaned_data["product"]
+    categories = form.cleaned_data["category"]
+
+    products = inventory.Product.objects.filter(
+        Q(id__in=products) | Q(category__in=categories),
+    ).select_related("category")
+    products = list(products)
+
+    users = User.objects.filter(
+        cart__status=commerce.Cart.STATUS_PAID,
+    ).distinct().order_by("id")
+
+    eligibility = EligibilityController(users)
+    available = eligibility.available_products(products)
+    discounts = eligibility.available_discounts(categories, products)
+
+    headings = ["User ID", "Username"]
+    headings += [str(product) for product in products]
+    headings += ["Discounts"]
+
+    data = []
+    for user in users:
+        user_products = set(available[user.id])
+        row = [user.id, user.username]
+        row += [
+            "Yes" if product in user_products else "No"
+            for product in products
+        ]
+        row.append(", ".join(
+            str(discount.clause) for discount in discounts[user.id]
+        ))
+        data.append(row)
+
+    return ListReport(
+        "Product availability", headings, data, link_view=attendee,
+    )
+
+
 @report_view(
     "Manifest",
     forms.ProductAndCategoryForm,
@@ -883,6 +940,10 @@ def manifest(request, form):
         elif cart.status == commerce.Cart.STATUS_RELEASED:
             items["refunded"].append(item)
 
+    people.AttendeeProfileBase.resolve_subclasses(
+        user.attendee.attendeeprofilebase for user in users
+    )
+
     users_by_name = list(users.keys())
     users_by_name.sort(key=(
         lambda i: i.attendee.attendeeprofilebase.attendee_name().lower()
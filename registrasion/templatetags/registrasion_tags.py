@@ -1,9 +1,13 @@
+import hashlib
+
 from registrasion.models import commerce
+from registrasion.controllers import version
 from registrasion.controllers.category import CategoryController
 from registrasion.controllers.item import ItemController
 
 from django import template
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Sum
 from urllib import urlencode  # TODO: s/urllib/six.moves.urllib/
 
@@ -19,6 +23,119 @@ def user_for_context(context):
         return context.request.user
 
 
+class _UserState(object):
+    ''' The parts of a user's registration that the tags in this module
+    show. Each part is worked out at most once per request, no matter how
+    many tags use it.
+
+    If ``TEMPLATE_TAGS_CACHE_TIMEOUT`` is set, the parts that depend only on
+    the user's carts and on availability are also kept in Django's cache for
+    up to that many seconds, until any of the user's carts, or the inventory
+    configuration, changes. Other users' purchases are not tracked, so stock
+    limits they use up show within the timeout. '''
+
+    _REQUEST_ATTRIBUTE = "_registrasion_user_states"
+
+    def __init__(self, user):
+        self.user = user
+        self._values = None
+        self._local = {}
+        self._cache_key = None
+
+    @classmethod
+    def for_context(cls, context):
+        user = user_for_context(context)
+        request = getattr(context, "request", None)
+        if request is None:
+            return cls(user)
+
+        states = request.__dict__.setdefault(cls._REQUEST_ATTRIBUTE, {})
+        if user.id not in states:
+            states[user.id] = cls(user)
+        return states[user.id]
+
+    @classmethod
+    def _timeout(cls):
+        return getattr(settings, "TEMPLATE_TAGS_CACHE_TIMEOUT", None)
+
+    def _key(self):
+        if self._cache_key is None:
+            carts = commerce.Cart.objects.filter(
+                user=self.user,
+            ).order_by("id").values_list("id", "revision", "status")
+            carts = hashlib.sha1(repr(list(carts)).encode("utf-8"))
+            self._cache_key = "registrasion-tags-%d-%s-%s" % (
+                self.user.id,
+                version.INVENTORY.current(),
+                carts.hexdigest(),
+            )
+        return self._cache_key
+
+    def _get(self, key, func, shared=True):
+        ''' Returns the stored value for key, calling func to work it out
+        if there isn't one. Values are only kept between requests if shared
+        is true. '''
+
+        if not shared:
+            if key not in self._local:
+                self._local[key] = func()
+            return self._local[key]
+
+        timeout = self._timeout()
+
+        if self._values is None:
+            self._values = (timeout and cache.get(self._key())) or {}
+
+        if key not in self._values:
+            self._values[key] = func()
+            if timeout:
+                cache.set(self._key(), self._values, timeout)
+
+        return self._values[key]
+
+    def available_categories(self):
+        return self._get(
+            ("available_categories",),
+            lambda: CategoryController.available_categories(self.user),
+        )
+
+    def items_pending(self):
+        return self._get(
+            ("items_pending",),
+            lambda: ItemController(self.user).items_pending(),
+        )
+
+    def items_purchased(self, category=None):
+        category_id = category.id if category is not None else None
+        return self._get(
+            ("items_purchased", category_id),
+            lambda: ItemController(self.user).items_purchased(
+                category=category,
+            ),
+        )
+
+    def items_pending_or_purchased(self):
+        return self._get(
+            ("items_pending_or_purchased",),
+            lambda: ItemController(self.user).items_pending_or_purchased(),
+        )
+
+    def available_credit(self):
+        # Credit can be applied without changing any carts
+        return self._get(
+            ("available_credit",),
+            self._available_credit,
+            shared=False,
+        )
+
+    def _available_credit(self):
+        notes = commerce.CreditNote.unclaimed().filter(
+            invoice__user=self.user,
+        )
+        ret = notes.values("amount").aggregate(Sum("amount"))["amount__sum"]
+        return 0 - (ret or 0)
+
+
 @register.assignment_tag(takes_context=True)
 def available_categories(context):
     ''' Gets all of the currently available products.
@@ -28,15 +145,15 @@ def available_categories(context):
             have Products that the current user can reserve.
 
     '''
-    return CategoryController.available_categories(user_for_context(context))
+    return _UserState.for_context(context).available_categories()
 
 
 @register.assignment_tag(takes_context=True)
 def missing_categories(context):
     ''' Adds the categories that the user does not currently have. '''
-    user = user_for_context(context)
-    categories_available = set(CategoryController.available_categories(user))
-    items = ItemController(user).items_pending_or_purchased()
+    state = _UserState.for_context(context)
+    categories_available = set(state.available_categories())
+    items = state.items_pending_or_purchased()
 
     categories_held = set()
 
@@ -56,11 +173,7 @@ def available_credit(context):
 
     '''
 
-    notes = commerce.CreditNote.unclaimed().filter(
-        invoice__user=user_for_context(context),
-    )
-    ret = notes.values("amount").aggregate(Sum("amount"))["amount__sum"] or 0
-    return 0 - ret
+    return _UserState.for_context(context).available_credit()
 
 
 @register.assignment_tag(takes_context=True)
@@ -80,7 +193,7 @@ def items_pending(context):
     the former is not defined.
     '''
 
-    return ItemController(user_for_context(context)).items_pending()
+    return _UserState.for_context(context).items_pending()
 
 
 @register.assignment_tag(takes_context=True)
@@ -91,9 +204,7 @@ def items_purchased(context, category=None):
     the former is not defined.
     '''
 
-    return ItemController(user_for_context(context)).items_purchased(
-        category=category
-    )
+    return _UserState.for_context(context).items_purchased(category=category)
 
 
 @register.assignment_tag(takes_context=True)
@@ -130,6 +241,9 @@ def sold_out_and_unregistered(context):
     If the current user *is* registered, then return None (it's not a
     pertinent question for people who already have a ticket).
 
+    If there is no logged-in user, returns True if the products have sold out
+    for everybody.
+
     '''
 
     user = user_for_context(context)
@@ -144,6 +258,22 @@ def sold_out_and_unregistered(context):
         return None
 
     ticket_category = settings.TICKET_PRODUCT_CATEGORY
+
+    sold_out = CategoryController.sold_out(ticket_category)
+    if not user.is_authenticated():
+        return sold_out
+
+    # Only users who hold a ticket in their own cart can get one once
+    # they've sold out for everybody else.
+    if sold_out:
+        holds_ticket = commerce.ProductItem.objects.filter(
+            cart__user=user,
+            cart__status=commerce.Cart.STATUS_ACTIVE,
+            product__category=ticket_category,
+        ).exists()
+        if not holds_ticket:
+            return True
+
     categories = available_categories(context)
 
     return ticket_category not in [cat.id for cat in categories]
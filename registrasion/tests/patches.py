@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from django.utils import timezone
 
 from registrasion.contrib import mail
@@ -46,5 +47,15 @@ class SendEmailMixin(object):
         super(SendEmailMixin, self).tearDown()
 
 
-class MixInPatches(SetTimeMixin, SendEmailMixin):
+class ClearCacheMixin(object):
+    ''' Clears the cache before each test case. Rolling back the database
+    between tests doesn't change the configuration versions, so anything
+    memoised against them would otherwise outlive the test. '''
+
+    def setUp(self):
+        super(ClearCacheMixin, self).setUp()
+        cache.clear()
+
+
+class MixInPatches(SetTimeMixin, SendEmailMixin, ClearCacheMixin):
     pass
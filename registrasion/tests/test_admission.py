@@ -0,0 +1,95 @@
+import datetime
+
+from django.test.utils import override_settings
+
+from registrasion.controllers.admission import AdmissionController
+from registrasion.models import commerce
+from registrasion.tests.controller_helpers import TestingCartController
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+@override_settings(ADMISSION_LIMIT=1, ADMISSION_TIMEOUT=600)
+class AdmissionTestCases(RegistrationCartTestCase):
+
+    def test_users_queue_beyond_the_limit(self):
+        user_1 = AdmissionController.for_user(self.USER_1)
+        user_2 = AdmissionController.for_user(self.USER_2)
+
+        self.assertTrue(user_1.is_admitted())
+        self.assertFalse(user_2.is_admitted())
+        self.assertEqual(0, user_1.position())
+        self.assertEqual(1, user_2.position())
+
+    def test_lapsed_users_make_room(self):
+        AdmissionController.for_user(self.USER_1)
+        AdmissionController.for_user(self.USER_2)
+
+        self.add_timedelta(datetime.timedelta(seconds=300))
+        user_2 = AdmissionController.for_user(self.USER_2)
+        self.assertFalse(user_2.is_admitted())
+
+        # USER_1 hasn't been seen since they were admitted
+        self.add_timedelta(datetime.timedelta(seconds=301))
+        user_2 = AdmissionController.for_user(self.USER_2)
+        self.assertTrue(user_2.is_admitted())
+
+        # USER_1 has lost their place, and has to queue again
+        user_1 = AdmissionController.for_user(self.USER_1)
+        self.assertFalse(user_1.is_admitted())
+        self.assertEqual(1, user_1.position())
+
+    def test_checking_out_makes_room(self):
+        AdmissionController.for_user(self.USER_1)
+        AdmissionController.for_user(self.USER_2)
+
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+        cart.next_cart()
+
+        self.assertFalse(
+            commerce.AdmissionTicket.objects.filter(user=self.USER_1).exists()
+        )
+        user_2 = AdmissionController.for_user(self.USER_2)
+        self.assertTrue(user_2.is_admitted())
+
+    def test_lapsed_reservations_make_room(self):
+        AdmissionController.for_user(self.USER_1)
+        AdmissionController.for_user(self.USER_2)
+
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+
+        # USER_1 keeps loading pages, but leaves their cart alone until
+        # its reservation lapses
+        for i in range(13):
+            self.add_timedelta(datetime.timedelta(seconds=300))
+            user_1 = AdmissionController.for_user(self.USER_1)
+            self.assertTrue(user_1.is_admitted())
+
+        user_2 = AdmissionController.for_user(self.USER_2)
+        self.assertTrue(user_2.is_admitted())
+
+        user_1 = AdmissionController.for_user(self.USER_1)
+        self.assertFalse(user_1.is_admitted())
+
+    def test_the_queue_is_a_single_row(self):
+        AdmissionController.for_user(self.USER_1)
+        AdmissionController.for_user(self.USER_2)
+
+        self.assertEqual(1, commerce.AdmissionQueue.objects.count())
+        AdmissionController.admit_waiting()
+        self.assertEqual(1, commerce.AdmissionQueue.objects.count())
+
+    def test_staff_bypass_the_queue(self):
+        AdmissionController.for_user(self.USER_1)
+
+        self.USER_2.is_staff = True
+        self.USER_2.save()
+
+        self.assertTrue(AdmissionController.bypasses_queue(self.USER_2))
+        self.assertFalse(AdmissionController.bypasses_queue(self.USER_1))
+
+    @override_settings(ADMISSION_LIMIT=None)
+    def test_everyone_bypasses_the_queue_when_disabled(self):
+        self.assertTrue(AdmissionController.bypasses_queue(self.USER_1))
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+
+from registrasion.contrib import badges
+from registrasion.models import people
+from registrasion.tests.controller_helpers import TestingCartController
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+def badge_templates(badge="{{ user.username }}", **templates):
+    templates[badges.BADGE_TEMPLATE] = badge
+    return [{
+        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "OPTIONS": {
+            "loaders": [
+                ("django.template.loaders.locmem.Loader", templates),
+            ],
+        },
+    }]
+
+
+@override_settings(TEMPLATES=badge_templates())
+class BadgeTestCases(RegistrationCartTestCase):
+
+    def _mark_stored(self, user):
+        people.RenderedBadge.objects.filter(user=user).update(svg="stored")
+
+    def test_unchanged_badges_are_not_rendered_again(self):
+        self.assertEqual("testuser", badges.cached_badge(self.USER_1))
+
+        self._mark_stored(self.USER_1)
+        self.assertEqual("stored", badges.cached_badge(self.USER_1))
+
+    def test_changed_users_are_rendered_again(self):
+        badges.cached_badge(self.USER_1)
+        self._mark_stored(self.USER_1)
+
+        self.USER_1.first_name = "Test"
+        self.USER_1.save()
+
+        self.assertEqual("testuser", badges.cached_badge(self.USER_1))
+
+    def test_paying_for_items_renders_again(self):
+        badges.cached_badge(self.USER_1)
+        self._mark_stored(self.USER_1)
+
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+        cart.next_cart()
+
+        self.assertEqual("testuser", badges.cached_badge(self.USER_1))
+
+    def test_renaming_paid_products_renders_again(self):
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+        cart.next_cart()
+
+        badges.cached_badge(self.USER_1)
+        self._mark_stored(self.USER_1)
+
+        self.PROD_1.name = "Renamed"
+        self.PROD_1.save()
+
+        self.assertEqual("testuser", badges.cached_badge(self.USER_1))
+
+    def test_changing_included_templates_renders_again(self):
+        badge = '{% include "badge_name.svg" %}'
+
+        with override_settings(TEMPLATES=badge_templates(
+            badge, **{"badge_name.svg": "{{ user.username }}"}
+        )):
+            badges.cached_badge(self.USER_1)
+            self._mark_stored(self.USER_1)
+
+        with override_settings(TEMPLATES=badge_templates(
+            badge, **{"badge_name.svg": "{{ user.email }}"}
+        )):
+            self.assertEqual(
+                self.USER_1.email, badges.cached_badge(self.USER_1),
+            )
+
+    def test_archive_is_written_for_staff_to_download(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "badges.zip")
+
+        with override_settings(BADGES_ARCHIVE=path):
+            self.assertIsNone(badges.archive_path())
+
+            users = User.objects.filter(pk=self.USER_1.pk)
+            badges.write_archive(users)
+
+            self.assertEqual(path, badges.archive_path())
+
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(
+                ["badge_%d.svg" % self.USER_1.pk], archive.namelist(),
+            )
@@ -135,3 +135,13 @@ class BatchTestCase(RegistrationCartTestCase):
             with BatchController.batch(self.USER_1):
                 ender = get_ender(self.USER_1)
         self.assertEquals(1, ender.end_count)
+
+    def test_forgotten_results_are_worked_out_again(self):
+        with BatchController.batch(self.USER_1):
+            output_1 = self._memoiseme(self.USER_1)
+            BatchController.forget(self.USER_1, self._memoiseme)
+            output_2 = self._memoiseme(self.USER_1)
+            output_3 = self._memoiseme(self.USER_1)
+
+        self.assertIsNot(output_1, output_2)
+        self.assertIs(output_2, output_3)
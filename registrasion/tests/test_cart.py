@@ -7,6 +7,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from registrasion.models import commerce
 from registrasion.models import conditions
@@ -21,6 +22,8 @@ from registrasion.tests.patches import MixInPatches
 UTC = pytz.timezone('UTC')
 
 
+# The tests run in one process, so the default cache is shared
+@override_settings(CACHE_SHARED_BETWEEN_PROCESSES=True)
 class RegistrationCartTestCase(MixInPatches, TestCase):
 
     def setUp(self):
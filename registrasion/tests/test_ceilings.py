@@ -6,6 +6,12 @@ from django.core.exceptions import ValidationError
 from registrasion.tests.controller_helpers import TestingCartController
 from registrasion.tests.test_cart import RegistrationCartTestCase
 
+from registrasion.controllers.conditions import (
+    TimeOrStockLimitFlagController,
+)
+from registrasion.controllers import version
+from registrasion.controllers.batch import BatchController
+from registrasion.controllers.category import CategoryController
 from registrasion.controllers.discount import DiscountController
 from registrasion.controllers.product import ProductController
 from registrasion.models import commerce
@@ -221,3 +227,149 @@ class CeilingsTestCases(RegistrationCartTestCase):
         cart = TestingCartController.for_user(self.USER_1)
         cart.add_to_cart(self.PROD_1, 1)
         self.assertEqual(1, cart.cart.discountitem_set.count())
+
+    def test_time_window_is_kept_until_the_next_boundary(self):
+        self.make_ceiling(
+            "date range ceiling",
+            start_time=datetime.datetime(2015, 1, 1, tzinfo=UTC),
+            end_time=datetime.datetime(2015, 2, 1, tzinfo=UTC))
+        ceiling = conditions.TimeOrStockLimitFlag.objects.get()
+
+        def in_window():
+            return TimeOrStockLimitFlagController._in_window(
+                conditions.TimeOrStockLimitFlag,
+            )
+
+        self.set_time(datetime.datetime(2014, 12, 1, tzinfo=UTC))
+        self.assertEqual(frozenset(), in_window())
+
+        # Nothing changes until the start time, so no queries are needed
+        self.set_time(datetime.datetime(2014, 12, 31, tzinfo=UTC))
+        with self.assertNumQueries(0):
+            self.assertEqual(frozenset(), in_window())
+
+        self.set_time(datetime.datetime(2015, 1, 1, tzinfo=UTC))
+        self.assertEqual(frozenset([ceiling.id]), in_window())
+
+        self.set_time(datetime.datetime(2015, 2, 1, tzinfo=UTC))
+        with self.assertNumQueries(0):
+            self.assertEqual(frozenset([ceiling.id]), in_window())
+
+        self.set_time(datetime.datetime(2015, 2, 1, minute=1, tzinfo=UTC))
+        self.assertEqual(frozenset(), in_window())
+
+    def test_stock_limits_are_tested_after_taking_the_locks(self):
+        self.make_ceiling("Limit ceiling", limit=1)
+
+        second_cart = TestingCartController.for_user(self.USER_2)
+
+        with BatchController.batch(self.USER_2):
+            # The category view works out what's available before it
+            # changes the cart
+            self.assertEqual(
+                [self.PROD_1],
+                ProductController.available_products(
+                    self.USER_2, products=[self.PROD_1],
+                ),
+            )
+
+            # Someone else takes the last one in the meantime
+            first_cart = TestingCartController.for_user(self.USER_1)
+            first_cart.add_to_cart(self.PROD_1, 1)
+
+            with self.assertRaises(ValidationError):
+                second_cart.add_to_cart(self.PROD_1, 1)
+
+    def test_new_carts_are_reserved_before_the_batch_ends(self):
+        self.make_ceiling("Limit ceiling", limit=1)
+
+        with BatchController.batch(self.USER_1):
+            first_cart = TestingCartController.for_user(self.USER_1)
+            first_cart.add_to_cart(self.PROD_1, 1)
+
+            # The batch hasn't ended, but the stock is already held
+            self.assertIn(first_cart.cart, commerce.Cart.reserved_carts())
+
+            second_cart = TestingCartController.for_user(self.USER_2)
+            with self.assertRaises(ValidationError):
+                second_cart.add_to_cart(self.PROD_1, 1)
+
+    def test_stock_remaining_counts_other_users_carts(self):
+        self.make_ceiling("Limit ceiling", limit=5)
+
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.add_to_cart(self.PROD_1, 2)
+
+        products = [self.PROD_1, self.PROD_3]
+        self.assertEqual(
+            {self.PROD_1.id: 3, self.PROD_3.id: None},
+            ProductController.stock_remaining(self.USER_2, products),
+        )
+        # The user's own cart isn't counted against them
+        self.assertEqual(
+            {self.PROD_1.id: 5, self.PROD_3.id: None},
+            ProductController.stock_remaining(self.USER_1, products),
+        )
+
+    def test_cart_changes_change_availability_version(self):
+        token = version.AVAILABILITY.current()
+
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.add_to_cart(self.PROD_1, 1)
+
+        self.assertNotEqual(token, version.AVAILABILITY.current())
+
+    def test_cart_changes_only_change_their_categories_versions(self):
+        cat_1 = version.category_items(self.CAT_1.id).current()
+        cat_2 = version.category_items(self.CAT_2.id).current()
+
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.add_to_cart(self.PROD_1, 1)
+
+        self.assertNotEqual(
+            cat_1, version.category_items(self.CAT_1.id).current(),
+        )
+        self.assertEqual(
+            cat_2, version.category_items(self.CAT_2.id).current(),
+        )
+
+        # Setting the same quantity again changes nothing
+        cat_1 = version.category_items(self.CAT_1.id).current()
+        current_cart.set_quantity(self.PROD_1, 1)
+        self.assertEqual(
+            cat_1, version.category_items(self.CAT_1.id).current(),
+        )
+
+        # Paying for the cart does
+        current_cart.next_cart()
+        self.assertNotEqual(
+            cat_1, version.category_items(self.CAT_1.id).current(),
+        )
+
+    def test_category_sold_out_when_stock_is_all_reserved(self):
+        self.make_category_ceiling("Limit ceiling", limit=1)
+
+        self.assertFalse(CategoryController._sold_out(self.CAT_1.id))
+
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.add_to_cart(self.PROD_1, 1)
+
+        self.assertTrue(CategoryController._sold_out(self.CAT_1.id))
+        # Categories without stock limits don't sell out
+        self.assertFalse(CategoryController._sold_out(self.CAT_2.id))
+
+        # Once the reservation lapses, the stock is available again
+        self.add_timedelta(self.RESERVATION * 2)
+        self.assertFalse(CategoryController._sold_out(self.CAT_1.id))
+
+    def test_category_sold_out_outside_time_window(self):
+        self.make_category_ceiling(
+            "Date range ceiling",
+            start_time=datetime.datetime(2015, 1, 1, tzinfo=UTC),
+            end_time=datetime.datetime(2015, 2, 1, tzinfo=UTC))
+
+        self.set_time(datetime.datetime(2014, 1, 1, tzinfo=UTC))
+        self.assertTrue(CategoryController._sold_out(self.CAT_1.id))
+
+        self.set_time(datetime.datetime(2015, 1, 15, tzinfo=UTC))
+        self.assertFalse(CategoryController._sold_out(self.CAT_1.id))
@@ -0,0 +1,71 @@
+from registrasion.controllers.checkin import CheckInController
+from registrasion.models import commerce
+from registrasion.models import people
+from registrasion.tests.controller_helpers import TestingCartController
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+class CheckInTestCases(RegistrationCartTestCase):
+
+    def _access_code(self, user):
+        return people.Attendee.get_instance(user).access_code
+
+    def test_paying_updates_the_manifest(self):
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 2)
+        cart.next_cart()
+
+        ctrl = CheckInController.for_access_code(
+            self._access_code(self.USER_1),
+        )
+        items = ctrl.as_dict()["items"]
+        self.assertEqual(1, len(items))
+        self.assertEqual(self.PROD_1.name, items[0]["product"])
+        self.assertEqual(2, items[0]["quantity"])
+
+    def test_releasing_a_cart_updates_the_manifest(self):
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+        cart.next_cart()
+
+        cart.cart.status = commerce.Cart.STATUS_RELEASED
+        cart.cart.save()
+
+        ctrl = CheckInController.for_access_code(
+            self._access_code(self.USER_1),
+        )
+        self.assertEqual([], ctrl.as_dict()["items"])
+
+    def test_attendees_check_in_once(self):
+        CheckInController.update_manifest(self.USER_1)
+        access_code = self._access_code(self.USER_1)
+
+        ctrl = CheckInController.for_access_code(access_code.lower())
+        self.assertTrue(ctrl.check_in())
+        self.assertFalse(ctrl.check_in())
+
+        # Rebuilding the manifest keeps the check-in
+        CheckInController.update_manifest(self.USER_1)
+        ctrl = CheckInController.for_access_code(access_code)
+        self.assertIsNotNone(ctrl.as_dict()["time_checked_in"])
+
+    def test_unknown_access_code(self):
+        self.assertIsNone(CheckInController.for_access_code("ZZZZZZ"))
+
+    def test_loading_fixtures_leaves_manifests_alone(self):
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)
+        cart.next_cart()
+        people.CheckInManifest.objects.all().delete()
+
+        # loaddata saves carts and profiles raw
+        cart.cart.save_base(raw=True)
+        profile = people.AttendeeProfileBase.objects.get(
+            attendee__user=self.USER_1,
+        )
+        profile.save_base(raw=True)
+        self.assertFalse(people.CheckInManifest.objects.exists())
+
+        profile.save()
+        self.assertTrue(people.CheckInManifest.objects.exists())
@@ -0,0 +1,242 @@
+import datetime
+import os
+import sys
+import threading
+import time
+import unittest
+
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Count
+from django.db.models import Sum
+from django.test import TransactionTestCase
+
+from registrasion.controllers.batch import BatchController
+from registrasion.controllers.cart import CartController
+from registrasion.controllers.invoice import InvoiceController
+from registrasion.controllers.product import ProductController
+from registrasion.models import commerce
+from registrasion.models import conditions
+from registrasion.models import inventory
+from registrasion.models import people
+
+from registrasion.tests.patches import ClearCacheMixin
+
+
+STRESS_TEST = os.environ.get("REGISTRASION_STRESS_TEST")
+
+
+@unittest.skipUnless(
+    STRESS_TEST,
+    "Set REGISTRASION_STRESS_TEST to run the concurrency stress tests.",
+)
+class ConcurrencyStressTestCases(ClearCacheMixin, TransactionTestCase):
+    ''' Simulates a ticket launch: many users try to buy scarce stock, with
+    a scarce voucher, at the same time, and we check that none of the limits
+    are exceeded.
+
+    Each user is driven by its own thread, or several threads, with its own
+    database connection, following the same steps as the product category
+    view. These tests need a database that allows concurrent writers, such as
+    PostgreSQL, and are skipped unless REGISTRASION_STRESS_TEST is set.
+    REGISTRASION_STRESS_WORKERS sets the number of users (default 20). '''
+
+    WORKERS = int(os.environ.get("REGISTRASION_STRESS_WORKERS", 20))
+    STOCK = 5
+    VOUCHER_LIMIT = 3
+    VOUCHER_CODE = "LAUNCH"
+
+    def setUp(self):
+        super(ConcurrencyStressTestCases, self).setUp()
+
+        if connection.vendor == "sqlite":
+            self.skipTest("SQLite does not allow concurrent writers.")
+
+        self.category = inventory.Category.objects.create(
+            name="Tickets",
+            description="Conference tickets",
+            order=1,
+            render_type=inventory.Category.RENDER_TYPE_RADIO,
+            required=False,
+        )
+        self.product = inventory.Product.objects.create(
+            name="Ticket",
+            description="A conference ticket",
+            category=self.category,
+            price=Decimal("10.00"),
+            reservation_duration=datetime.timedelta(hours=1),
+            limit_per_user=1,
+            order=1,
+        )
+
+        ceiling = conditions.TimeOrStockLimitFlag.objects.create(
+            description="Ticket stock",
+            condition=conditions.FlagBase.DISABLE_IF_FALSE,
+            limit=self.STOCK,
+        )
+        ceiling.products.add(self.product)
+
+        self.voucher = inventory.Voucher.objects.create(
+            recipient="Launch",
+            code=self.VOUCHER_CODE,
+            limit=self.VOUCHER_LIMIT,
+        )
+
+        self.users = []
+        for i in range(self.WORKERS):
+            user = User.objects.create_user(
+                username="stressuser%d" % i,
+                email="stress%d@example.com" % i,
+                password="top_secret",
+            )
+            attendee = people.Attendee.get_instance(user)
+            people.AttendeeProfileBase.objects.create(attendee=attendee)
+            self.users.append(user)
+
+    def _buy_ticket(self, user):
+        ''' Applies the voucher, reserves a ticket, and generates an
+        invoice for the given user, as a user would at launch. Like the
+        product category view, the available products are worked out in the
+        same batch as the cart is changed. '''
+
+        try:
+            CartController.for_user(user).apply_voucher(self.VOUCHER_CODE)
+        except ValidationError:
+            pass
+
+        with BatchController.batch(user):
+            available = ProductController.available_products(
+                user,
+                category=self.category,
+            )
+            if self.product not in available:
+                return
+
+            cart = CartController.for_user(user)
+            try:
+                cart.set_quantities(((self.product, 1),))
+            except ValidationError:
+                return
+
+        try:
+            InvoiceController.for_cart(cart.cart)
+        except ValidationError:
+            pass
+
+    def _run_workers(self, task, threads_per_user=1):
+        ''' Runs task for every user, in ``threads_per_user`` threads each,
+        all starting at once.
+
+        Returns:
+            (float, [float, ...]): The total elapsed time, and the time taken
+                for each user.
+
+        '''
+
+        start = threading.Event()
+        latencies = []
+        errors = []
+
+        def work(user):
+            start.wait()
+            try:
+                started = time.time()
+                task(user)
+                latencies.append(time.time() - started)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=work, args=(user,))
+            for user in self.users
+            for i in range(threads_per_user)
+        ]
+        for thread in threads:
+            thread.start()
+
+        started = time.time()
+        start.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        self.assertEqual([], errors)
+        return elapsed, latencies
+
+    def _report(self, name, elapsed, latencies):
+        latencies = sorted(latencies)
+
+        def percentile(p):
+            index = int(round(p * (len(latencies) - 1)))
+            return latencies[index] * 1000
+
+        sys.stderr.write(
+            "\n%s: %d users in %.2fs (%.1f/s), p50 %.0fms, p99 %.0fms\n" % (
+                name,
+                len(latencies),
+                elapsed,
+                len(latencies) / elapsed,
+                percentile(0.5),
+                percentile(0.99),
+            )
+        )
+
+    def assert_stock_limit_honoured(self):
+        reserved = commerce.ProductItem.objects.filter(
+            cart__in=commerce.Cart.reserved_carts(),
+            product=self.product,
+        ).aggregate(total=Sum("quantity"))["total"] or 0
+
+        self.assertLessEqual(reserved, self.STOCK)
+
+    def assert_voucher_limit_honoured(self):
+        holders = commerce.Cart.objects.filter(
+            vouchers=self.voucher,
+        ).exclude(
+            status=commerce.Cart.STATUS_RELEASED,
+        ).count()
+
+        self.assertLessEqual(holders, self.VOUCHER_LIMIT)
+
+    def assert_one_active_cart_per_user(self):
+        duplicates = commerce.Cart.objects.filter(
+            status=commerce.Cart.STATUS_ACTIVE,
+        ).values("user").annotate(
+            carts=Count("id"),
+        ).filter(carts__gt=1)
+
+        self.assertEqual([], list(duplicates))
+
+    def test_ticket_launch(self):
+        elapsed, latencies = self._run_workers(self._buy_ticket)
+        self._report("Ticket launch", elapsed, latencies)
+
+        self.assert_stock_limit_honoured()
+        self.assert_voucher_limit_honoured()
+        self.assert_one_active_cart_per_user()
+
+    def test_repeated_purchase_attempts(self):
+        def buy_repeatedly(user):
+            for i in range(3):
+                self._buy_ticket(user)
+
+        elapsed, latencies = self._run_workers(buy_repeatedly)
+        self._report("Repeated attempts", elapsed, latencies)
+
+        self.assert_stock_limit_honoured()
+        self.assert_voucher_limit_honoured()
+        self.assert_one_active_cart_per_user()
+
+    def test_concurrent_requests_from_each_user(self):
+        elapsed, latencies = self._run_workers(
+            self._buy_ticket, threads_per_user=3,
+        )
+        self._report("Concurrent requests", elapsed, latencies)
+
+        self.assert_stock_limit_honoured()
+        self.assert_voucher_limit_honoured()
+        self.assert_one_active_cart_per_user()
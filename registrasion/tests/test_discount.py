@@ -478,3 +478,23 @@ class DiscountTestCase(RegistrationCartTestCase):
             [self.PROD_2],
         )
         self.assertEqual(1, len(discounts))
+
+    def test_discount_usage_counts_paid_items(self):
+        self.add_discount_prod_1_includes_prod_2(quantity=2)
+        cart = TestingCartController.for_user(self.USER_1)
+        cart.add_to_cart(self.PROD_1, 1)  # Enable the discount
+        cart.add_to_cart(self.PROD_2, 1)
+
+        # Items in unpaid carts are not counted
+        self.assertEqual(0, commerce.DiscountUsage.objects.count())
+
+        cart.next_cart()
+
+        usage = commerce.DiscountUsage.objects.get(user=self.USER_1)
+        self.assertEqual(self.PROD_2, usage.product)
+        self.assertEqual(1, usage.quantity)
+
+        cart.cart.status = commerce.Cart.STATUS_RELEASED
+        cart.cart.save()
+
+        self.assertEqual(0, commerce.DiscountUsage.objects.count())
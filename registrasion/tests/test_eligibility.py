@@ -0,0 +1,100 @@
+from decimal import Decimal
+from django.contrib.auth.models import User
+
+from registrasion.controllers.discount import DiscountController
+from registrasion.controllers.eligibility import EligibilityController
+from registrasion.controllers.product import ProductController
+from registrasion.models import conditions
+from registrasion.tests.controller_helpers import TestingCartController
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+class EligibilityTestCases(RegistrationCartTestCase):
+
+    def assert_products_match(self, products):
+        users = User.objects.all()
+        available = EligibilityController(users).available_products(products)
+
+        for user in users:
+            expected = ProductController.available_products(
+                user, products=products,
+            )
+            self.assertEqual(set(expected), set(available[user.id]))
+
+    def test_product_flag_matches_per_user_evaluation(self):
+        flag = conditions.ProductFlag.objects.create(
+            description="Product condition",
+            condition=conditions.FlagBase.ENABLE_IF_TRUE,
+        )
+        flag.products.add(self.PROD_1)
+        flag.enabling_products.add(self.PROD_2)
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_2, 1)
+
+        available = EligibilityController(
+            User.objects.all(),
+        ).available_products(self.products)
+
+        self.assertIn(self.PROD_1, available[self.USER_1.id])
+        self.assertNotIn(self.PROD_1, available[self.USER_2.id])
+        self.assert_products_match(self.products)
+
+    def test_stock_limit_ignores_own_active_cart(self):
+        self.make_ceiling("Limit ceiling", limit=1)
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_1, 1)
+
+        available = EligibilityController(
+            User.objects.all(),
+        ).available_products(self.products)
+
+        self.assertIn(self.PROD_1, available[self.USER_1.id])
+        self.assertNotIn(self.PROD_1, available[self.USER_2.id])
+        self.assert_products_match(self.products)
+
+    def test_per_user_limits_count_paid_items(self):
+        self.PROD_1.limit_per_user = 1
+        self.PROD_1.save()
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_1, 1)
+        cart_1.next_cart()
+
+        self.assert_products_match(self.products)
+
+    def test_discounts_match_per_user_evaluation(self):
+        discount = conditions.IncludedProductDiscount.objects.create(
+            description="PROD_1 includes PROD_2",
+        )
+        discount.enabling_products.add(self.PROD_1)
+        conditions.DiscountForProduct.objects.create(
+            discount=discount,
+            product=self.PROD_2,
+            percentage=Decimal(100),
+            quantity=2,
+        )
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_1, 1)
+        cart_1.add_to_cart(self.PROD_2, 1)
+        cart_1.next_cart()
+
+        users = User.objects.all()
+        available = EligibilityController(users).available_discounts(
+            [], [self.PROD_2],
+        )
+
+        for user in users:
+            expected = DiscountController.available_discounts(
+                user, [], [self.PROD_2],
+            )
+            self.assertEqual(
+                [(i.clause.id, i.quantity) for i in expected],
+                [(i.clause.id, i.quantity) for i in available[user.id]],
+            )
+
+        self.assertEqual(1, available[self.USER_1.id][0].quantity)
+        self.assertEqual([], available[self.USER_2.id])
@@ -1,10 +1,16 @@
 import pytz
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.test.utils import override_settings
 
 from registrasion.models import commerce
 from registrasion.models import conditions
+from registrasion.controllers.batch import BatchController
 from registrasion.controllers.category import CategoryController
+from registrasion.controllers.conditions import ConditionController
+from registrasion.controllers.conditions import IsMetByFilter
+from registrasion.controllers.flag import FlagTable
 from registrasion.tests.controller_helpers import TestingCartController
 from registrasion.tests.controller_helpers import TestingInvoiceController
 from registrasion.controllers.product import ProductController
@@ -14,6 +20,16 @@ from registrasion.tests.test_cart import RegistrationCartTestCase
 UTC = pytz.timezone('UTC')
 
 
+class AlwaysMetController(IsMetByFilter, ConditionController):
+    ''' A condition controller whose conditions are met by everybody. '''
+
+    CACHING = ConditionController.CACHE_STATIC
+
+    @classmethod
+    def pre_filter(cls, queryset, user):
+        return queryset
+
+
 class FlagTestCases(RegistrationCartTestCase):
 
     @classmethod
@@ -394,3 +410,159 @@ class FlagTestCases(RegistrationCartTestCase):
 
         # The following should not fail, as PROD_3 is not affected by flag.
         cart1.add_to_cart(self.PROD_3, 1)
+
+    def test_dif_flag_on_product_and_its_category(self):
+        ''' A flag that covers a product both directly and through its
+        category is only one condition on that product. '''
+
+        flag = conditions.ProductFlag.objects.create(
+            description="Product condition",
+            condition=conditions.FlagBase.DISABLE_IF_FALSE,
+        )
+        flag.products.add(self.PROD_1)
+        flag.categories.add(self.PROD_1.category)
+        flag.enabling_products.add(self.PROD_3)
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        with self.assertRaises(ValidationError):
+            cart_1.add_to_cart(self.PROD_1, 1)
+
+        cart_1.add_to_cart(self.PROD_3, 1)
+        cart_1.add_to_cart(self.PROD_1, 1)
+
+    def test_new_flags_apply_immediately(self):
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_1, 1)
+        cart_1.set_quantity(self.PROD_1, 0)
+
+        self.add_product_flag()
+
+        with self.assertRaises(ValidationError):
+            cart_1.add_to_cart(self.PROD_1, 1)
+
+    @override_settings(CONFIGURATION_MEMO_TIMEOUT=0)
+    def test_flag_table_sees_changes_from_other_processes(self):
+        flag = conditions.ProductFlag.objects.create(
+            description="Product condition",
+            condition=conditions.FlagBase.DISABLE_IF_FALSE,
+        )
+        self.assertNotIn(self.PROD_1.id, FlagTable.get().dif)
+
+        # Bulk creating the relation doesn't send any signals, just as
+        # another process's changes wouldn't be seen by this one
+        ProductThrough = conditions.FlagBase.products.through
+        ProductThrough.objects.bulk_create([
+            ProductThrough(flagbase_id=flag.id, product_id=self.PROD_1.id),
+        ])
+
+        self.assertEqual((flag.id,), FlagTable.get().dif[self.PROD_1.id])
+
+    def test_filtered_conditions_returns_subclasses(self):
+        self.add_product_flag()
+        self.make_ceiling("Limit ceiling", limit=5)
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.add_to_cart(self.PROD_2, 1)
+
+        filtered = ConditionController.filtered_conditions(
+            conditions.FlagBase, self.USER_1,
+        )
+        by_type = dict((type(i), i) for i in filtered)
+
+        self.assertEqual(2, len(filtered))
+        self.assertIn(conditions.ProductFlag, by_type)
+        # Conditions that set a remainder keep their annotation
+        ceiling = by_type[conditions.TimeOrStockLimitFlag]
+        self.assertEqual(5, ceiling.remainder)
+
+        # USER_2 has not met the product flag
+        filtered = ConditionController.filtered_conditions(
+            conditions.FlagBase, self.USER_2,
+        )
+        self.assertEqual(
+            [conditions.TimeOrStockLimitFlag], [type(i) for i in filtered],
+        )
+
+    def test_cart_changes_only_forget_dependent_results(self):
+        self.add_product_flag()
+        self.add_category_flag()
+
+        ConditionController.filtered_conditions(
+            conditions.FlagBase, self.USER_1,
+        )
+
+        key = ConditionController._results_key(self.USER_1)
+        self.assertEqual(2, len(cache.get(key)["flagbase"]))
+
+        # PROD_2 enables the product flag, but not the category flag
+        ConditionController.forget_results(self.USER_1, [self.PROD_2])
+        self.assertEqual(1, len(cache.get(key)["flagbase"]))
+
+        ConditionController.forget_results(self.USER_1)
+        self.assertIsNone(cache.get(key))
+
+    @override_settings(CACHE_SHARED_BETWEEN_PROCESSES=False)
+    def test_unshared_caches_only_keep_results_for_the_batch(self):
+        self.add_product_flag()
+
+        key = ConditionController._results_key(self.USER_1)
+
+        with BatchController.batch(self.USER_1):
+            ConditionController.filtered_conditions(
+                conditions.FlagBase, self.USER_1,
+            )
+            batch = BatchController.get_cache(self.USER_1)
+            self.assertEqual(1, len(batch[key]["flagbase"]))
+
+        self.assertIsNone(cache.get(key))
+
+    def test_rejected_cart_changes_keep_stored_results(self):
+        self.add_product_flag()
+        self.add_category_flag()
+
+        ConditionController.filtered_conditions(
+            conditions.FlagBase, self.USER_1,
+        )
+        key = ConditionController._results_key(self.USER_1)
+
+        # PROD_1 needs PROD_2 in the cart
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        with self.assertRaises(ValidationError):
+            cart_1.add_to_cart(self.PROD_1, 1)
+
+        self.assertEqual(2, len(cache.get(key)["flagbase"]))
+
+    def test_results_stored_after_failed_changes_are_forgotten(self):
+        self.add_product_flag()
+        self.add_category_flag()
+
+        key = ConditionController._results_key(self.USER_1)
+
+        with self.assertRaises(ValueError):
+            with ConditionController.forgetting_on_failure():
+                ConditionController.forget_results(
+                    self.USER_1, [self.PROD_2],
+                )
+                ConditionController.filtered_conditions(
+                    conditions.FlagBase, self.USER_1,
+                )
+                raise ValueError()
+
+        # Only the result that depends on PROD_2 is forgotten
+        self.assertEqual(1, len(cache.get(key)["flagbase"]))
+
+    def test_registered_controller_evaluates_its_type(self):
+        self.add_product_flag()
+
+        original = ConditionController.for_type(conditions.ProductFlag)
+        ConditionController.register(
+            conditions.ProductFlag, AlwaysMetController,
+        )
+        try:
+            available = ProductController.available_products(
+                self.USER_1, products=[self.PROD_1],
+            )
+        finally:
+            ConditionController.register(conditions.ProductFlag, original)
+
+        self.assertEqual([self.PROD_1], available)
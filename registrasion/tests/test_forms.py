@@ -0,0 +1,27 @@
+from registrasion import forms
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+class ProductsFormTestCases(RegistrationCartTestCase):
+
+    def test_products_form_classes_are_reused(self):
+        products = [self.PROD_2, self.PROD_1]
+        form_class = forms.ProductsForm(self.CAT_1, products)
+
+        # Product order doesn't matter
+        self.assertIs(
+            form_class,
+            forms.ProductsForm(self.CAT_1, [self.PROD_1, self.PROD_2]),
+        )
+        self.assertIsNot(form_class, forms.ProductsForm(self.CAT_1, [
+            self.PROD_1,
+        ]))
+
+        # Changing the inventory rebuilds the classes
+        self.PROD_1.name = "Renamed product"
+        self.PROD_1.save()
+
+        self.assertIsNot(
+            form_class, forms.ProductsForm(self.CAT_1, products),
+        )
@@ -66,3 +66,21 @@ class GroupMemberTestCase(RegistrationCartTestCase):
                 products=[product],
             )
             self.assertNotIn(product, available)
+
+    def test_leaving_group_disables_product(self):
+        self._create_group_and_flag()
+
+        self.USER_1.groups.add(self.GROUP_1)
+        available = ProductController.available_products(
+            self.USER_1,
+            products=[self.PROD_1],
+        )
+        self.assertIn(self.PROD_1, available)
+
+        # Membership changes from the group's side are noticed too
+        self.GROUP_1.user_set.remove(self.USER_1)
+        available = ProductController.available_products(
+            self.USER_1,
+            products=[self.PROD_1],
+        )
+        self.assertNotIn(self.PROD_1, available)
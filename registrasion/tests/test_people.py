@@ -0,0 +1,24 @@
+from registrasion.models import people
+
+from registrasion.tests.test_cart import RegistrationCartTestCase
+
+
+class AttendeeProfileTestCases(RegistrationCartTestCase):
+
+    def test_profile_subclasses_are_resolved_together(self):
+        profiles = list(people.AttendeeProfileBase.objects.filter(
+            attendee__user__in=[self.USER_1, self.USER_2],
+        ).order_by("id"))
+
+        with self.assertNumQueries(1):
+            resolved = people.AttendeeProfileBase.resolve_subclasses(profiles)
+
+        self.assertEqual(
+            [profile.id for profile in profiles],
+            [profile.id for profile in resolved],
+        )
+
+        # The subclass instances are remembered
+        with self.assertNumQueries(0):
+            for profile in profiles:
+                profile.subclass_instance()
@@ -1,6 +1,9 @@
 import pytz
 
+from django.contrib.auth.models import User
+
 from registrasion.models import conditions
+from registrasion.controllers.conditions import SpeakerConditionController
 from registrasion.controllers.product import ProductController
 
 from symposion.conference import models as conference_models
@@ -229,3 +232,25 @@ class SpeakerTestCase(RegistrationCartTestCase):
             products=[self.PROD_1],
         )
         self.assertNotIn(self.PROD_1, available_after_cancelled)
+
+    def test_speaker_index_is_used_for_non_speakers(self):
+        self._create_proposals()
+        self._create_flag_for_primary_speaker()
+        promote_proposal(self.PROPOSAL_1)
+
+        user_3 = User.objects.create_user(
+            username='testuser3',
+            email='test3@example.com',
+            password='top_secret',
+        )
+
+        # Build the index of speakers
+        SpeakerConditionController._speakers()
+
+        flags = conditions.SpeakerFlag.objects.all()
+        with self.assertNumQueries(0):
+            filtered = SpeakerConditionController.pre_filter(flags, user_3)
+            self.assertEqual([], list(filtered))
+
+        filtered = SpeakerConditionController.pre_filter(flags, self.USER_1)
+        self.assertEqual(1, len(filtered))
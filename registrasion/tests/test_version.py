@@ -0,0 +1,87 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from registrasion import checks
+from registrasion.controllers import version
+from registrasion.controllers.batch import BatchController
+
+
+LOCAL_CACHE = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+
+SHARED_CACHE = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.memcached.MemcachedCache",
+        "LOCATION": "127.0.0.1:11211",
+    },
+}
+
+
+@override_settings(CACHE_SHARED_BETWEEN_PROCESSES=True)
+class ConfigurationVersionTestCases(TestCase):
+
+    def setUp(self):
+        self.version = version.ConfigurationVersion("test")
+        self.calls = 0
+
+        @self.version.memoise
+        def counted():
+            self.calls += 1
+
+        self.counted = counted
+
+    def test_results_are_memoised_until_the_version_changes(self):
+        self.counted()
+        self.counted()
+        self.assertEqual(1, self.calls)
+
+        self.version.increment()
+        self.counted()
+        self.assertEqual(2, self.calls)
+
+    @override_settings(CONFIGURATION_MEMO_TIMEOUT=0)
+    def test_results_expire_after_the_memo_timeout(self):
+        self.counted()
+        self.counted()
+        self.assertEqual(2, self.calls)
+
+    def test_results_for_old_versions_are_discarded(self):
+        self.counted()
+        self.version.increment()
+        self.counted()
+        self.assertEqual(1, len(self.version._memos))
+
+    @override_settings(CACHE_SHARED_BETWEEN_PROCESSES=False)
+    def test_unshared_caches_only_keep_results_for_the_batch(self):
+        user = User.objects.create_user(username="testuser")
+
+        with BatchController.batch(user):
+            self.counted()
+            self.counted()
+        self.assertEqual(1, self.calls)
+
+        # Outside of a batch, nothing is kept
+        self.counted()
+        self.counted()
+        self.assertEqual(3, self.calls)
+        self.assertEqual({}, self.version._memos)
+
+
+class CacheBackendCheckTestCases(TestCase):
+
+    @override_settings(CACHES=LOCAL_CACHE)
+    def test_process_local_cache_warns(self):
+        warnings = checks.check_cache_backend(None)
+        self.assertEqual(["registrasion.W001"], [i.id for i in warnings])
+
+    @override_settings(CACHES=SHARED_CACHE)
+    def test_shared_cache_does_not_warn(self):
+        self.assertEqual([], checks.check_cache_backend(None))
+
+    @override_settings(CACHES=LOCAL_CACHE, CACHE_SHARED_BETWEEN_PROCESSES=True)
+    def test_single_process_sites_can_share_the_local_cache(self):
+        self.assertEqual([], checks.check_cache_backend(None))
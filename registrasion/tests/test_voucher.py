@@ -2,10 +2,13 @@ import datetime
 import pytz
 
 from decimal import Decimal
+from io import BytesIO
+from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.db import transaction
 
+from registrasion.controllers.voucher import VoucherController
 from registrasion.models import conditions
 from registrasion.models import inventory
 from registrasion.tests.controller_helpers import TestingCartController
@@ -158,3 +161,208 @@ class VoucherTestCases(RegistrationCartTestCase):
 
         current_cart.fix_simple_errors()
         self.assertEqual(1, current_cart.cart.vouchers.count())
+
+    def test_voucher_counter_counts_claims(self):
+        voucher = self.new_voucher(limit=2)
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.apply_voucher(voucher.code)
+        self.assertEqual(1, voucher.vouchercounter.claims)
+
+        cart_2 = TestingCartController.for_user(self.USER_2)
+        cart_2.apply_voucher(voucher.code)
+        voucher.vouchercounter.refresh_from_db()
+        self.assertEqual(2, voucher.vouchercounter.claims)
+
+    def test_voucher_counter_forgets_expired_claims(self):
+        voucher = self.new_voucher()
+
+        self.set_time(datetime.datetime(2015, 1, 1, tzinfo=UTC))
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.apply_voucher(voucher.code)
+
+        self.add_timedelta(inventory.Voucher.RESERVATION_DURATION * 2)
+
+        # The counter is exhausted, but user 1's claim has expired
+        cart_2 = TestingCartController.for_user(self.USER_2)
+        cart_2.apply_voucher(voucher.code)
+
+        voucher.vouchercounter.refresh_from_db()
+        self.assertEqual(1, voucher.vouchercounter.claims)
+
+    def test_revived_carts_claim_their_vouchers_again(self):
+        voucher = self.new_voucher(limit=2)
+        user_3 = User.objects.create_user(username="testuser3")
+        user_4 = User.objects.create_user(username="testuser4")
+
+        self.set_time(datetime.datetime(2015, 1, 1, tzinfo=UTC))
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.apply_voucher(voucher.code)
+        cart_2 = TestingCartController.for_user(self.USER_2)
+        cart_2.apply_voucher(voucher.code)
+
+        # User 1's claim expires, and is forgotten when user 3 claims
+        self.add_timedelta(inventory.Voucher.RESERVATION_DURATION * 2)
+        cart_3 = TestingCartController.for_user(user_3)
+        cart_3.apply_voucher(voucher.code)
+
+        # User 2 gives up the voucher, so the claims are counted again
+        cart_2.cart.vouchers.remove(voucher)
+        VoucherController(voucher).release()
+
+        # User 1's cart is revived, and claims the voucher again
+        cart_1.add_to_cart(self.PROD_1, 1)
+        cart_1.validate_cart()
+
+        cart_4 = TestingCartController.for_user(user_4)
+        with self.assertRaises(ValidationError):
+            cart_4.apply_voucher(voucher.code)
+
+    def test_revived_carts_lose_vouchers_claimed_by_others(self):
+        voucher = self.new_voucher(limit=1)
+
+        self.set_time(datetime.datetime(2015, 1, 1, tzinfo=UTC))
+
+        cart_1 = TestingCartController.for_user(self.USER_1)
+        cart_1.apply_voucher(voucher.code)
+
+        # User 1's claim expires, and user 2 takes the voucher
+        self.add_timedelta(inventory.Voucher.RESERVATION_DURATION * 2)
+        cart_2 = TestingCartController.for_user(self.USER_2)
+        cart_2.apply_voucher(voucher.code)
+
+        # User 1's cart is revived, but can't claim the voucher again
+        cart_1.add_to_cart(self.PROD_1, 1)
+        self.assertNotIn(voucher, cart_1.cart.vouchers.all())
+        cart_1.validate_cart()
+        cart_2.validate_cart()
+
+    def test_refund_recounts_voucher_claims(self):
+        voucher = self.new_voucher()
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.apply_voucher(voucher.code)
+        current_cart.add_to_cart(self.PROD_1, 1)
+
+        inv = TestingInvoiceController.for_cart(current_cart.cart)
+        if not inv.invoice.is_paid:
+            inv.pay("Hello!", inv.invoice.value)
+
+        inv.refund()
+
+        voucher.vouchercounter.refresh_from_db()
+        self.assertEqual(0, voucher.vouchercounter.claims)
+
+    def test_generate_codes_avoids_existing_codes(self):
+        codes = VoucherController.generate_codes(20, length=4, prefix="abc")
+        self.assertEqual(20, len(set(codes)))
+        for code in codes:
+            self.assertTrue(code.startswith("ABC"))
+            self.assertEqual(7, len(code))
+
+        VoucherController.bulk_create("Sponsor", codes)
+        more_codes = VoucherController.generate_codes(
+            20, length=4, prefix="ABC",
+        )
+        self.assertFalse(set(codes) & set(more_codes))
+
+    def test_generate_codes_fails_when_there_are_too_few_codes(self):
+        # There are 35 one-character codes
+        codes = VoucherController.generate_codes(35, length=1, prefix="X")
+        self.assertEqual(35, len(codes))
+
+        VoucherController.bulk_create("Sponsor", codes[:1])
+        with self.assertRaises(ValueError):
+            VoucherController.generate_codes(35, length=1, prefix="X")
+
+    def test_bulk_create_copies_voucher_conditions(self):
+        like = self.new_voucher(code="TEMPLATE")
+        discount = conditions.VoucherDiscount.objects.create(
+            description="Sponsor discount",
+            voucher=like,
+        )
+        conditions.DiscountForProduct.objects.create(
+            discount=discount,
+            product=self.PROD_1,
+            percentage=Decimal(100),
+            quantity=1,
+        )
+        flag = conditions.VoucherFlag.objects.create(
+            description="Sponsor flag",
+            voucher=like,
+            condition=conditions.FlagBase.ENABLE_IF_TRUE,
+        )
+        flag.products.add(self.PROD_1)
+
+        vouchers = VoucherController.bulk_create(
+            "Sponsor", ["one", "two"], like=like,
+        )
+        self.assertEqual(["ONE", "TWO"], [i.code for i in vouchers])
+
+        # Each new voucher enables and discounts PROD_1 on its own
+        current_cart = TestingCartController.for_user(self.USER_1)
+        current_cart.apply_voucher("one")
+        current_cart.add_to_cart(self.PROD_1, 1)
+        self.assertEqual(1, len(current_cart.cart.discountitem_set.all()))
+
+        # The copies keep the original descriptions
+        self.assertEqual(
+            ["Sponsor discount"] * 3,
+            [i.description for i in conditions.VoucherDiscount.objects.all()],
+        )
+        self.assertEqual(
+            ["Sponsor flag"] * 3,
+            [i.description for i in conditions.VoucherFlag.objects.all()],
+        )
+
+    def test_bulk_create_reports_every_unusable_code(self):
+        self.new_voucher(code="USED")
+
+        codes = ["GOOD", "used", "x" * 17, "good", ""]
+        self.assertEqual(
+            [1, 2, 3, 4],
+            [i for i, message in VoucherController.code_errors(codes)],
+        )
+
+        with self.assertRaises(ValueError):
+            VoucherController.bulk_create("Sponsor", codes)
+        self.assertFalse(VoucherController.code_exists("GOOD"))
+
+    def test_write_csv_encodes_recipients_as_utf8(self):
+        vouchers = VoucherController.bulk_create(u"Caf\xe9", ["CAFE"])
+
+        outfile = BytesIO()
+        VoucherController.write_csv(vouchers, outfile)
+        self.assertIn(u"Caf\xe9".encode("utf8"), outfile.getvalue())
+
+    def test_unknown_voucher_code_is_rejected(self):
+        self.new_voucher(code="VOUCHER")
+
+        current_cart = TestingCartController.for_user(self.USER_1)
+        with self.assertRaises(ValidationError):
+            current_cart.apply_voucher("NOTAVOUCHER")
+
+    def test_code_exists_sees_new_vouchers(self):
+        self.assertFalse(VoucherController.code_exists("voucher"))
+
+        self.new_voucher(code="VOUCHER")
+        self.assertTrue(VoucherController.code_exists("voucher"))
+
+        VoucherController.bulk_create("Sponsor", ["BULK"])
+        self.assertTrue(VoucherController.code_exists("BULK"))
+
+    def test_failed_attempts_are_throttled(self):
+        sources = ["user-1", "address-127.0.0.1"]
+
+        for i in range(VoucherController.ATTEMPT_LIMIT - 1):
+            VoucherController.record_failed_attempt(sources)
+        self.assertFalse(VoucherController.attempts_exceeded(sources))
+
+        VoucherController.record_failed_attempt(sources)
+        self.assertTrue(VoucherController.attempts_exceeded(sources))
+
+        # Other users at other addresses are unaffected
+        self.assertFalse(
+            VoucherController.attempts_exceeded(["user-2", "address-::1"])
+        )
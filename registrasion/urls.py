@@ -4,9 +4,14 @@ from django.conf.urls import include
 from django.conf.urls import url
 
 from .views import (
+    admission_status,
     amend_registration,
+    availability_updates,
     badge,
     badges,
+    badges_archive,
+    check_in,
+    check_in_export,
     checkout,
     credit_note,
     edit_profile,
@@ -24,10 +29,16 @@ from .views import (
 
 
 public = [
+    url(r"^admission$", admission_status, name="admission_status"),
     url(r"^amend/([0-9]+)$", amend_registration, name="amend_registration"),
+    url(r"^availability/([0-9]+)$", availability_updates,
+        name="availability_updates"),
     url(r"^badge/([0-9]+)$", badge, name="badge"),
     url(r"^badges$", badges, name="badges"),
+    url(r"^badges/archive$", badges_archive, name="badges_archive"),
     url(r"^category/([0-9]+)$", product_category, name="product_category"),
+    url(r"^checkin/export$", check_in_export, name="check_in_export"),
+    url(r"^checkin/([A-Za-z0-9]+)$", check_in, name="check_in"),
     url(r"^checkout$", checkout, name="checkout"),
     url(r"^checkout/([0-9]+)$", checkout, name="checkout"),
     url(r"^credit_note/([0-9]+)$", credit_note, name="credit_note"),
@@ -69,6 +80,11 @@ reports = [
         rv.paid_invoices_by_date,
         name="paid_invoices_by_date"
     ),
+    url(
+        r"^product_availability/?$",
+        rv.product_availability,
+        name="product_availability",
+    ),
     url(r"^product_status/?$", rv.product_status, name="product_status"),
     url(r"^reconciliation/?$", rv.reconciliation, name="reconciliation"),
     url(
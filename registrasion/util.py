@@ -17,6 +17,20 @@ def generate_access_code():
     return get_random_string(length=length, allowed_chars=chars)
 
 
+# upper-case letters + digits 1-9 (no 0 vs O confusion)
+VOUCHER_CODE_CHARS = string.ascii_uppercase + string.digits[1:]
+
+
+def generate_voucher_code(length=8, prefix=""):
+    ''' Generates a random voucher code, made up of ``prefix``, followed by
+    ``length`` upper-case letters and digits (excluding 0, so that it can't be
+    confused with O). '''
+
+    return prefix + get_random_string(
+        length=length, allowed_chars=VOUCHER_CODE_CHARS,
+    )
+
+
 def all_arguments_optional(ntcls):
     ''' Takes a namedtuple derivative and makes all of the arguments optional.
     '''
@@ -1,21 +1,29 @@
 import datetime
-import zipfile
+import functools
+import hashlib
+import tempfile
 
 from . import forms
 from . import util
 from .models import commerce
 from .models import inventory
 from .models import people
+from .contrib import badges as badges_contrib
+from .controllers.admission import AdmissionController
 from .controllers.batch import BatchController
 from .controllers.cart import CartController
 from .controllers.category import CategoryController
+from .controllers.checkin import CheckInController
 from .controllers.credit_note import CreditNoteController
 from .controllers.discount import DiscountController
 from .controllers.invoice import InvoiceController
 from .controllers.item import ItemController
 from .controllers.product import ProductController
+from .controllers import version
+from .controllers.voucher import VoucherController
 from .exceptions import CartValidationError
 
+from collections import defaultdict
 from collections import namedtuple
 
 from django import forms as django_forms
@@ -27,10 +35,16 @@ from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mass_mail
+from django.http import FileResponse
 from django.http import Http404, HttpResponse
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from django.shortcuts import render
-from django.template import Context, Template, loader
+from django.db.models import Sum
+from django.template import Context, Template
+from django.utils import timezone
+from django.views.decorators.http import etag
 
 
 _GuidedRegistrationSection = namedtuple(
@@ -64,7 +78,153 @@ class GuidedRegistrationSection(_GuidedRegistrationSection):
     pass
 
 
+def _make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def registration_etag(request, *a, **k):
+    ''' Returns an ETag for a page that shows the user's carts, and what
+    is available to them. It changes whenever any of the user's carts, their
+    unclaimed credit notes, the inventory, or the stock held in anybody's cart
+    changes, and at least once a minute so that lapsed reservations are
+    noticed. Pages with messages waiting to be shown are never given an ETag.
+
+    Use this with ``django.views.decorators.http.etag`` on your dashboard
+    view, or any other view that uses the Registrasion template tags, so
+    that repeat views can be answered with 304 Not Modified without
+    evaluating any conditions.
+
+    '''
+
+    if request.method not in ("GET", "HEAD"):
+        return None
+    if not request.user.is_authenticated():
+        return None
+    if len(messages.get_messages(request)):
+        # The messages would be left unshown, and shown on some later page
+        return None
+
+    carts = commerce.Cart.objects.filter(
+        user=request.user,
+    ).order_by("id").values_list("id", "revision", "status")
+
+    credit_notes = commerce.CreditNote.unclaimed().filter(
+        invoice__user=request.user,
+    ).order_by("id").values_list("id", flat=True)
+
+    return _make_etag(
+        request.user.id,
+        request.path,
+        list(carts),
+        list(credit_notes),
+        version.AVAILABILITY.current(),
+        timezone.now().strftime("%Y%m%d%H%M"),
+    )
+
+
+def _invoice_etag(request, invoice_id, access_code=None):
+    ''' Returns an ETag for an invoice page, which changes when the
+    invoice's status, the amount paid, its cart, or the inventory changes.
+
+    Unpaid invoices whose cart's reservation has lapsed are not given an
+    ETag, so that the invoice view can check whether they are still valid.
+    '''
+
+    if request.method not in ("GET", "HEAD"):
+        return None
+
+    invoice = commerce.Invoice.objects.filter(
+        pk=invoice_id,
+    ).select_related(
+        "cart",
+    ).annotate(
+        paid=Sum("paymentbase__amount"),
+    ).first()
+
+    if invoice is None:
+        return None
+
+    cart = invoice.cart
+    if cart is None:
+        cart_state = None
+    else:
+        expiry = cart.time_last_updated + cart.reservation_duration
+        if invoice.is_unpaid and expiry <= timezone.now():
+            return None
+        cart_state = (cart.revision, cart.status, expiry)
+
+    return _make_etag(
+        request.user.id,
+        request.path,
+        invoice.status,
+        invoice.paid,
+        cart_state,
+        version.INVENTORY.current(),
+    )
+
+
+def _admission_required(view):
+    ''' Decorator that shows the waiting room instead of the view if the
+    user has not been admitted to the registration pages yet. Apply it
+    inside ``login_required``. '''
+
+    @functools.wraps(view)
+    def inner(request, *a, **k):
+        if AdmissionController.bypasses_queue(request.user):
+            return view(request, *a, **k)
+
+        ctrl = AdmissionController.for_user(request.user)
+        if ctrl.is_admitted():
+            return view(request, *a, **k)
+
+        return _waiting_room(request, ctrl)
+
+    return inner
+
+
+def _waiting_room(request, ctrl):
+    ''' Renders ``registrasion/waiting_room.html``, with data::
+
+        {
+            "position": int(),  # The user's position in the queue
+        }
+
+    '''
+
+    data = {
+        "position": ctrl.position(),
+    }
+
+    return render(request, "registrasion/waiting_room.html", data)
+
+
 @login_required
+def admission_status(request):
+    ''' Reports the user's place in the queue for the registration pages.
+    This is cheap enough to be polled from the waiting room.
+
+    Returns:
+        JsonResponse: with data::
+
+            {
+                "admitted": bool(), # True if the user may use the pages now
+                "position": int(),  # The user's position in the queue, or 0
+                                    # if they have been admitted
+            }
+
+    '''
+
+    if AdmissionController.bypasses_queue(request.user):
+        data = {"admitted": True, "position": 0}
+    else:
+        ctrl = AdmissionController.for_user(request.user)
+        data = {"admitted": ctrl.is_admitted(), "position": ctrl.position()}
+
+    return JsonResponse(data)
+
+
+@login_required
+@_admission_required
 def guided_registration(request, page_number=None):
     ''' Goes through the registration process in order, making sure user sees
     all valid categories.
@@ -263,7 +423,26 @@ def _guided_registration_products(request, mode):
         if len(available_products) == 0:
             return []
 
-        has_errors = False
+        # Load the user's items and discounts for every category at once,
+        # rather than once per category.
+        current_cart = CartController.for_user(request.user)
+        items = commerce.ProductItem.objects.filter(
+            product__in=available_products,
+            cart=current_cart.cart,
+        ).select_related("product")
+
+        items_by_category = defaultdict(list)
+        for item in items:
+            items_by_category[item.product.category_id].append(item)
+
+        all_discounts = util.lazy(
+            DiscountController.available_discounts,
+            request.user,
+            [],
+            available_products,
+        )
+
+        submitted = []
 
         for category in cats:
             products = [
@@ -272,8 +451,26 @@ def _guided_registration_products(request, mode):
             ]
 
             prefix = "category_" + str(category.id)
-            p = _handle_products(request, category, products, prefix)
-            products_form, discounts, products_handled = p
+            products_form = _products_form(
+                request,
+                category,
+                products,
+                prefix,
+                items_by_category[category.id],
+            )
+
+            if request.method == "POST" and products_form.is_valid():
+                submitted.append((category, products_form))
+
+            # Making this a function to lazily evaluate when it's displayed
+            # in templates.
+            discounts = util.lazy(
+                lambda category, products: _discounts_for_category(
+                    all_discounts(), category, products,
+                ),
+                category,
+                products,
+            )
 
             section = GuidedRegistrationSection(
                 title=category.name,
@@ -287,6 +484,8 @@ def _guided_registration_products(request, mode):
                 sections.append(section)
                 seen_categories.append(category)
 
+        _require_held_categories(request.user, submitted)
+
     # Update the cache with the newly calculated values
     cat_ids = [cat.id for cat in seen_categories]
     request.session[SESSION_KEY] = {MODE_KEY: mode, CATS_KEY: cat_ids}
@@ -313,6 +512,7 @@ def _guided_registration_profile_and_voucher(request):
 
 
 @login_required
+@etag(registration_etag)
 def review(request):
     ''' View for the review page. '''
 
@@ -409,6 +609,8 @@ def _handle_profile(request, prefix):
 
 
 @login_required
+@_admission_required
+@etag(registration_etag)
 def product_category(request, category_id):
     ''' Form for selecting products from an individual product category.
 
@@ -430,6 +632,10 @@ def product_category(request, category_id):
                                                   # products
                     "voucher_form": voucher_form, # A form for entering a
                                                   # voucher code
+                    "availability_updates_interval": int(), # How often, in
+                                                  # seconds, to poll
+                                                  # ``availability_updates``,
+                                                  # or None
                 }
 
     '''
@@ -479,11 +685,134 @@ def product_category(request, category_id):
         "discounts": discounts,
         "form": products_form,
         "voucher_form": voucher_form,
+        "availability_updates_interval": _availability_updates_interval(),
     }
 
     return render(request, "registrasion/product_category.html", data)
 
 
+def _availability_updates_interval():
+    return getattr(settings, "AVAILABILITY_UPDATES_INTERVAL", None)
+
+
+def _availability_version(user, category):
+    ''' Returns a token that changes whenever something happens that could
+    change the availability of the category's products for the user. Working
+    this out doesn't touch the availability of the products themselves. '''
+
+    cart = commerce.Cart.objects.filter(
+        user=user,
+        status=commerce.Cart.STATUS_ACTIVE,
+    ).values_list("id", "revision").first()
+
+    return _make_etag(
+        version.INVENTORY.current(),
+        version.category_items(category.id).current(),
+        cart,
+        # Lapsed reservations don't change anything, so notice them this way
+        timezone.now().strftime("%Y%m%d%H%M"),
+    )
+
+
+@login_required
+def availability_updates(request, category_id):
+    ''' Reports changes to the availability of the products in a category,
+    so that pages can tell users about them without being reloaded. This
+    answers straight away, so poll it, backing off while nothing changes.
+    It is only available if the ``AVAILABILITY_UPDATES_INTERVAL`` setting
+    (the number of seconds between polls) is set.
+
+    If the query string contains ``version`` and ``state``, as returned by an
+    earlier call, availability is only worked out again if items from this
+    category, the inventory, or the user's cart have changed since (or a
+    minute has passed, in case reservations have lapsed), and
+    ``changed`` is only true if the availability of this category is
+    different to ``state``. Without them, the current availability is always
+    returned.
+
+    Arguments:
+        category_id (castable to int): The id of the category to watch.
+
+    Returns:
+        JsonResponse: with data::
+
+            {
+                "version": str(),      # Pass these back with the next poll
+                "state": str(),
+                "changed": bool(),     # False if nothing in this category
+                                       # changed; nothing else is sent.
+                "products": {          # The available products, by ID
+                    str(id): {
+                        "stock": int(),  # The remaining stock, or None if
+                                         # it's not limited
+                    },
+                },
+                "reservation_expires": str(), # When the user's current cart
+                                              # reservation expires (ISO
+                                              # 8601), or None
+            }
+
+    '''
+
+    if _availability_updates_interval() is None:
+        raise Http404()
+
+    category = get_object_or_404(inventory.Category, pk=int(category_id))
+
+    since = request.GET.get("version")
+    seen_state = request.GET.get("state")
+
+    token = _availability_version(request.user, category)
+    if seen_state is not None and token == since:
+        return JsonResponse({
+            "version": token,
+            "state": seen_state,
+            "changed": False,
+        })
+
+    with BatchController.batch(request.user):
+        products = ProductController.available_products(
+            request.user,
+            category=category,
+        )
+        stock = ProductController.stock_remaining(request.user, products)
+
+    try:
+        cart = commerce.Cart.objects.get(
+            user=request.user,
+            status=commerce.Cart.STATUS_ACTIVE,
+        )
+        expires = cart.time_last_updated + cart.reservation_duration
+        expires = expires.isoformat()
+    except ObjectDoesNotExist:
+        expires = None
+
+    available = dict(
+        (str(product.id), {"stock": stock[product.id]})
+        for product in products
+    )
+    state = _make_etag(sorted(available.items()), expires)
+
+    # Most changes to the version are to stock that this user can't see the
+    # difference in.
+    if state == seen_state:
+        return JsonResponse({
+            "version": token,
+            "state": state,
+            "changed": False,
+        })
+
+    data = {
+        "version": token,
+        "state": state,
+        "changed": True,
+        "products": available,
+        "reservation_expires": expires,
+    }
+
+    return JsonResponse(data)
+
+
 def voucher_code(request):
     ''' A view *just* for entering a voucher form. '''
 
@@ -513,13 +842,42 @@ def _handle_products(request, category, products, prefix):
 
     current_cart = CartController.for_user(request.user)
 
-    ProductsForm = forms.ProductsForm(category, products)
-
     # Create initial data for each of products in category
     items = commerce.ProductItem.objects.filter(
         product__in=products,
         cart=current_cart.cart,
     ).select_related("product")
+
+    products_form = _products_form(request, category, products, prefix, items)
+
+    if request.method == "POST" and products_form.is_valid():
+        _require_held_categories(request.user, [(category, products_form)])
+
+    handled = False if products_form.errors else True
+
+    # Making this a function to lazily evaluate when it's displayed
+    # in templates.
+
+    discounts = util.lazy(
+        DiscountController.available_discounts,
+        request.user,
+        [],
+        products,
+    )
+
+    return products_form, discounts, handled
+
+
+def _products_form(request, category, products, prefix, items):
+    ''' Makes the products form for the given category, with initial
+    quantities from ``items``, the user's ProductItems for those products in
+    their current cart. If the form has been submitted and is valid, the
+    quantities are set in the user's cart. '''
+
+    current_cart = CartController.for_user(request.user)
+
+    ProductsForm = forms.ProductsForm(category, products)
+
     quantities = []
     seen = set()
 
@@ -541,32 +899,46 @@ def _handle_products(request, category, products, prefix):
         if products_form.has_changed():
             _set_quantities_from_products_form(products_form, current_cart)
 
-        # If category is required, the user must have at least one
-        # in an active+valid cart
-        if category.required:
-            carts = commerce.Cart.objects.filter(user=request.user)
-            items = commerce.ProductItem.objects.filter(
-                product__category=category,
-                cart=carts,
+    return products_form
+
+
+def _require_held_categories(user, categories_and_forms):
+    ''' Adds an error to the form for each required category that the
+    user does not have any items from, in any of their carts. '''
+
+    required = [
+        category for category, form in categories_and_forms
+        if category.required
+    ]
+    if not required:
+        return
+
+    held = set(commerce.ProductItem.objects.filter(
+        cart__user=user,
+        product__category__in=required,
+    ).values_list("product__category", flat=True))
+
+    for category, products_form in categories_and_forms:
+        if category.required and category.id not in held:
+            products_form.add_error(
+                None,
+                "You must have at least one item from this category",
             )
-            if len(items) == 0:
-                products_form.add_error(
-                    None,
-                    "You must have at least one item from this category",
-                )
-    handled = False if products_form.errors else True
 
-    # Making this a function to lazily evaluate when it's displayed
-    # in templates.
 
-    discounts = util.lazy(
-        DiscountController.available_discounts,
-        request.user,
-        [],
-        products,
-    )
+def _discounts_for_category(discounts, category, products):
+    ''' Returns the discounts from ``discounts`` that apply to the given
+    category or products. '''
 
-    return products_form, discounts, handled
+    if not products:
+        return []
+
+    products = set(products)
+    return [
+        discount for discount in discounts
+        if getattr(discount.clause, "product", None) in products or
+        getattr(discount.clause, "category", None) == category
+    ]
 
 
 def _set_quantities_from_products_form(products_form, current_cart):
@@ -609,7 +981,22 @@ def _handle_voucher(request, prefix):
         voucher = voucher_form.cleaned_data["voucher"]
         voucher = inventory.Voucher.normalise_code(voucher)
 
-        if len(current_cart.cart.vouchers.filter(code=voucher)) > 0:
+        sources = _voucher_attempt_sources(request)
+
+        if VoucherController.attempts_exceeded(sources):
+            voucher_form.add_error(
+                "voucher",
+                "Too many invalid voucher codes have been entered. "
+                "Please try again later.",
+            )
+            handled = True
+        elif not VoucherController.code_exists(voucher):
+            VoucherController.record_failed_attempt(sources)
+            voucher_form.add_error(
+                "voucher", "%s is not a valid voucher code." % voucher,
+            )
+            handled = True
+        elif len(current_cart.cart.vouchers.filter(code=voucher)) > 0:
             # This voucher has already been applied to this cart.
             # Do not apply code
             handled = False
@@ -625,6 +1012,22 @@ def _handle_voucher(request, prefix):
     return (voucher_form, handled)
 
 
+def _voucher_attempt_sources(request):
+    ''' Returns the strings that identify where a voucher code was entered
+    from, for throttling invalid attempts. Attempts are counted against the
+    user, and also against their IP address if ``VOUCHER_ATTEMPT_BY_ADDRESS``
+    is set. Leave that unset if your users may share an address, e.g. behind
+    a reverse proxy, or one user's typos could block voucher entry for
+    everyone. '''
+
+    sources = ["user-%s" % request.user.id]
+
+    if getattr(settings, "VOUCHER_ATTEMPT_BY_ADDRESS", False):
+        sources.append("address-%s" % request.META.get("REMOTE_ADDR", ""))
+
+    return sources
+
+
 @login_required
 def checkout(request, user_id=None):
     ''' Runs the checkout process for the current cart.
@@ -730,6 +1133,7 @@ def invoice_access(request, access_code):
     return redirect("invoice", invoice.id, access_code)
 
 
+@etag(_invoice_etag)
 def invoice(request, invoice_id, access_code=None):
     ''' Displays an invoice.
 
@@ -1084,7 +1488,7 @@ def badge(request, user_id):
     user_id = int(user_id)
     user = User.objects.get(pk=user_id)
 
-    rendered = render_badge(user)
+    rendered = badges_contrib.cached_badge(user)
     response = HttpResponse(rendered)
 
     response["Content-Type"] = "image/svg+xml"
@@ -1092,9 +1496,26 @@ def badge(request, user_id):
     return response
 
 
+@user_passes_test(_staff_only)
 def badges(request):
     ''' Either displays a form containing a list of users with badges to
-    render, or returns a .zip file containing their badges. '''
+    render, or returns a .zip file containing their badges.
+
+    Rendering many badges here ties up a web server, so for large numbers of
+    badges, run the ``render_badges`` management command, and download its
+    output from ``badges_archive``.
+
+    Returns:
+        render or FileResponse: ``registrasion/badges.html`` with data::
+
+            {
+                "form": form,                # The form for choosing badges
+                "archive": bool(),           # True if the render_badges
+                                             # command has written an archive
+                                             # that can be downloaded
+            }
+
+    '''
 
     category = request.GET.getlist("category", [])
     product = request.GET.getlist("product", [])
@@ -1108,32 +1529,108 @@ def badges(request):
     )
 
     if form.is_valid():
-        response = HttpResponse()
-        response["Content-Type"] = "application.zip"
-        response["Content-Disposition"] = 'attachment; filename="badges.zip"'
+        users = User.objects.filter(
+            invoice__in=form.cleaned_data["invoice"],
+        ).distinct()
 
-        z = zipfile.ZipFile(response, "w")
+        # Build the zip on disk, rather than in memory, and stream it out
+        zip_file = tempfile.TemporaryFile()
+        badges_contrib.write_badges(users, zip_file)
+        zip_file.seek(0)
 
-        for invoice in form.cleaned_data["invoice"]:
-            user = invoice.user
-            badge = render_badge(user)
-            z.writestr("badge_%d.svg" % user.id, badge.encode("utf-8"))
+        response = FileResponse(zip_file)
+        response["Content-Type"] = "application/zip"
+        response["Content-Disposition"] = 'attachment; filename="badges.zip"'
 
         return response
 
     data = {
         "form": form,
+        "archive": badges_contrib.archive_path() is not None,
     }
 
     return render(request, "registrasion/badges.html", data)
 
 
+@user_passes_test(_staff_only)
+def badges_archive(request):
+    ''' Returns the .zip file of badges most recently written by the
+    ``render_badges`` management command, to ``BADGES_ARCHIVE``.
+
+    Raises:
+        Http404: if ``BADGES_ARCHIVE`` is not set, or the command has not
+            written it yet.
+
+    '''
+
+    path = badges_contrib.archive_path()
+    if path is None:
+        raise Http404()
+
+    response = FileResponse(open(path, "rb"))
+    response["Content-Type"] = "application/zip"
+    response["Content-Disposition"] = 'attachment; filename="badges.zip"'
+
+    return response
+
+
 def render_badge(user):
     ''' Renders a single user's badge. '''
 
+    return badges_contrib.render_badge(user)
+
+
+@user_passes_test(_staff_only)
+def check_in(request, access_code):
+    ''' Looks up an attendee by their access code, for the registration
+    desk. POSTing to this view marks the attendee as checked in.
+
+    Returns:
+        JsonResponse: with the attendee's manifest (see
+            ``CheckInController.as_dict``), and::
+
+                {
+                    "checked_in_now": bool(), # True if this request checked
+                                              # the attendee in
+                }
+
+    Raises:
+        Http404: if there is no attendee with that access code.
+
+    '''
+
+    ctrl = CheckInController.for_access_code(access_code)
+    if ctrl is None:
+        raise Http404()
+
+    checked_in_now = False
+    if request.method == "POST":
+        checked_in_now = ctrl.check_in()
+
+    data = ctrl.as_dict()
+    data["checked_in_now"] = checked_in_now
+
+    return JsonResponse(data)
+
+
+@user_passes_test(_staff_only)
+def check_in_export(request):
+    ''' Returns every attendee's manifest, so that scanners can look up
+    attendees while they are offline.
+
+    Returns:
+        JsonResponse: with data::
+
+            {
+                "time_exported": datetime(),
+                "attendees": [...], # See CheckInController.export
+            }
+
+    '''
+
     data = {
-        "user": user,
+        "time_exported": timezone.now(),
+        "attendees": CheckInController.export(),
     }
 
-    t = loader.get_template('registrasion/badge.svg')
-    return t.render(data)
+    return JsonResponse(data)